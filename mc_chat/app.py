@@ -3,57 +3,533 @@ Minecraft 聊天室后端 - Flask + Flask-SocketIO
 支持 WebRTC 多人语音聊天
 """
 import os
+
+from offload import monkey_patch, run_blocking
+
+# 服务模式：threading（默认）/ eventlet / gevent；协程模式必须在导入 Flask 等模块之前打补丁
+ASYNC_MODE = monkey_patch(os.environ.get('MC_ASYNC_MODE', 'threading'))
+
+import functools
 import random
 import string
-import uuid
-import json
 import time
+import uuid
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, send_file, send_from_directory
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
-from PIL import Image
-import base64
-from io import BytesIO
+from event_log import EventLogger, DEBUG, INFO, parse_level, parse_sampling
+from state import ChatState
+from persistence import ChatJournal
+from cluster import BusManager, ClusterLink, open_bus
+from fanout import Fanout, FanoutManager
+from compact import CompactCodec, compact_available
+from ice import IceCoalescer
+from sfu import VoiceRelay, sfu_available
+from speakers import ActiveSpeakers
+from expiry import ExpiryEngine
+from metrics import Metrics
+from search import MESSAGE_TYPES, SORTS, SearchIndex, parse_time, query_terms
+from ratelimit import RateLimiter, merge_limits, parse_limits, payload_size
+from avatars import AvatarStore, avatar_url
+from storage import ContentStore, content_digest, is_digest
+from skins import (SkinAliases, SkinJobQueue, SkinTooLargeError, SkinValidationError,
+                   migrate_legacy_skins, read_skin_form)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
+app.config['ASYNC_MODE'] = ASYNC_MODE
 app.config['UPLOAD_FOLDER'] = 'static/skins'
+app.config['AVATAR_FOLDER'] = 'static/avatars'
+app.config['AVATAR_CACHE_SIZE'] = 512
+# 皮肤处理进程池：工作进程数、最多排队任务数（超出返回 503）
+app.config['SKIN_WORKERS'] = int(os.environ.get('MC_SKIN_WORKERS', min(4, os.cpu_count() or 1)))
+app.config['SKIN_MAX_PENDING'] = int(os.environ.get('MC_SKIN_MAX_PENDING', 32))
+app.config['SKIN_USE_PROCESSES'] = os.environ.get('MC_SKIN_POOL', 'process') == 'process'
+# 单个皮肤文件大小上限（512x512 高清皮肤也远小于该值）
+app.config['SKIN_MAX_BYTES'] = 2 * 1024 * 1024
+# 语音消息按内容哈希保存为二进制文件，消息里只携带 ID、时长和大小
+app.config['VOICE_FOLDER'] = os.environ.get('MC_VOICE_FOLDER', 'voice_clips')
+app.config['VOICE_MAX_BYTES'] = 5 * 1024 * 1024
+app.config['VOICE_MAX_DURATION_MS'] = 5 * 60 * 1000
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
+# 事件日志配置：MC_EVENT_LOG_LEVEL=off 关闭，采样如 "webrtc_ice_candidate=0.1"
+app.config['EVENT_LOG_PATH'] = os.environ.get('MC_EVENT_LOG_PATH', 'mc_chat-events.log')
+app.config['EVENT_LOG_LEVEL'] = os.environ.get('MC_EVENT_LOG_LEVEL', 'info')
+app.config['EVENT_LOG_SAMPLING'] = os.environ.get('MC_EVENT_LOG_SAMPLING', '')
+app.config['EVENT_LOG_MAX_BYTES'] = int(os.environ.get('MC_EVENT_LOG_MAX_BYTES', 10 * 1024 * 1024))
+
+# 每种房间在内存中保留的历史消息条数（环形缓冲区容量），以及加入房间时下发的条数
+app.config['HISTORY_CAPACITY'] = {
+    'private': int(os.environ.get('MC_HISTORY_PRIVATE', 100)),
+    'group': int(os.environ.get('MC_HISTORY_GROUP', 100))
+}
+app.config['JOIN_HISTORY_COUNT'] = 50
+# get_history / /rooms/<room_id>/history 每页条数上限
+app.config['HISTORY_PAGE_MAX'] = 200
+# search_messages / /rooms/<room_id>/search 每页条数上限和查询文字长度上限
+app.config['SEARCH_PAGE_MAX'] = 50
+app.config['SEARCH_QUERY_MAX'] = 200
+# 每个房间最多索引的消息条数（索引全部在内存中，超出时淘汰最早的），0 为不限
+app.config['SEARCH_MAX_MESSAGES'] = int(os.environ.get('MC_SEARCH_MAX_MESSAGES', 50000))
+
+# 持久化数据库（SQLite WAL），设为空字符串时只保存在内存中
+app.config['CHAT_DB_PATH'] = os.environ.get('MC_CHAT_DB', 'mc_chat.db')
+app.config['CHAT_DB_SNAPSHOT_INTERVAL'] = float(os.environ.get('MC_CHAT_DB_SNAPSHOT_INTERVAL', 60))
+# 每个节点使用独立数据库时设为 1，其他工作进程的变更也写入本地数据库
+app.config['CHAT_DB_REPLICA'] = os.environ.get('MC_CHAT_DB_REPLICA', '') == '1'
+
+# 同一对用户的 ICE 候选合并转发窗口（毫秒），0 为逐条立即转发
+app.config['ICE_BATCH_MS'] = float(os.environ.get('MC_ICE_BATCH_MS', 10))
+app.config['ICE_BATCH_MAX'] = 32
+# 群聊成员数达到该值时语音改由服务端转发（需要 aiortc），0 为始终使用 mesh
+app.config['VOICE_SFU_MIN_MEMBERS'] = int(os.environ.get('MC_VOICE_SFU_MIN_MEMBERS', 9))
+# 活跃发言人：每个房间广播音量最大的前 K 人，广播间隔（毫秒）即每个房间的最高广播频率
+app.config['ACTIVE_SPEAKERS_TOP_K'] = int(os.environ.get('MC_ACTIVE_SPEAKERS', 3))
+app.config['ACTIVE_SPEAKERS_INTERVAL_MS'] = float(os.environ.get('MC_ACTIVE_SPEAKERS_INTERVAL_MS', 250))
+# 服务端 PeerConnection 使用的 STUN/TURN 地址（逗号分隔），服务器有公网地址时可留空
+app.config['VOICE_SFU_ICE_SERVERS'] = [url for url in os.environ.get('MC_VOICE_SFU_ICE_SERVERS', '').split(',') if url]
+
+# 多工作进程部署：mcq://127.0.0.1:2260（broker.py）或 redis://localhost:6379/0，留空为单进程
+app.config['MESSAGE_QUEUE'] = os.environ.get('MC_MESSAGE_QUEUE', '')
+app.config['PORT'] = int(os.environ.get('MC_PORT', 2250))
+# eventlet 模式下的并发连接上限和监听队列长度
+app.config['MAX_CONNECTIONS'] = int(os.environ.get('MC_MAX_CONNECTIONS', 10000))
+app.config['LISTEN_BACKLOG'] = int(os.environ.get('MC_LISTEN_BACKLOG', 2048))
+# 房间广播扇出线程数（0 为在处理线程中同步发送）；单个连接发送队列积压上限（包数）和最长积压时间（秒）
+app.config['FANOUT_WORKERS'] = int(os.environ.get('MC_FANOUT_WORKERS', 2))
+app.config['FANOUT_MAX_QUEUE'] = int(os.environ.get('MC_FANOUT_MAX_QUEUE', 256))
+app.config['FANOUT_MAX_LAG'] = float(os.environ.get('MC_FANOUT_MAX_LAG', 30))
+# 限流规则：事件 -> {作用域: (每秒补充令牌数, 最多攒多少个)}
+# user 按 socket 连接（HTTP 按客户端地址）计数，room 按房间计数，bytes 按负载字节数计数
+# MC_RATE_LIMITS 覆盖单项，例如 "send_message=2/10,upload_voice:bytes=0"（rate 为 0 取消该项），设为 off 关闭限流
+app.config['RATE_LIMITS'] = {
+    'send_message': {'user': (5, 20), 'room': (30, 60), 'bytes': (32 * 1024, 128 * 1024)},
+    'get_history': {'user': (2, 10)},
+    'search_messages': {'user': (2, 10)},
+    'create_invite': {'user': (0.2, 5)},
+    'join_invite': {'user': (0.5, 10)},
+    'invite_to_room': {'user': (0.5, 10)},
+    'delete_room': {'user': (0.5, 5)},
+    'webrtc_offer': {'user': (2, 20), 'bytes': (64 * 1024, 256 * 1024)},
+    'webrtc_answer': {'user': (2, 20), 'bytes': (64 * 1024, 256 * 1024)},
+    'webrtc_ice_candidate': {'user': (20, 100)},
+    'webrtc_ice_candidates': {'user': (10, 50)},
+    'join_voice_room': {'user': (1, 10)},
+    'sfu_publish': {'user': (1, 5)},
+    'voice_levels': {'user': (10, 20)},
+    'upload_skin': {'user': (0.1, 3), 'bytes': (1024 * 1024, 4 * 1024 * 1024)},
+    'upload_voice': {'user': (0.5, 5), 'bytes': (256 * 1024, 10 * 1024 * 1024)}
+}
+if os.environ.get('MC_RATE_LIMITS', '') == 'off':
+    app.config['RATE_LIMITS'] = {}
+else:
+    app.config['RATE_LIMITS'] = merge_limits(app.config['RATE_LIMITS'], parse_limits(os.environ.get('MC_RATE_LIMITS', '')))
+# 多进程部署时房间和 HTTP 的限流计数经消息总线共享（每次检查多一次总线往返）
+app.config['RATE_LIMIT_SHARED'] = os.environ.get('MC_RATE_LIMIT_SHARED', '') == '1'
+# 过期清理（秒，0 为不清理）：登录后一直没有连接的用户、邀请码有效期、没有成员在线的房间
+app.config['LOGIN_TTL'] = float(os.environ.get('MC_LOGIN_TTL', 600))
+app.config['INVITE_TTL'] = float(os.environ.get('MC_INVITE_TTL', 7 * 24 * 3600))
+app.config['ROOM_IDLE_TTL'] = float(os.environ.get('MC_ROOM_IDLE_TTL', 24 * 3600))
+# 重启后从数据库恢复的用户多久没有连接才移除（客户端用保存的 user_id 重新 register_user 即可回到原房间）
+app.config['RESTORED_USER_TTL'] = float(os.environ.get('MC_RESTORED_USER_TTL', 24 * 3600))
+# 群聊邀请码默认可用次数（0 为不限，create_invite 可以单独指定 max_uses），好友邀请码只能用一次
+app.config['INVITE_MAX_USES'] = int(os.environ.get('MC_INVITE_MAX_USES', 0))
+# 断线后保留会话的宽限期（秒）：期间用 resume_token 重连只补发漏收的消息，到期仍未重连才移除用户，0 为断线立即移除
+app.config['RESUME_GRACE'] = float(os.environ.get('MC_RESUME_GRACE', 120))
+app.config['EXPIRY_TICK'] = 1.0
+# 处理函数耗时、负载大小、扇出宽度等指标（GET /metrics），设为 0 关闭埋点
+app.config['METRICS'] = os.environ.get('MC_METRICS', '1') == '1'
+# 调试模式（自动重载、调试器），生产部署设为 0
+app.config['DEBUG_SERVER'] = os.environ.get('MC_DEBUG', '1') == '1'
+
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
-ALLOWED_EXTENSIONS = {'png'}
+# 配置了消息队列时，emit 经总线到达所有工作进程，聊天状态也通过总线复制
+bus = open_bus(app.config['MESSAGE_QUEUE']) if app.config['MESSAGE_QUEUE'] else None
+cluster = ClusterLink(bus) if bus is not None else None
+client_manager = BusManager(bus) if bus is not None else FanoutManager()
+
+# 房间广播由扇出线程写入各连接的发送队列，慢连接的积压有上限
+fanout = None
+if app.config['FANOUT_WORKERS'] > 0:
+    fanout = Fanout(
+        workers=app.config['FANOUT_WORKERS'],
+        max_queue=app.config['FANOUT_MAX_QUEUE'],
+        max_lag=app.config['FANOUT_MAX_LAG']
+    )
+    client_manager.fanout = fanout
+
+# 客户端连接时可以协商 MessagePack 紧凑编码（需要 msgpack），未安装时所有连接使用 JSON
+# 句柄表按需清理已删除的用户和房间（state 在下方创建，回调执行时已存在）
+codec = CompactCodec(alive=lambda value: state.has_user(value) or state.has_room(value)) \
+    if compact_available() else None
+client_manager.codec = codec
+
+# 运行指标：热路径只写当前线程的分片，/metrics 抓取时汇总
+metrics = Metrics() if app.config['METRICS'] else None
+client_manager.metrics = metrics
+
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=app.config['ASYNC_MODE'],
+                    client_manager=client_manager)
+if fanout is not None:
+    fanout.start(client_manager)
 
-# 内存数据存储
-users = {}  # user_id -> {nickname, skin_path, avatar, socket_id}
-rooms = {}  # room_id -> {type, name, members: [user_ids], messages: []}
-user_rooms = {}  # user_id -> [room_ids]
-room_peers = {}  # room_id -> {user_id: socket_id}  # 用于 WebRTC 信令
+ALLOWED_EXTENSIONS = {'png'}
 
-# 邀请码映射：短邀请码 -> 房间 ID
-invite_codes = {}
+# 限流器：令牌惰性补充，检查发生在处理函数之前
+rate_limiter = RateLimiter(
+    app.config['RATE_LIMITS'],
+    shared=bus if bus is not None and app.config['RATE_LIMIT_SHARED'] else None
+)
+
+event_log = EventLogger(
+    app.config['EVENT_LOG_PATH'],
+    level=parse_level(app.config['EVENT_LOG_LEVEL']),
+    sampling=parse_sampling(app.config['EVENT_LOG_SAMPLING']),
+    max_bytes=app.config['EVENT_LOG_MAX_BYTES']
+)
+
+# 持久化日志：变更由后台线程组提交，启动时从快照恢复
+journal = None
+if app.config['CHAT_DB_PATH']:
+    journal = ChatJournal(
+        app.config['CHAT_DB_PATH'],
+        snapshot_interval=app.config['CHAT_DB_SNAPSHOT_INTERVAL']
+    )
+
+# 消息搜索：每个房间一份倒排索引，随消息追加增量更新
+search_index = SearchIndex(max_messages=app.config['SEARCH_MAX_MESSAGES'])
+
+# 内存数据存储：用户、房间、邀请码、WebRTC 对等表及其反向索引
+state = ChatState(
+    history_capacity=app.config['HISTORY_CAPACITY'],
+    journal=journal,
+    cluster=cluster,
+    journal_remote=app.config['CHAT_DB_REPLICA'],
+    search=search_index
+)
+if journal is not None:
+    state.restore(journal.load(app.config['HISTORY_CAPACITY']))
+    indexed = state.index_history(journal.iter_messages())
+    journal.start()
+    print(f"已从 {app.config['CHAT_DB_PATH']} 恢复 {len(state.rooms)} 个房间、{len(state.invite_codes)} 个邀请码，"
+          f"索引 {indexed} 条历史消息")
+if cluster is not None:
+    cluster.start(state)
+    print(f"已加入集群：{app.config['MESSAGE_QUEUE']}（节点 {cluster.node_id}）")
+
+# 皮肤按规范化后的内容哈希存储，相同皮肤只保存一份；上传内容哈希 -> 皮肤哈希的映射用于跳过重复处理
+skin_store = ContentStore(app.config['UPLOAD_FOLDER'], '.png')
+skin_aliases = SkinAliases(capacity=app.config['AVATAR_CACHE_SIZE'])
+# 旧版以 <uuid>_<文件名>.png 保存的皮肤在启动时迁移为按哈希保存
+migrated_skins = migrate_legacy_skins(skin_store)
+if migrated_skins:
+    for uid, user in list(state.users.items()):
+        if user.get('skin_path') in migrated_skins:
+            state.update_user(uid, skin_path=migrated_skins[user['skin_path']])
+    print(f"已迁移 {len(migrated_skins)} 个旧版皮肤文件")
+
+# 头像按皮肤哈希存储（内存 LRU + 磁盘），消息和成员列表只携带 /avatar/<hash>.png
+avatar_store = AvatarStore(app.config['AVATAR_FOLDER'], capacity=app.config['AVATAR_CACHE_SIZE'])
+
+# 语音消息音频文件，按内容哈希寻址
+voice_store = ContentStore(app.config['VOICE_FOLDER'], '.webm')
+
+# 皮肤保存与头像生成在进程池中完成，请求线程只负责计算哈希和入队
+skin_jobs = SkinJobQueue(
+    max_workers=app.config['SKIN_WORKERS'],
+    max_pending=app.config['SKIN_MAX_PENDING'],
+    use_processes=app.config['SKIN_USE_PROCESSES'],
+    offload=app.config['ASYNC_MODE'] == 'eventlet'
+)
+
+def flush_ice_candidates(target_socket, payload):
+    socketio.emit('webrtc_ice_candidates', payload, to=target_socket)
+
+# trickle ICE 候选按 (房间, 发送方, 接收方) 攒批，一批只 emit 一次
+ice_relay = IceCoalescer(
+    flush_ice_candidates,
+    window=app.config['ICE_BATCH_MS'] / 1000,
+    max_batch=app.config['ICE_BATCH_MAX']
+)
+
+def emit_to_socket(target_socket, event, payload):
+    socketio.emit(event, payload, to=target_socket)
+
+# 语音转发：aiortc 的 asyncio 循环运行在原生线程中，只支持 threading 服务模式；
+# 转发状态保存在本进程内，多进程部署时仍使用 mesh
+voice_relay = None
+if app.config['VOICE_SFU_MIN_MEMBERS'] > 0 and sfu_available():
+    if app.config['ASYNC_MODE'] != 'threading' or bus is not None:
+        print('语音转发模式只支持单进程 threading 服务模式，已改用 mesh')
+    else:
+        voice_relay = VoiceRelay(emit_to_socket, ice_servers=app.config['VOICE_SFU_ICE_SERVERS'])
+        voice_relay.start()
+
+def flush_active_speakers(room_id, speakers):
+    socketio.emit('active_speakers', {'room_id': room_id, 'speakers': speakers}, room=voice_room(room_id))
+    # 转发模式下只转发活跃发言人的音频；从未上报音量的客户端不受影响
+    if voice_relay is not None and voice_relay.is_active(room_id):
+        active = {user_id for user_id, _ in speakers}
+        voice_relay.set_paused(room_id, active_speakers.reporters(room_id) - active)
+
+active_speakers = ActiveSpeakers(
+    flush_active_speakers,
+    top_k=app.config['ACTIVE_SPEAKERS_TOP_K'],
+    interval=app.config['ACTIVE_SPEAKERS_INTERVAL_MS'] / 1000
+)
+
+def expire_offline_user(user_id):
+    """登录后一直没有连接，或断线后宽限期内没有重连：移除用户"""
+    nickname = state.nickname(user_id)
+    left_rooms = state.expire_user(user_id)
+    if left_rooms is None:
+        return False
+    for room_id in left_rooms:
+        socketio.emit('user_left', {'user_id': user_id, 'nickname': nickname}, room=room_id)
+        expiry.schedule('room', room_id, app.config['ROOM_IDLE_TTL'])
+    return True
+
+def expire_room(room_id):
+    """长时间没有成员在线：删除房间及其历史消息和邀请码"""
+    if not state.is_room_idle(room_id):
+        return False
+    discard_room(room_id)
+    print(f'房间 {room_id} 长时间无人在线，已清理')
+    return True
+
+def when_synced(kind, handler):
+    """
+    多进程部署时，本进程与其他进程完成全量同步之前看不到它们的连接（在线用户会被当成离线），
+    清理推迟到同步之后；同步之后本地的在线状态即集群的在线状态
+    """
+    if cluster is None:
+        return handler
+    def wrapper(key):
+        if not cluster.synced():
+            expiry.schedule(kind, key, cluster.NODE_TIMEOUT)
+            return False
+        return handler(key)
+    return wrapper
+
+# 用户、邀请码、房间的过期都登记在同一个时间轮上，由一个后台线程推进
+expiry = ExpiryEngine(tick=app.config['EXPIRY_TICK'])
+expiry.on('login', when_synced('login', expire_offline_user))
+expiry.on('session', when_synced('session', expire_offline_user))
+expiry.on('invite', state.remove_invite_code)
+expiry.on('room', when_synced('room', expire_room))
+# 恢复出来的用户都还没有连接，房间也都无人在线；用户等待重连的时间比新登录的长，普通重启不会清掉成员关系
+for restored_user_id in list(state.users):
+    expiry.schedule('login', restored_user_id, app.config['RESTORED_USER_TTL'])
+for restored_room_id in list(state.rooms):
+    expiry.schedule('room', restored_room_id, app.config['ROOM_IDLE_TTL'])
+for code, expires_at in state.invite_expiries().items():
+    expiry.schedule('invite', code, max(expires_at - time.time(), app.config['EXPIRY_TICK']))
+expiry.start()
+
+def handle_node_lost(node_id, sessions):
+    """
+    其他工作进程失联：它负责的会话已在各进程解绑（见 ClusterLink），语音模式各自清理；
+    通知语音房间、登记会话过期只由抢到租约的一个进程执行
+    """
+    ended = set()
+    for voice_room_ids in sessions.values():
+        for room_id in voice_room_ids:
+            if state.voice_count(room_id) == 0:
+                voice_modes.pop(room_id, None)
+                ended.add(room_id)
+    if not cluster.claim(f'node_lost:{node_id}'):
+        return
+    for user_id, voice_room_ids in sessions.items():
+        for room_id in voice_room_ids:
+            socketio.emit('user_left_voice', {
+                'user_id': user_id,
+                'nickname': state.nickname(user_id, '未知')
+            }, room=voice_room(room_id))
+        if app.config['RESUME_GRACE'] > 0:
+            expiry.schedule('session', user_id, app.config['RESUME_GRACE'])
+        else:
+            expire_offline_user(user_id)
+    for room_id in ended:
+        socketio.emit('voice_ended', {'room_id': room_id}, room=room_id)
+
+if cluster is not None:
+    cluster.on('node_lost', handle_node_lost)
+
+def rate_limited(event):
+    """
+    Socket.IO 事件限流：超出时回复 rate_limited，不进入处理函数
+    房间的桶只由该房间的成员消耗，非成员拿任意 room_id 也耗不掉别人房间的令牌（请求仍由处理函数拒绝）
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(data=None, *args):
+            room_id = data.get('room_id') if isinstance(data, dict) else None
+            if room_id and not state.is_member(room_id, data.get('user_id')):
+                room_id = None
+            size = payload_size(data) if rate_limiter.measures(event) else 0
+            wait = rate_limiter.check(event, request.sid, room_id=room_id, size=size)
+            if wait:
+                emit('rate_limited', {
+                    'event': event,
+                    'room_id': room_id,
+                    'retry_after': round(wait, 2),
+                    'message': '操作过于频繁，请稍后再试'
+                })
+                return None
+            return handler(data, *args)
+        return wrapper
+    return decorator
+
+def http_rate_limited(event):
+    """HTTP 接口限流：在解析请求体之前按客户端地址和 Content-Length 检查，超出时返回 429"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            wait = rate_limiter.check(
+                event, request.remote_addr,
+                size=request.content_length or 0,
+                shared_client=True
+            )
+            if wait:
+                response = jsonify({'success': False, 'message': '操作过于频繁，请稍后再试'})
+                response.headers['Retry-After'] = str(max(1, int(wait + 0.999)))
+                return response, 429
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def register_invite_code(code, room_id, max_uses):
+    """登记邀请码并安排过期清理"""
+    ttl = app.config['INVITE_TTL']
+    state.add_invite_code(code, room_id, expires_at=time.time() + ttl if ttl > 0 else None, max_uses=max_uses)
+    expiry.schedule('invite', code, ttl)
+
+def invite_max_uses(data):
+    """群聊邀请码的可用次数：请求中的 max_uses，缺省用配置"""
+    try:
+        return max(0, int(data.get('max_uses', app.config['INVITE_MAX_USES'])))
+    except (TypeError, ValueError):
+        return app.config['INVITE_MAX_USES']
+
 def generate_invite_code(length=6):
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
 
-def extract_avatar(skin_path):
-    try:
-        img = Image.open(skin_path)
-        face = img.crop((8, 8, 16, 16))
-        avatar = face.resize((64, 64), Image.NEAREST)
-        buffer = BytesIO()
-        avatar.save(buffer, format='PNG')
-        avatar_base64 = base64.b64encode(buffer.getvalue()).decode()
-        return f"data:image/png;base64,{avatar_base64}"
-    except Exception as e:
-        print(f"提取头像失败：{e}")
+def on_skin_processed(job, avatar_bytes):
+    """皮肤任务完成：写入头像缓存，更新用户并推送 skin_ready"""
+    if metrics is not None:
+        metrics.observe('mc_skin_job_seconds', ('ready' if avatar_bytes is not None else 'failed',),
+                        job['finished'] - job['created'])
+    if avatar_bytes is not None:
+        run_blocking(avatar_store.put, job['skin_hash'], avatar_bytes)
+        skin_aliases.put(job['upload_hash'], job['skin_hash'])
+        job['avatar'] = avatar_url(job['skin_hash'])
+        job['status'] = 'ready'
+    else:
+        print(f"提取头像失败：{job['error']}")
+
+    for uid in job['user_ids']:
+        if job['avatar']:
+            state.update_user(uid, skin_path=skin_store.path(job['skin_hash']), avatar=job['avatar'])
+        user = state.get_user(uid)
+        if user and user['socket_id']:
+            socketio.emit('skin_ready', {
+                'job_id': job['job_id'],
+                'status': job['status'],
+                'avatar': job['avatar'],
+                'skin_url': skin_job_url(job)
+            }, to=user['socket_id'])
+
+def skin_job_url(job):
+    """任务完成前皮肤哈希未知，返回 None"""
+    return f"/static/skins/{skin_store.filename(job['skin_hash'])}" if job['skin_hash'] else None
+
+def member_info(uid):
+    user = state.get_user(uid)
+    if user is None:
         return None
+    return {
+        'user_id': uid,
+        'nickname': user['nickname'],
+        'avatar': user['avatar']
+    }
+
+def room_members_info(room_id):
+    members_info = []
+    for uid in state.member_ids(room_id):
+        info = member_info(uid)
+        if info:
+            members_info.append(info)
+    return members_info
+
+def read_history_page(room_id, data, default_limit):
+    """按 before / after 游标和 limit 读取一页历史，返回 (page, error)"""
+    try:
+        limit = int(data.get('limit') or default_limit)
+    except (TypeError, ValueError):
+        return None, '无效的 limit'
+    limit = max(1, min(limit, app.config['HISTORY_PAGE_MAX']))
+
+    before = data.get('before') or None
+    after = data.get('after') or None
+    if before and after:
+        return None, 'before 和 after 不能同时使用'
+
+    page = state.history_page(room_id, before=before, after=after, limit=limit)
+    if page is None:
+        return None, '房间不存在'
+    return page, None
+
+def read_search(room_id, data):
+    """
+    按 query / type / from_user_id / since / until / sort / offset / limit 搜索房间历史，返回 (result, error)
+    query 为空时只按条件筛选，按时间倒序返回
+    """
+    query = data.get('query') or ''
+    if not isinstance(query, str) or len(query) > app.config['SEARCH_QUERY_MAX']:
+        return None, '无效的搜索内容'
+    terms = query_terms(query)
+
+    message_type = data.get('type') or None
+    if message_type is not None and message_type not in MESSAGE_TYPES:
+        return None, '无效的消息类型'
+    sort = data.get('sort') or 'relevance'
+    if sort not in SORTS:
+        return None, '无效的排序方式'
+    from_user_id = data.get('from_user_id') or None
+
+    try:
+        since = parse_time(data.get('since'))
+        until = parse_time(data.get('until'))
+    except (TypeError, ValueError):
+        return None, '无效的时间范围'
+    try:
+        offset = max(0, int(data.get('offset') or 0))
+        limit = int(data.get('limit') or 20)
+    except (TypeError, ValueError):
+        return None, '无效的 offset 或 limit'
+    limit = max(1, min(limit, app.config['SEARCH_PAGE_MAX']))
+
+    if not terms and query.strip():
+        # 只有标点等不会被索引的字符
+        return {'terms': [], 'messages': [], 'offset': offset, 'has_more': False}, None
+    if not terms and from_user_id is None and message_type is None and since is None and until is None:
+        return None, '请输入搜索内容或筛选条件'
+
+    result = state.search_messages(
+        room_id, terms, offset=offset, limit=limit, user_id=from_user_id,
+        message_type=message_type, since=since, until=until, sort=sort
+    )
+    if result is None:
+        return None, '房间不存在'
+    result['terms'] = terms
+    result['offset'] = offset
+    return result, None
 
 @app.route('/')
 def index():
@@ -68,97 +544,304 @@ def login():
         return jsonify({'success': False, 'message': '请输入昵称'})
 
     user_id = str(uuid.uuid4())
-    users[user_id] = {
-        'nickname': nickname,
-        'skin_path': None,
-        'avatar': None,
-        'socket_id': None
-    }
+    state.add_user(user_id, nickname)
+    expiry.schedule('login', user_id, app.config['LOGIN_TTL'])
 
     print(f'登录成功 - user_id: {user_id}, nickname: {nickname}')
     return jsonify({'success': True, 'user_id': user_id, 'nickname': nickname})
 
 @app.route('/upload_skin', methods=['POST'])
+@http_rate_limited('upload_skin')
 def upload_skin():
-    user_id = request.form.get('user_id')
+    """
+    上传皮肤：边读边解析请求体，PNG 文件头不合法或超过大小上限时立即拒绝，不再读取剩余部分
+    重复上传同一文件时直接返回已保存的皮肤，否则交给进程池处理并返回 202
+    """
+    max_bytes = app.config['SKIN_MAX_BYTES']
+    # 请求体明显超过皮肤上限时，一个字节都不读
+    if request.content_length and request.content_length > max_bytes + 64 * 1024:
+        return jsonify({'success': False, 'message': '皮肤文件过大'}), 413
+
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'success': False, 'message': '没有上传文件'})
 
-    if not user_id or user_id not in users:
+    try:
+        fields, filename, skin_bytes = read_skin_form(request.stream, boundary, max_bytes)
+    except SkinTooLargeError as e:
+        return jsonify({'success': False, 'message': str(e)}), 413
+    except SkinValidationError as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+    user_id = fields.get('user_id')
+    if not state.has_user(user_id):
         return jsonify({'success': False, 'message': '用户不存在'})
 
-    if 'skin' not in request.files:
+    if skin_bytes is None:
         return jsonify({'success': False, 'message': '没有上传文件'})
-
-    file = request.files['skin']
-    if file.filename == '':
+    if not filename:
         return jsonify({'success': False, 'message': '没有选择文件'})
-
-    if file and allowed_file(file.filename):
-        filename = secure_filename(f"{user_id}_{file.filename}")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-
-        avatar = extract_avatar(filepath)
-        users[user_id]['skin_path'] = filepath
-        users[user_id]['avatar'] = avatar
-
+    if not allowed_file(filename):
+        return jsonify({'success': False, 'message': '只支持 PNG 格式文件'})
+
+    # 同一文件已处理过（或上传的就是已保存的规范化皮肤）时直接返回，不写盘也不解码
+    upload_hash = run_blocking(content_digest, skin_bytes)
+    skin_hash = skin_aliases.get(upload_hash) or upload_hash
+    if skin_store.exists(skin_hash) and avatar_store.has(skin_hash):
+        avatar = avatar_url(skin_hash)
+        state.update_user(user_id, skin_path=skin_store.path(skin_hash), avatar=avatar)
         return jsonify({
             'success': True,
-            'skin_url': f'/static/skins/{filename}',
+            'status': 'ready',
+            'skin_url': f'/static/skins/{skin_store.filename(skin_hash)}',
             'avatar': avatar
         })
 
-    return jsonify({'success': False, 'message': '只支持 PNG 格式文件'})
+    # 交给进程池规范化、保存并生成头像，完成后通过 skin_ready 推送
+    job = skin_jobs.submit(user_id, upload_hash, skin_bytes, skin_store.root, on_skin_processed)
+    if job is None:
+        return jsonify({'success': False, 'message': '服务器繁忙，请稍后再试'}), 503
+
+    return jsonify({
+        'success': True,
+        'status': job['status'],
+        'job_id': job['job_id'],
+        'skin_url': skin_job_url(job),
+        'avatar': job['avatar']
+    }), 202
+
+@app.route('/skin_job/<job_id>')
+def skin_job_status(job_id):
+    """查询皮肤处理任务状态"""
+    job = skin_jobs.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+
+    return jsonify({
+        'success': job['status'] != 'failed',
+        'status': job['status'],
+        'job_id': job_id,
+        'skin_url': skin_job_url(job),
+        'avatar': job['avatar'],
+        'message': '皮肤处理失败' if job['status'] == 'failed' else None
+    })
+
+@app.route('/upload_voice', methods=['POST'])
+@http_rate_limited('upload_voice')
+def upload_voice():
+    """上传语音消息音频，返回语音 ID；随后客户端用 send_message 发送该 ID"""
+    if request.content_length and request.content_length > app.config['VOICE_MAX_BYTES'] + 64 * 1024:
+        return jsonify({'success': False, 'message': '语音文件过大'}), 413
+
+    user_id = request.form.get('user_id')
+    room_id = request.form.get('room_id')
+
+    if not state.has_user(user_id):
+        return jsonify({'success': False, 'message': '用户不存在'})
+
+    if not state.is_member(room_id, user_id):
+        return jsonify({'success': False, 'message': '房间不存在'})
+
+    file = request.files.get('audio')
+    if file is None:
+        return jsonify({'success': False, 'message': '没有上传文件'})
+
+    max_bytes = app.config['VOICE_MAX_BYTES']
+    audio_bytes = file.stream.read(max_bytes + 1)
+    if not audio_bytes:
+        return jsonify({'success': False, 'message': '语音内容为空'})
+    if len(audio_bytes) > max_bytes:
+        return jsonify({'success': False, 'message': '语音文件过大'}), 413
+
+    voice_id, _ = run_blocking(voice_store.put, audio_bytes)
+    return jsonify({
+        'success': True,
+        'voice_id': voice_id,
+        'size': len(audio_bytes),
+        'url': f'/voice/{voice_id}'
+    })
+
+@app.route('/voice/<voice_id>')
+def serve_voice(voice_id):
+    """按需下载语音，支持 Range 请求以便边下边播"""
+    if not voice_store.exists(voice_id):
+        return jsonify({'success': False, 'message': '语音不存在'}), 404
+
+    return send_file(
+        os.path.abspath(voice_store.path(voice_id)),
+        mimetype='audio/webm',
+        conditional=True,
+        etag=voice_id,
+        max_age=365 * 24 * 3600
+    )
+
+@app.route('/rooms/<room_id>/history')
+@http_rate_limited('get_history')
+def room_history(room_id):
+    """分页读取房间历史：?user_id=&before=<消息ID>|after=<消息ID>&limit="""
+    user_id = request.args.get('user_id')
+    if not state.has_user(user_id) or not state.is_member(room_id, user_id):
+        return jsonify({'success': False, 'message': '不是房间成员'}), 403
+
+    page, error = read_history_page(room_id, request.args, app.config['JOIN_HISTORY_COUNT'])
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+
+    return jsonify({
+        'success': True,
+        'room_id': room_id,
+        'messages': page['messages'],
+        'has_more': page['has_more'],
+        'reset': page['reset']
+    })
+
+@app.route('/rooms/<room_id>/search')
+@http_rate_limited('search_messages')
+def room_search(room_id):
+    """搜索房间历史：?user_id=&query=&type=&from_user_id=&since=&until=&sort=&offset=&limit="""
+    user_id = request.args.get('user_id')
+    if not state.has_user(user_id) or not state.is_member(room_id, user_id):
+        return jsonify({'success': False, 'message': '不是房间成员'}), 403
+
+    result, error = read_search(room_id, request.args)
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+
+    return jsonify({
+        'success': True,
+        'room_id': room_id,
+        'query': request.args.get('query', ''),
+        'terms': result['terms'],
+        'messages': result['messages'],
+        'offset': result['offset'],
+        'has_more': result['has_more']
+    })
+
+@app.route('/stats')
+def runtime_stats():
+    """运行状态：扇出队列与慢连接、限流、过期清理、事件日志、持久化、集群复制、语音等各组件的计数"""
+    return jsonify({
+        'fanout': fanout.stats() if fanout is not None else None,
+        'event_log': event_log.stats(),
+        'journal': journal.stats() if journal is not None else None,
+        'cluster': cluster.stats() if cluster is not None else None,
+        'skin_jobs': skin_jobs.stats(),
+        'ice': ice_relay.stats(),
+        'active_speakers': active_speakers.stats(),
+        'voice_relay': voice_relay.stats() if voice_relay is not None else None,
+        'rate_limit': rate_limiter.stats(),
+        'compact': codec.stats() if codec is not None else None,
+        'expiry': expiry.stats(),
+        'state': state.stats(),
+        'search': search_index.stats()
+    })
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 文本格式的处理函数调用次数、错误、耗时和负载分布，以及连接数、房间数等当前值"""
+    if metrics is None:
+        return Response('metrics disabled\n', status=404, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/static/skins/<filename>')
 def serve_skin(filename):
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+@app.route('/avatar/<avatar_hash>.png')
+def serve_avatar(avatar_hash):
+    """按内容哈希提供头像，内容不可变，可长期缓存"""
+    data = avatar_store.get(avatar_hash)
+    if data is None:
+        return jsonify({'success': False, 'message': '头像不存在'}), 404
+
+    response = Response(data, mimetype='image/png')
+    response.set_etag(avatar_hash)
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
 # ==================== WebSocket 事件 ====================
 
 @socketio.on('connect')
-def handle_connect():
-    print(f'用户连接：{request.sid}')
+def handle_connect(auth=None):
+    compact = codec is not None and isinstance(auth, dict) and auth.get('encoding') == 'msgpack'
+    if compact:
+        codec.enable(request.sid)
+    print(f"用户连接：{request.sid}{'（紧凑编码）' if compact else ''}")
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print(f'用户断开：{request.sid}')
+    ice_relay.discard(request.sid)
+    if voice_relay is not None:
+        voice_relay.leave_sid(request.sid)
     
-    # 清理用户数据
-    for user_id, data in users.items():
-        if data.get('socket_id') == request.sid:
-            # 从所有房间移除
-            for room_id in list(user_rooms.get(user_id, [])):
-                if room_id in rooms:
-                    if user_id in rooms[room_id]['members']:
-                        rooms[room_id]['members'].remove(user_id)
-                    
-                    # 通知其他人用户离开
-                    emit('user_left', {
-                        'user_id': user_id,
-                        'nickname': data['nickname']
-                    }, room=room_id)
-                
-                # 清理 WebRTC 信令数据
-                if room_id in room_peers:
-                    if user_id in room_peers[room_id]:
-                        del room_peers[room_id][user_id]
-            
-            if user_id in user_rooms:
-                del user_rooms[user_id]
-            
-            # 从全局用户列表移除
-            if user_id in users:
-                del users[user_id]
-            break
+    # 通过 sid 索引直接找到用户
+    user_id = state.user_by_sid(request.sid)
+    if not user_id:
+        return
+
+    # 语音连接无法跨 socket 保留，立即离开
+    for room_id in state.voice_rooms_of(user_id):
+        leave_voice(room_id, user_id)
+
+    # 保留会话和房间成员关系，只解绑 socket；宽限期内没有用 resume_token 重连才移除用户并通知其他人
+    if not state.suspend_session(user_id, request.sid):
+        return
+    if app.config['RESUME_GRACE'] > 0:
+        expiry.schedule('session', user_id, app.config['RESUME_GRACE'])
+    else:
+        expire_offline_user(user_id)
 
 @socketio.on('register_user')
 def handle_register(data):
     user_id = data.get('user_id')
-    if user_id and user_id in users:
-        users[user_id]['socket_id'] = request.sid
+    if state.bind_socket(user_id, request.sid):
+        expiry.cancel('login', user_id)
+        expiry.cancel('session', user_id)
+        emit('session', {'resume_token': state.issue_resume_token(user_id)})
         print(f'用户 {user_id} 注册 socket: {request.sid}')
+    else:
+        emit('register_error', {'message': '用户不存在，请重新登录'})
+
+@socketio.on('resume_session')
+def handle_resume_session(data):
+    """
+    断线重连：{resume_token, rooms: {room_id: 本地最后一条消息的 ID}}
+    把新 socket 绑定到原会话、重新加入各房间，不广播 user_joined，每个房间只补发游标之后的消息
+    """
+    resumed = state.resume_session(data.get('resume_token'), request.sid)
+    if resumed is None:
+        emit('session_expired', {})
+        return
+    user_id, room_ids, resume_token = resumed
+    expiry.cancel('session', user_id)
+
+    cursors = data.get('rooms')
+    if not isinstance(cursors, dict):
+        cursors = {}
+    rooms = []
+    for room_id in room_ids:
+        join_room(room_id)
+        expiry.cancel('room', room_id)
+        # 本地没有缓存的房间打开时再加载
+        if not cursors.get(room_id):
+            continue
+        page = state.history_page(room_id, after=cursors[room_id], limit=app.config['JOIN_HISTORY_COUNT'])
+        if page is not None:
+            rooms.append({
+                'room_id': room_id,
+                'messages': page['messages'],
+                'has_more': page['has_more'],
+                'reset': page['reset']
+            })
+
+    emit('session_resumed', {'user_id': user_id, 'resume_token': resume_token, 'rooms': rooms})
+    print(f'用户 {user_id} 恢复会话 socket: {request.sid}')
 
 @socketio.on('create_invite')
+@rate_limited('create_invite')
 def handle_create_invite(data):
     user_id = data.get('user_id')
     invite_type = data.get('type', 'friend')
@@ -166,31 +849,31 @@ def handle_create_invite(data):
     existing_room_id = data.get('existing_room_id')
     invite_code = data.get('invite_code')
 
-    if not user_id or user_id not in users:
+    if not state.has_user(user_id):
         emit('invite_error', {'message': '用户不存在'})
         return
 
     # 如果是为已有房间生成邀请码
-    if existing_room_id and existing_room_id in rooms:
-        room = rooms[existing_room_id]
+    room = state.get_room(existing_room_id)
+    if room is not None:
         if room['type'] != 'group':
             emit('invite_error', {'message': '只有群聊才能邀请他人'})
             return
         
         # 检查用户是否是房间成员
-        if user_id not in room['members']:
+        if not state.is_member(existing_room_id, user_id):
             emit('invite_error', {'message': '您不是该房间成员'})
             return
         
         # 生成邀请码（使用传入的或新生成）
         code = invite_code if invite_code else generate_invite_code()
-        invite_codes[code] = existing_room_id
+        register_invite_code(code, existing_room_id, invite_max_uses(data))
         
         emit('invite_to_room_success', {
             'room_id': existing_room_id,
             'room_name': room['name'],
             'invite_code': code,
-            'inviter_nickname': users[user_id]['nickname']
+            'inviter_nickname': state.nickname(user_id)
         })
         return
 
@@ -198,89 +881,65 @@ def handle_create_invite(data):
     code = generate_invite_code()
     room_id = str(uuid.uuid4())
 
-    # 记录邀请码与房间 ID 的映射，供后续通过短码加入
-    invite_codes[code] = room_id
+    # 记录邀请码与房间 ID 的映射，供后续通过短码加入；好友邀请码只能用一次
+    register_invite_code(code, room_id, 1 if invite_type == 'friend' else invite_max_uses(data))
 
-    # region agent log
-    try:
-        log_entry = {
-            "sessionId": "da94d2",
-            "id": f"log_{int(time.time() * 1000)}",
-            "timestamp": int(time.time() * 1000),
-            "location": "app.py:handle_create_invite",
-            "message": "create_invite generated",
-            "data": {
+    if event_log.enabled_for(INFO):
+        event_log.log(
+            "app.py:handle_create_invite", "create_invite generated",
+            {
                 "user_id": user_id,
                 "invite_type": invite_type,
                 "room_name": room_name,
                 "room_id": room_id,
                 "code": code
             },
-            "runId": "pre-fix",
-            "hypothesisId": "H1"
-        }
-        with open("debug-da94d2.log", "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-    except Exception:
-        pass
-    # endregion
-
-    rooms[room_id] = {
-        'type': 'private' if invite_type == 'friend' else 'group',
-        'name': room_name if invite_type == 'group' else f'{users[user_id]["nickname"]}的聊天',
-        'members': [user_id],
-        'messages': []
-    }
-
-    room_peers[room_id] = {user_id: request.sid}
-    user_rooms[user_id] = [room_id]
+            level=INFO, event='create_invite'
+        )
+
+    room = state.create_room(
+        room_id,
+        'private' if invite_type == 'friend' else 'group',
+        room_name if invite_type == 'group' else f'{state.nickname(user_id)}的聊天',
+        user_id,
+        request.sid
+    )
     join_room(room_id)
 
     emit('invite_created', {
         'code': code,
         'room_id': room_id,
         'type': invite_type,
-        'room_name': rooms[room_id]['name']
+        'room_name': room['name']
     })
 
 @socketio.on('join_invite')
+@rate_limited('join_invite')
 def handle_join_invite(data):
     user_id = data.get('user_id')
     code = data.get('code', '').strip().lower()
 
     print(f'加入邀请 - user_id: {user_id}, code: {code}')
 
-    # region agent log
-    try:
-        log_entry = {
-            "sessionId": "da94d2",
-            "id": f"log_{int(time.time() * 1000)}",
-            "timestamp": int(time.time() * 1000),
-            "location": "app.py:handle_join_invite",
-            "message": "join_invite received",
-            "data": {
+    if event_log.enabled_for(INFO):
+        event_log.log(
+            "app.py:handle_join_invite", "join_invite received",
+            {
                 "user_id": user_id,
                 "raw_code": code
             },
-            "runId": "pre-fix",
-            "hypothesisId": "H1"
-        }
-        with open("debug-da94d2.log", "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-    except Exception:
-        pass
-    # endregion
+            level=INFO, event='join_invite'
+        )
 
-    if not user_id or user_id not in users:
+    if not state.has_user(user_id):
         emit('join_error', {'message': '用户不存在'})
         return
 
-    room_id = None
     resolve_source = None
 
     # 1) 优先尝试使用短邀请码映射
-    if code in invite_codes:
-        room_id = invite_codes[code]
+    room_id = state.resolve_invite_code(code)
+    if room_id is not None:
         resolve_source = 'short_code'
     else:
         # 2) 再尝试把 code 当作房间 UUID 处理（兼容直接使用 room_id 的情况）
@@ -289,148 +948,175 @@ def handle_join_invite(data):
             room_id = code
             resolve_source = 'room_id'
         except ValueError:
-            # region agent log
-            try:
-                log_entry = {
-                    "sessionId": "da94d2",
-                    "id": f"log_{int(time.time() * 1000)}",
-                    "timestamp": int(time.time() * 1000),
-                    "location": "app.py:handle_join_invite",
-                    "message": "join_invite invalid_code",
-                    "data": {
+            if event_log.enabled_for(INFO):
+                event_log.log(
+                    "app.py:handle_join_invite", "join_invite invalid_code",
+                    {
                         "user_id": user_id,
                         "raw_code": code
                     },
-                    "runId": "pre-fix",
-                    "hypothesisId": "H1"
-                }
-                with open("debug-da94d2.log", "a", encoding="utf-8") as f:
-                    f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-            except Exception:
-                pass
-            # endregion
+                    level=INFO, event='join_invite'
+                )
             emit('join_error', {'message': '无效的邀请码'})
             return
 
-    if room_id not in rooms:
+    room = state.get_room(room_id)
+    if room is None:
         emit('join_error', {'message': '房间不存在'})
         return
 
-    room = rooms[room_id]
-
-    # region agent log
-    try:
-        log_entry = {
-            "sessionId": "da94d2",
-            "id": f"log_{int(time.time() * 1000)}",
-            "timestamp": int(time.time() * 1000),
-            "location": "app.py:handle_join_invite",
-            "message": "join_invite success",
-            "data": {
+    if event_log.enabled_for(INFO):
+        event_log.log(
+            "app.py:handle_join_invite", "join_invite success",
+            {
                 "user_id": user_id,
                 "room_id": room_id,
                 "resolve_source": resolve_source,
                 "room_type": room['type'],
                 "member_count": len(room['members'])
             },
-            "runId": "pre-fix",
-            "hypothesisId": "H1"
-        }
-        with open("debug-da94d2.log", "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-    except Exception:
-        pass
-    # endregion
-
-    is_new_member = False
-    if user_id not in room['members']:
-        room['members'].append(user_id)
-        is_new_member = True
-
-    # 添加到房间对等列表
-    if room_id not in room_peers:
-        room_peers[room_id] = {}
-    room_peers[room_id][user_id] = request.sid
-
-    if user_id not in user_rooms:
-        user_rooms[user_id] = []
-    if room_id not in user_rooms[user_id]:
-        user_rooms[user_id].append(room_id)
+            level=INFO, event='join_invite'
+        )
+
+    # 加入成员列表、房间对等列表和用户房间索引
+    is_new_member = state.add_member(room_id, user_id, request.sid)
+    if is_new_member is None:
+        emit('join_error', {'message': '房间不存在'})
+        return
 
     join_room(room_id)
-    users[user_id]['socket_id'] = request.sid
+    state.bind_socket(user_id, request.sid)
+    expiry.cancel('room', room_id)
 
     # 通知其他人（仅当是新成员时）
     if is_new_member:
-        emit('user_joined', {
-            'user_id': user_id,
-            'nickname': users[user_id]['nickname'],
-            'avatar': users[user_id]['avatar']
-        }, room=room_id, include_self=False)
+        emit('user_joined', member_info(user_id), room=room_id, include_self=False)
+        if resolve_source == 'short_code' and state.use_invite_code(code):
+            expiry.cancel('invite', code)
 
-    # 返回房间信息 - 确保包含所有成员
-    members_info = []
-    for uid in room['members']:
-        if uid in users:
-            members_info.append({
-                'user_id': uid,
-                'nickname': users[uid]['nickname'],
-                'avatar': users[uid]['avatar']
-            })
+    # 客户端带上本地最后一条消息的 ID（after）时只补发缺失的部分，否则下发最新一页
+    page = state.history_page(
+        room_id, after=data.get('after') or None, limit=app.config['JOIN_HISTORY_COUNT']
+    ) or {'messages': [], 'has_more': False, 'reset': False}
 
+    # 返回房间信息 - 确保包含所有成员
     emit('join_success', {
         'room_id': room_id,
         'room_name': room['name'],
         'room_type': room['type'],
-        'members': members_info,
-        'messages': room['messages'][-50:]
+        'members': room_members_info(room_id),
+        'messages': page['messages'],
+        'has_more': page['has_more'],
+        'history_reset': page['reset'],
+        'history_after': None if page['reset'] else data.get('after') or None
+    })
+
+@socketio.on('get_history')
+@rate_limited('get_history')
+def handle_get_history(data):
+    """按游标分页读取历史：{user_id, room_id, before | after, limit}"""
+    user_id = data.get('user_id')
+    room_id = data.get('room_id')
+
+    if not state.has_user(user_id) or not state.is_member(room_id, user_id):
+        emit('history_error', {'room_id': room_id, 'message': '不是房间成员'})
+        return
+
+    page, error = read_history_page(room_id, data, app.config['JOIN_HISTORY_COUNT'])
+    if error:
+        emit('history_error', {'room_id': room_id, 'message': error})
+        return
+
+    emit('history', {
+        'room_id': room_id,
+        'before': data.get('before'),
+        'after': data.get('after'),
+        'messages': page['messages'],
+        'has_more': page['has_more'],
+        'reset': page['reset']
+    })
+
+@socketio.on('search_messages')
+@rate_limited('search_messages')
+def handle_search_messages(data):
+    """搜索房间历史：{user_id, room_id, query, type, from_user_id, since, until, sort, offset, limit}"""
+    user_id = data.get('user_id')
+    room_id = data.get('room_id')
+
+    if not state.has_user(user_id) or not state.is_member(room_id, user_id):
+        emit('search_error', {'room_id': room_id, 'message': '不是房间成员'})
+        return
+
+    result, error = read_search(room_id, data)
+    if error:
+        emit('search_error', {'room_id': room_id, 'message': error})
+        return
+
+    emit('search_results', {
+        'room_id': room_id,
+        'query': data.get('query', ''),
+        'terms': result['terms'],
+        'messages': result['messages'],
+        'offset': result['offset'],
+        'has_more': result['has_more']
     })
 
 @socketio.on('send_message')
+@rate_limited('send_message')
 def handle_message(data):
     user_id = data.get('user_id')
     room_id = data.get('room_id')
     content = data.get('content', '').strip()
     message_type = data.get('type', 'text')
 
-    if not user_id or user_id not in users:
+    user = state.get_user(user_id)
+    if user is None:
         emit('message_error', {'message': '用户不存在'})
         return
 
-    if not room_id or room_id not in rooms:
+    if not state.has_room(room_id):
         emit('message_error', {'message': '房间不存在'})
         return
 
+    if not state.is_member(room_id, user_id):
+        emit('message_error', {'message': '不是房间成员'})
+        return
+
     if not content:
         emit('message_error', {'message': '消息不能为空'})
         return
 
-    user = users[user_id]
+    # 语音消息只携带已上传音频的 ID，不再接受内联的 base64 音频
+    voice = None
+    if message_type == 'voice':
+        size = voice_store.size(content) if is_digest(content) else None
+        if size is None:
+            emit('message_error', {'message': '语音不存在，请重新录制'})
+            return
+        try:
+            duration = int(data.get('duration') or 0)
+        except (TypeError, ValueError):
+            duration = 0
+        voice = {
+            'id': content,
+            'duration': max(0, min(duration, app.config['VOICE_MAX_DURATION_MS'])),
+            'size': size
+        }
 
-    # region agent log
-    try:
-        log_entry = {
-            "sessionId": "da94d2",
-            "id": f"log_{int(time.time() * 1000)}",
-            "timestamp": int(time.time() * 1000),
-            "location": "app.py:handle_message",
-            "message": "incoming message",
-            "data": {
+    if event_log.enabled_for(INFO):
+        event_log.log(
+            "app.py:handle_message", "incoming message",
+            {
                 "user_id": user_id,
                 "room_id": room_id,
                 "type": message_type,
                 "content_length": len(content)
             },
-            "runId": "voice-message-debug",
-            "hypothesisId": "VM4"
-        }
-        with open("debug-da94d2.log", "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-    except Exception:
-        pass
-    # endregion
+            level=INFO, event='send_message'
+        )
     message = {
         'id': str(uuid.uuid4()),
+        'room_id': room_id,
         'user_id': user_id,
         'nickname': user['nickname'],
         'avatar': user['avatar'],
@@ -438,16 +1124,19 @@ def handle_message(data):
         'type': message_type,
         'timestamp': datetime.now().isoformat()
     }
+    if voice is not None:
+        message['voice'] = voice
 
-    rooms[room_id]['messages'].append(message)
-    if len(rooms[room_id]['messages']) > 100:
-        rooms[room_id]['messages'] = rooms[room_id]['messages'][-100:]
+    if not state.append_message(room_id, message):
+        emit('message_error', {'message': '房间不存在'})
+        return
 
     emit('new_message', message, room=room_id)
 
 # ==================== WebRTC 信令服务 ====================
 
 @socketio.on('webrtc_offer')
+@rate_limited('webrtc_offer')
 def handle_offer(data):
     """转发 WebRTC Offer"""
     room_id = data.get('room_id')
@@ -458,39 +1147,29 @@ def handle_offer(data):
     if room_id and target_user_id and offer:
         print(f'转发 Offer: {from_user_id} -> {target_user_id}')
 
-        # region agent log
-        try:
-            log_entry = {
-                "sessionId": "da94d2",
-                "id": f"log_{int(time.time() * 1000)}",
-                "timestamp": int(time.time() * 1000),
-                "location": "app.py:handle_offer",
-                "message": "webrtc_offer received",
-                "data": {
+        if event_log.enabled_for(DEBUG):
+            event_log.log(
+                "app.py:handle_offer", "webrtc_offer received",
+                {
                     "room_id": room_id,
                     "from_user_id": from_user_id,
                     "target_user_id": target_user_id,
                     "has_offer": offer is not None
                 },
-                "runId": "voice-pre-fix",
-                "hypothesisId": "V2"
-            }
-            with open("debug-da94d2.log", "a", encoding="utf-8") as f:
-                f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-        except Exception:
-            pass
-        # endregion
+                level=DEBUG, event='webrtc_offer'
+            )
 
         # 获取目标用户的 socket_id，仅转发给目标用户
-        if room_id in room_peers and target_user_id in room_peers[room_id]:
-            target_socket = room_peers[room_id][target_user_id]
+        target_socket = state.peer_sid(room_id, target_user_id)
+        if target_socket:
             emit('webrtc_offer', {
                 'from_user_id': from_user_id,
-                'from_nickname': users.get(from_user_id, {}).get('nickname', '未知'),
+                'from_nickname': state.nickname(from_user_id, '未知'),
                 'offer': offer
             }, to=target_socket)
 
 @socketio.on('webrtc_answer')
+@rate_limited('webrtc_answer')
 def handle_answer(data):
     """转发 WebRTC Answer"""
     room_id = data.get('room_id')
@@ -501,75 +1180,72 @@ def handle_answer(data):
     if room_id and target_user_id and answer:
         print(f'转发 Answer: {from_user_id} -> {target_user_id}')
 
-        # region agent log
-        try:
-            log_entry = {
-                "sessionId": "da94d2",
-                "id": f"log_{int(time.time() * 1000)}",
-                "timestamp": int(time.time() * 1000),
-                "location": "app.py:handle_answer",
-                "message": "webrtc_answer received",
-                "data": {
+        if event_log.enabled_for(DEBUG):
+            event_log.log(
+                "app.py:handle_answer", "webrtc_answer received",
+                {
                     "room_id": room_id,
                     "from_user_id": from_user_id,
                     "target_user_id": target_user_id,
                     "has_answer": answer is not None
                 },
-                "runId": "voice-pre-fix",
-                "hypothesisId": "V2"
-            }
-            with open("debug-da94d2.log", "a", encoding="utf-8") as f:
-                f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-        except Exception:
-            pass
-        # endregion
-
-        if room_id in room_peers and target_user_id in room_peers[room_id]:
-            target_socket = room_peers[room_id][target_user_id]
+                level=DEBUG, event='webrtc_answer'
+            )
+
+        target_socket = state.peer_sid(room_id, target_user_id)
+        if target_socket:
             emit('webrtc_answer', {
                 'from_user_id': from_user_id,
                 'answer': answer
             }, to=target_socket)
 
 @socketio.on('webrtc_ice_candidate')
+@rate_limited('webrtc_ice_candidate')
 def handle_ice_candidate(data):
-    """转发 ICE 候选"""
+    """转发 ICE 候选；candidate 为空且 end 为 true 表示发送方已收集完毕"""
+    relay_ice_candidates(data, [data.get('candidate')] if data.get('candidate') else [])
+
+@socketio.on('webrtc_ice_candidates')
+@rate_limited('webrtc_ice_candidates')
+def handle_ice_candidates(data):
+    """转发客户端自行攒好的一批 ICE 候选"""
+    candidates = data.get('candidates')
+    if not isinstance(candidates, list):
+        return
+    relay_ice_candidates(data, [candidate for candidate in candidates if candidate])
+
+def relay_ice_candidates(data, candidates):
     room_id = data.get('room_id')
     target_user_id = data.get('target_user_id')
-    candidate = data.get('candidate')
     from_user_id = data.get('from_user_id')
+    end = bool(data.get('end'))
 
-    if room_id and target_user_id and candidate:
-        # region agent log
-        try:
-            log_entry = {
-                "sessionId": "da94d2",
-                "id": f"log_{int(time.time() * 1000)}",
-                "timestamp": int(time.time() * 1000),
-                "location": "app.py:handle_ice_candidate",
-                "message": "webrtc_ice_candidate received",
-                "data": {
-                    "room_id": room_id,
-                    "from_user_id": from_user_id,
-                    "target_user_id": target_user_id
-                },
-                "runId": "voice-pre-fix",
-                "hypothesisId": "V2"
-            }
-            with open("debug-da94d2.log", "a", encoding="utf-8") as f:
-                f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-        except Exception:
-            pass
-        # endregion
-
-        if room_id in room_peers and target_user_id in room_peers[room_id]:
-            target_socket = room_peers[room_id][target_user_id]
-            emit('webrtc_ice_candidate', {
-                'from_user_id': from_user_id,
-                'candidate': candidate
-            }, to=target_socket)
+    if not (room_id and target_user_id and (candidates or end)):
+        return
+
+    if event_log.enabled_for(DEBUG):
+        event_log.log(
+            "app.py:handle_ice_candidate", "webrtc_ice_candidate received",
+            {
+                "room_id": room_id,
+                "from_user_id": from_user_id,
+                "target_user_id": target_user_id,
+                "count": len(candidates),
+                "end": end
+            },
+            level=DEBUG, event='webrtc_ice_candidate'
+        )
+
+    target_socket = state.peer_sid(room_id, target_user_id)
+    if not target_socket:
+        return
+    for candidate in candidates:
+        ice_relay.add(room_id, from_user_id, target_socket, candidate)
+    if end:
+        ice_relay.add(room_id, from_user_id, target_socket, end=True)
 
 @socketio.on('delete_room')
+@rate_limited('delete_room')
 def handle_delete_room(data):
     """删除群聊或双人聊天房间"""
     user_id = data.get('user_id')
@@ -581,11 +1257,11 @@ def handle_delete_room(data):
             'room_id': room_id,
             'room_name': '',
             'initiator_id': user_id,
-            'initiator_nickname': users.get(user_id, {}).get('nickname', '')
+            'initiator_nickname': state.nickname(user_id)
         }, to=request.sid)
         return
 
-    room = rooms.get(room_id)
+    room = state.get_room(room_id)
 
     # 房间在服务端已经不存在：仍然给当前用户一个 room_deleted，用于清理本地 UI
     if not room:
@@ -593,12 +1269,12 @@ def handle_delete_room(data):
             'room_id': room_id,
             'room_name': '',
             'initiator_id': user_id,
-            'initiator_nickname': users.get(user_id, {}).get('nickname', '')
+            'initiator_nickname': state.nickname(user_id)
         }, to=request.sid)
         return
 
     # 用户在服务端不存在：同样只做本地清理，不修改全局 rooms
-    if not user_id or user_id not in users:
+    if not state.has_user(user_id):
         emit('room_deleted', {
             'room_id': room_id,
             'room_name': room['name'],
@@ -608,154 +1284,195 @@ def handle_delete_room(data):
         return
 
     # 如果用户不在房间成员列表中，只删除自己本地的房间记录，不影响全局房间
-    if user_id not in room['members']:
+    if not state.is_member(room_id, user_id):
         emit('room_deleted', {
             'room_id': room_id,
             'room_name': room['name'],
             'initiator_id': user_id,
-            'initiator_nickname': users.get(user_id, {}).get('nickname', '')
+            'initiator_nickname': state.nickname(user_id)
         }, to=request.sid)
         return
 
-    # 从用户的房间列表中移除该房间
-    for uid, r_list in list(user_rooms.items()):
-        if room_id in r_list:
-            r_list.remove(room_id)
-            if not r_list:
-                del user_rooms[uid]
-
-    # 从 WebRTC 对等表中移除
-    if room_id in room_peers:
-        del room_peers[room_id]
-
-    # 从邀请码表中移除指向该房间的短码
-    codes_to_delete = [code for code, rid in invite_codes.items() if rid == room_id]
-    for code in codes_to_delete:
-        del invite_codes[code]
-
     # 向房间内所有用户广播房间被删除
     emit('room_deleted', {
         'room_id': room_id,
         'room_name': room['name'],
         'initiator_id': user_id,
-        'initiator_nickname': users.get(user_id, {}).get('nickname', '')
+        'initiator_nickname': state.nickname(user_id)
     }, room=room_id)
 
-    # 最后从 rooms 中删除
-    del rooms[room_id]
+    # 最后删除房间：同时清理成员的房间索引、WebRTC 对等表和指向该房间的邀请码
+    discard_room(room_id)
+    expiry.cancel('room', room_id)
+
+def discard_room(room_id):
+    """删除房间及其语音状态（用户删除或长时间无人在线）"""
+    state.delete_room(room_id)
+    active_speakers.clear_room(room_id)
+    voice_modes.pop(room_id, None)
+    if voice_relay is not None:
+        voice_relay.close_room(room_id)
+
+def voice_room(room_id):
+    """语音中的用户额外加入的 Socket.IO 房间，语音增量事件只发到这里"""
+    return f'voice:{room_id}'
+
+# 每个房间当前语音会话的模式，第一个人加入时确定，所有人离开后清除
+voice_modes = {}
+
+def voice_mode(room_id, in_progress):
+    """语音模式：群聊人数达到阈值且服务端可以转发时为 sfu，否则为 mesh；进行中的会话保持原模式"""
+    if voice_relay is None:
+        return 'mesh'
+    mode = voice_modes.get(room_id) if in_progress else None
+    if mode is None:
+        room = state.get_room(room_id)
+        if room is not None and room['type'] == 'group' and len(room['members']) >= app.config['VOICE_SFU_MIN_MEMBERS']:
+            mode = 'sfu'
+        else:
+            mode = 'mesh'
+        voice_modes[room_id] = mode
+    return mode
+
+def leave_voice(room_id, user_id):
+    """离开语音并通知仍在语音中的人；最后一个人离开时通知整个房间语音已结束"""
+    active_speakers.remove(room_id, user_id)
+    if voice_relay is not None:
+        voice_relay.leave(room_id, user_id)
+
+    remaining = state.leave_voice(room_id, user_id)
+    if remaining is None:
+        return
+    emit('user_left_voice', {
+        'user_id': user_id,
+        'nickname': state.nickname(user_id, '未知')
+    }, room=voice_room(room_id))
+    if remaining == 0:
+        voice_modes.pop(room_id, None)
+        emit('voice_ended', {'room_id': room_id}, room=room_id)
 
 @socketio.on('join_voice_room')
+@rate_limited('join_voice_room')
 def handle_join_voice_room(data):
-    """加入语音房间 - 通知其他人开始 WebRTC 连接"""
+    """加入语音房间 - 快照只发给新加入者，其他语音用户只收到一条增量"""
     user_id = data.get('user_id')
     room_id = data.get('room_id')
 
-    if not room_id or room_id not in rooms:
+    if not state.has_room(room_id):
         emit('voice_error', {'message': '房间不存在'})
         return
 
-    # 更新房间对等列表
-    if room_id not in room_peers:
-        room_peers[room_id] = {}
-    room_peers[room_id][user_id] = request.sid
-    users[user_id]['socket_id'] = request.sid
+    if not state.has_user(user_id):
+        emit('voice_error', {'message': '用户不存在'})
+        return
 
-    # 获取房间内其他用户
-    other_users = [
-        {
-            'user_id': uid,
-            'nickname': users[uid]['nickname'],
-            'avatar': users[uid]['avatar']
-        }
-        for uid in rooms[room_id]['members']
-        if uid != user_id
-    ]
+    # 更新房间对等列表和语音在线集合
+    state.set_peer(room_id, user_id, request.sid)
+    state.bind_socket(user_id, request.sid)
+    voice_user_ids = state.join_voice(room_id, user_id)
+    if voice_user_ids is None:
+        emit('voice_error', {'message': '房间不存在'})
+        return
+    join_room(voice_room(room_id))
 
-    # region agent log
-    try:
-        log_entry = {
-            "sessionId": "da94d2",
-            "id": f"log_{int(time.time() * 1000)}",
-            "timestamp": int(time.time() * 1000),
-            "location": "app.py:handle_join_voice_room",
-            "message": "join_voice_room",
-            "data": {
+    # 已在语音中的用户（而不是全部聊天成员）
+    other_users = [info for info in (member_info(uid) for uid in voice_user_ids) if info]
+
+    if event_log.enabled_for(INFO):
+        event_log.log(
+            "app.py:handle_join_voice_room", "join_voice_room",
+            {
                 "room_id": room_id,
                 "user_id": user_id,
-                "other_user_ids": [u["user_id"] for u in other_users],
-                "room_member_count": len(rooms[room_id]['members'])
+                "other_user_ids": voice_user_ids,
+                "room_member_count": state.member_count(room_id)
             },
-            "runId": "voice-pre-fix",
-            "hypothesisId": "V1"
-        }
-        with open("debug-da94d2.log", "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-    except Exception:
-        pass
-    # endregion
-
-    # 通知房间内其他人有新用户加入语音
-    emit('user_joined_voice', {
-        'user_id': user_id,
-        'nickname': users[user_id]['nickname'],
-        'avatar': users[user_id]['avatar'],
-        'existing_users': other_users
-    }, room=room_id)
+            level=INFO, event='join_voice_room'
+        )
+
+    mode = voice_mode(room_id, bool(voice_user_ids))
+    joined = dict(member_info(user_id), room_id=room_id, mode=mode)
+
+    # 增量只发给语音中的其他人；语音刚开始时通知整个房间一次，未加入语音的成员可以点击加入
+    emit('user_joined_voice', joined, room=voice_room(room_id), include_self=False)
+    if not voice_user_ids:
+        emit('voice_started', joined, room=room_id, include_self=False)
 
-    # 返回房间内现有用户列表给新加入者
+    # 返回语音中现有用户列表给新加入者；sfu 模式下客户端随后发送 sfu_publish
     emit('voice_room_users', {
-        'users': other_users
+        'users': other_users,
+        'mode': mode
     })
 
+@socketio.on('sfu_publish')
+@rate_limited('sfu_publish')
+def handle_sfu_publish(data):
+    """转发模式：客户端把自己的音频发布到服务端"""
+    room_id = data.get('room_id')
+    user_id = data.get('user_id')
+    offer = data.get('offer')
+
+    if voice_relay is None:
+        emit('voice_error', {'message': '服务器未启用语音转发'})
+        return
+    if not (offer and state.peer_sid(room_id, user_id) == request.sid):
+        return
+
+    voice_relay.publish(room_id, user_id, request.sid, offer)
+
+@socketio.on('sfu_answer')
+def handle_sfu_answer(data):
+    """转发模式：客户端对服务端重新协商 Offer 的应答"""
+    answer = data.get('answer')
+    if voice_relay is not None and answer:
+        voice_relay.answer(data.get('room_id'), data.get('user_id'), answer)
+
+@socketio.on('voice_levels')
+@rate_limited('voice_levels')
+def handle_voice_levels(data):
+    """客户端上报本地麦克风音量（0~1），高频事件，不写事件日志"""
+    room_id = data.get('room_id')
+    user_id = data.get('user_id')
+    level = data.get('level')
+
+    if not isinstance(level, (int, float)) or state.peer_sid(room_id, user_id) != request.sid:
+        return
+    active_speakers.report(room_id, user_id, min(max(float(level), 0.0), 1.0))
+
 @socketio.on('leave_voice_room')
 def handle_leave_voice_room(data):
     """离开语音房间"""
     user_id = data.get('user_id')
     room_id = data.get('room_id')
 
-    if room_id and room_id in room_peers:
-        if user_id in room_peers[room_id]:
-            del room_peers[room_id][user_id]
+    if state.has_room(room_id):
+        leave_room(voice_room(room_id))
+        leave_voice(room_id, user_id)
+        state.remove_peer(room_id, user_id)
 
-        # region agent log
-        try:
-            log_entry = {
-                "sessionId": "da94d2",
-                "id": f"log_{int(time.time() * 1000)}",
-                "timestamp": int(time.time() * 1000),
-                "location": "app.py:handle_leave_voice_room",
-                "message": "leave_voice_room",
-                "data": {
+        if event_log.enabled_for(INFO):
+            event_log.log(
+                "app.py:handle_leave_voice_room", "leave_voice_room",
+                {
                     "room_id": room_id,
                     "user_id": user_id,
-                    "remaining_peers": list(room_peers.get(room_id, {}).keys())
+                    "remaining_voice": state.voice_count(room_id)
                 },
-                "runId": "voice-pre-fix",
-                "hypothesisId": "V1"
-            }
-            with open("debug-da94d2.log", "a", encoding="utf-8") as f:
-                f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-        except Exception:
-            pass
-        # endregion
-
-        emit('user_left_voice', {
-            'user_id': user_id,
-            'nickname': users.get(user_id, {}).get('nickname', '未知')
-        }, room=room_id)
+                level=INFO, event='leave_voice_room'
+            )
 
 @socketio.on('get_rooms')
 def handle_get_rooms(data):
     user_id = data.get('user_id')
 
-    if not user_id or user_id not in users:
+    if not state.has_user(user_id):
         emit('rooms_list', {'rooms': []})
         return
 
     room_list = []
-    for room_id in user_rooms.get(user_id, []):
-        if room_id in rooms:
-            room = rooms[room_id]
+    for room_id in state.rooms_of(user_id):
+        room = state.get_room(room_id)
+        if room is not None:
             room_list.append({
                 'room_id': room_id,
                 'name': room['name'],
@@ -766,27 +1483,28 @@ def handle_get_rooms(data):
     emit('rooms_list', {'rooms': room_list})
 
 @socketio.on('invite_to_room')
+@rate_limited('invite_to_room')
 def handle_invite_to_room(data):
     """邀请用户加入已有群聊"""
     inviter_user_id = data.get('user_id')
     room_id = data.get('room_id')
     new_invite_code = data.get('invite_code')
 
-    if not inviter_user_id or inviter_user_id not in users:
+    if not state.has_user(inviter_user_id):
         emit('invite_to_room_error', {'message': '用户不存在'})
         return
 
-    if not room_id or room_id not in rooms:
+    room = state.get_room(room_id)
+    if room is None:
         emit('invite_to_room_error', {'message': '房间不存在'})
         return
 
-    room = rooms[room_id]
     if room['type'] != 'group':
         emit('invite_to_room_error', {'message': '只有群聊才能邀请他人'})
         return
 
     # 验证邀请码
-    if new_invite_code not in invite_codes or invite_codes[new_invite_code] != room_id:
+    if state.resolve_invite_code(new_invite_code) != room_id:
         emit('invite_to_room_error', {'message': '无效的邀请码'})
         return
 
@@ -795,7 +1513,7 @@ def handle_invite_to_room(data):
         'room_id': room_id,
         'room_name': room['name'],
         'invite_code': new_invite_code,
-        'inviter_nickname': users[inviter_user_id]['nickname']
+        'inviter_nickname': state.nickname(inviter_user_id)
     })
 
 @socketio.on('get_room_members')
@@ -804,19 +1522,11 @@ def handle_get_room_members(data):
     user_id = data.get('user_id')
     room_id = data.get('room_id')
 
-    if not room_id or room_id not in rooms:
+    if not state.has_room(room_id):
         emit('room_members_list', {'members': []})
         return
 
-    room = rooms[room_id]
-    members_info = []
-    for uid in room['members']:
-        if uid in users:
-            members_info.append({
-                'user_id': uid,
-                'nickname': users[uid]['nickname'],
-                'avatar': users[uid]['avatar']
-            })
+    members_info = room_members_info(room_id)
 
     emit('room_members_list', {
         'room_id': room_id,
@@ -824,6 +1534,31 @@ def handle_get_room_members(data):
         'member_count': len(members_info)
     })
 
+# 所有 socket 事件处理函数和 HTTP 路由统一埋点（必须在全部处理函数注册之后）
+if metrics is not None:
+    metrics.instrument_socketio(socketio.server)
+    metrics.instrument_flask(app)
+    metrics.gauge('mc_connected_sockets', '已连接的 socket 数（含长轮询）', lambda: len(socketio.server.eio.sockets))
+    for gauge_name, key, help_text in (
+        ('mc_users', 'users', '内存中的用户数'),
+        ('mc_users_online', 'online', '绑定了 socket 的用户数'),
+        ('mc_rooms', 'rooms', '房间数'),
+        ('mc_messages_in_memory', 'messages', '内存中保留的历史消息条数'),
+        ('mc_voice_peers', 'voice_peers', '正在语音中的用户数')
+    ):
+        metrics.gauge(gauge_name, help_text, lambda key=key: state.stats()[key])
+    metrics.gauge('mc_skin_jobs_pending', '排队和处理中的皮肤任务数', lambda: skin_jobs.pending)
+
 if __name__ == '__main__':
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    socketio.run(app, debug=True, host='0.0.0.0', port=2250)
+    os.makedirs(app.config['AVATAR_FOLDER'], exist_ok=True)
+    if app.config['ASYNC_MODE'] == 'eventlet' and not app.config['DEBUG_SERVER']:
+        # socketio.run 的 eventlet 监听队列只有 50、并发上限 1024，重连风暴时会被重置，这里自行监听
+        import eventlet
+        import eventlet.wsgi
+        listener = eventlet.listen(('0.0.0.0', app.config['PORT']), backlog=app.config['LISTEN_BACKLOG'])
+        eventlet.wsgi.server(listener, app, max_size=app.config['MAX_CONNECTIONS'], log_output=False)
+    else:
+        # 多工作进程通常由进程管理器启动（没有终端），需要显式允许 Werkzeug 服务器
+        socketio.run(app, debug=app.config['DEBUG_SERVER'], host='0.0.0.0', port=app.config['PORT'],
+                     allow_unsafe_werkzeug=True)
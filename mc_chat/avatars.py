@@ -0,0 +1,79 @@
+"""
+头像存储 - 按皮肤内容哈希寻址
+消息和成员列表只携带 /avatar/<hash>.png 这样的短引用，图片本身由浏览器缓存；
+同一皮肤的头像只计算一次：内存 LRU + 磁盘两级缓存
+"""
+import threading
+from collections import OrderedDict
+
+from offload import run_blocking
+from storage import ContentStore, is_digest
+
+AVATAR_URL_PREFIX = '/avatar/'
+
+
+def is_avatar_hash(value):
+    return is_digest(value)
+
+
+def avatar_url(avatar_hash):
+    return f'{AVATAR_URL_PREFIX}{avatar_hash}.png' if avatar_hash else None
+
+
+class AvatarStore:
+    """
+    头像缓存，key 为皮肤内容的 SHA-256
+
+    - 内存中按 LRU 保留最近使用的 capacity 个头像
+    - 磁盘上以 <root>/<hash>.png 持久保存，重启后无需重新解码皮肤
+    """
+
+    def __init__(self, root, capacity=512):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._disk = ContentStore(root, '.png')
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, avatar_hash, png_bytes):
+        with self._lock:
+            self._cache[avatar_hash] = png_bytes
+            self._cache.move_to_end(avatar_hash)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def get(self, avatar_hash):
+        """读取头像 PNG；内存未命中时回落到磁盘"""
+        if not is_avatar_hash(avatar_hash):
+            return None
+        with self._lock:
+            png_bytes = self._cache.get(avatar_hash)
+            if png_bytes is not None:
+                self._cache.move_to_end(avatar_hash)
+                self.hits += 1
+                return png_bytes
+
+        if not self._disk.exists(avatar_hash):
+            self.misses += 1
+            return None
+        try:
+            png_bytes = run_blocking(self._disk.read, avatar_hash)
+        except OSError:
+            return None
+        self._remember(avatar_hash, png_bytes)
+        return png_bytes
+
+    def has(self, avatar_hash):
+        with self._lock:
+            if avatar_hash in self._cache:
+                return True
+        return self._disk.exists(avatar_hash)
+
+    def put(self, avatar_hash, png_bytes):
+        self._disk.put(png_bytes, digest=avatar_hash)
+        self._remember(avatar_hash, png_bytes)
+        return avatar_hash
+
+    def __len__(self):
+        return len(self._cache)
@@ -0,0 +1,690 @@
+"""
+压测 - 在本机启动 app.py，用大量模拟的 python-socketio 客户端按脚本施加负载
+
+场景：每 room_size 个客户端组成一个群聊（HTTP 登录、register_user、create_invite / join_invite），
+负载阶段所有客户端合计按 --rate（每个客户端每秒条数）发送消息，并可每隔 --voice-interval 秒
+在一个房间里发起一次语音信令突发（join_voice_room、offer/answer、逐条 ICE 候选，随后离开语音）。
+客户端分散在 --procs 个进程中，每个房间的成员在同一个进程里。
+
+结果：消息吞吐、端到端扇出延迟（发送到每个其他成员收到）p50/p95/p99、信令转发延迟、
+服务端 CPU 和 RSS（读取 /proc，仅限 Linux），写成 JSON 以便在不同提交之间比较；
+--compare 指定基线结果时逐项对比，超出容差的退化返回退出码 1。
+
+客户端需要 pip install "python-socketio[client]"（websocket-client）。
+运行：python bench.py --clients 1000 --room-size 10 --rate 0.2 --duration 30 --output bench.json
+      python bench.py --clients 1000 --room-size 10 --rate 0.2 --duration 30 --compare bench.json
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+import socketio
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 启动 app.py 时的默认环境：关闭调试、事件日志和限流，语音固定为 mesh（信令全部经服务端转发）
+SERVER_ENV = {
+    'MC_DEBUG': '0',
+    'MC_EVENT_LOG_LEVEL': 'off',
+    'MC_RATE_LIMITS': 'off',
+    'MC_VOICE_SFU_MIN_MEMBERS': '0'
+}
+
+# 记为错误的服务端事件
+ERROR_EVENTS = ('rate_limited', 'message_error', 'invite_error', 'join_error', 'voice_error', 'register_error')
+
+# --compare 对比的指标：路径、哪个方向更好
+COMPARED = (
+    ('messages_per_second', 'higher'),
+    ('deliveries_per_second', 'higher'),
+    ('delivery_ratio', 'higher'),
+    ('fanout_latency_ms.p50', 'lower'),
+    ('fanout_latency_ms.p95', 'lower'),
+    ('fanout_latency_ms.p99', 'lower'),
+    ('signaling_latency_ms.p50', 'lower'),
+    ('signaling_latency_ms.p99', 'lower'),
+    ('server.cpu_percent', 'lower'),
+    ('server.rss_peak_mb', 'lower')
+)
+
+
+def stamp():
+    """嵌入负载中的发送时间；所有进程在同一台机器上，直接用墙上时间"""
+    return f'{time.time():.6f}'
+
+
+def stamp_of(text):
+    """从 'bench ... <发送时间>' 中取出发送时间，不是压测负载时返回 None"""
+    if not isinstance(text, str) or not text.startswith('bench '):
+        return None
+    try:
+        return float(text.rsplit(' ', 1)[1])
+    except ValueError:
+        return None
+
+
+def summarize(samples):
+    """延迟样本（秒）-> 毫秒的 count / mean / p50 / p95 / p99 / max"""
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    count = len(samples)
+
+    def pick(q):
+        return round(samples[min(count - 1, int(q * count))] * 1000, 3)
+
+    return {
+        'count': count,
+        'mean': round(sum(samples) / count * 1000, 3),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': round(samples[-1] * 1000, 3)
+    }
+
+
+def http_json(url, form=None, timeout=10):
+    data = urllib.parse.urlencode(form).encode() if form is not None else None
+    with urllib.request.urlopen(url, data=data, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+# ==================== 服务端 ====================
+
+class ServerSampler:
+    """后台定期读取 /proc/<pid> 的 RSS，按需读取累计 CPU 时间（非 Linux 时都为 None）"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.rss_peak = None
+        self.rss_last = None
+        self._stop = threading.Event()
+        self._ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self._thread = threading.Thread(target=self._run, name='sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def cpu_seconds(self):
+        try:
+            with open(f'/proc/{self.pid}/stat') as f:
+                # 第 2 个字段（进程名）可能带空格，从最后一个 ')' 之后开始数：utime、stime 是第 14、15 个字段
+                fields = f.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self._ticks
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def rss_mb(self):
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) / 1024
+        except (OSError, IndexError, ValueError):
+            pass
+        return None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = self.rss_mb()
+            if rss is not None:
+                self.rss_last = rss
+                self.rss_peak = max(self.rss_peak or 0, rss)
+
+
+def start_server(port, async_mode, db_path, extra_env, log_path):
+    env = dict(os.environ, **SERVER_ENV)
+    env.update(MC_PORT=str(port), MC_ASYNC_MODE=async_mode, MC_CHAT_DB=db_path)
+    env.update(extra_env)
+    log = open(log_path, 'w') if log_path else subprocess.DEVNULL
+    return subprocess.Popen(
+        [sys.executable, 'app.py'], cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+
+def wait_ready(url, server, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f'app.py 启动失败，退出码 {server.returncode}')
+        try:
+            return http_json(url + '/stats', timeout=2)
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'等待 {url} 就绪超时')
+
+
+def raise_fd_limit():
+    """每个连接在压测进程和服务端各占一个文件描述符，把软上限提到硬上限（子进程继承）"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = 65536 if hard == resource.RLIM_INFINITY else hard
+    if soft != resource.RLIM_INFINITY and soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
+
+
+# ==================== 模拟客户端 ====================
+
+class Recorder:
+    """一个压测进程内的计数和延迟样本"""
+
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.voice_bursts = 0
+        self.fanout = []
+        self.signaling = []
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def delivery(self, sent_at):
+        latency = time.time() - sent_at
+        with self._lock:
+            self.delivered += 1
+            self.fanout.append(latency)
+
+    def signal(self, sent_at):
+        latency = time.time() - sent_at
+        with self._lock:
+            self.signaling.append(latency)
+
+    def burst_done(self):
+        with self._lock:
+            self.voice_bursts += 1
+
+    def error(self, event, *args):
+        with self._lock:
+            self.errors[event] = self.errors.get(event, 0) + 1
+
+
+class BenchClient:
+    """一个模拟用户：HTTP 登录后连接 socket，按脚本收发事件，延迟记到 recorder"""
+
+    def __init__(self, url, nickname, recorder, ice_per_peer):
+        self.url = url
+        self.recorder = recorder
+        self.ice_per_peer = ice_per_peer
+        self.user_id = http_json(url + '/login', {'nickname': nickname})['user_id']
+        self.room_id = None
+        self.invite_code = None
+
+        self.registered = threading.Event()
+        self.invited = threading.Event()
+        self.joined = threading.Event()
+
+        sio = self.sio = socketio.Client(reconnection=False)
+        sio.on('session', lambda data: self.registered.set())
+        sio.on('invite_created', self._on_invite_created)
+        sio.on('join_success', lambda data: self.joined.set())
+        sio.on('new_message', self._on_message)
+        sio.on('voice_room_users', self._on_voice_users)
+        sio.on('webrtc_offer', self._on_offer)
+        sio.on('webrtc_answer', self._on_answer)
+        sio.on('webrtc_ice_candidates', self._on_candidates)
+        for event in ERROR_EVENTS:
+            sio.on(event, lambda data=None, event=event: recorder.error(event))
+
+    def connect(self, timeout):
+        self.sio.connect(self.url, transports=['websocket'], wait_timeout=timeout)
+        self.sio.emit('register_user', {'user_id': self.user_id})
+        return self.registered.wait(timeout)
+
+    def disconnect(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+    def send_message(self, padding):
+        self.sio.emit('send_message', {
+            'user_id': self.user_id,
+            'room_id': self.room_id,
+            'content': f'bench {padding}{stamp()}'
+        })
+
+    def join_voice(self):
+        self.sio.emit('join_voice_room', {'user_id': self.user_id, 'room_id': self.room_id})
+
+    def leave_voice(self):
+        self.sio.emit('leave_voice_room', {'user_id': self.user_id, 'room_id': self.room_id})
+
+    def _signal(self, event, kind, target_user_id):
+        """发出 offer / answer，随后逐条发送 trickle ICE 候选"""
+        route = {'room_id': self.room_id, 'target_user_id': target_user_id, 'from_user_id': self.user_id}
+        self.sio.emit(event, dict(route, **{kind: {'type': kind, 'sdp': f'bench {stamp()}'}}))
+        for index in range(self.ice_per_peer):
+            self.sio.emit('webrtc_ice_candidate', dict(route, candidate={
+                'candidate': f'bench {index} {stamp()}', 'sdpMid': '0', 'sdpMLineIndex': 0
+            }))
+
+    def _on_invite_created(self, data):
+        self.room_id = data.get('room_id')
+        self.invite_code = data.get('code')
+        self.invited.set()
+
+    def _on_message(self, data):
+        if data.get('user_id') == self.user_id:
+            return
+        sent_at = stamp_of(data.get('content'))
+        if sent_at is not None:
+            self.recorder.delivery(sent_at)
+
+    def _on_voice_users(self, data):
+        # mesh：新加入者向每个已在语音中的用户发起 offer
+        for user in data.get('users') or []:
+            self._signal('webrtc_offer', 'offer', user['user_id'])
+
+    def _on_offer(self, data):
+        sent_at = stamp_of((data.get('offer') or {}).get('sdp'))
+        if sent_at is not None:
+            self.recorder.signal(sent_at)
+        self._signal('webrtc_answer', 'answer', data.get('from_user_id'))
+
+    def _on_answer(self, data):
+        sent_at = stamp_of((data.get('answer') or {}).get('sdp'))
+        if sent_at is not None:
+            self.recorder.signal(sent_at)
+
+    def _on_candidates(self, data):
+        for candidate in data.get('candidates') or []:
+            if isinstance(candidate, dict):
+                sent_at = stamp_of(candidate.get('candidate'))
+                if sent_at is not None:
+                    self.recorder.signal(sent_at)
+
+
+def setup_room(url, indices, options, recorder):
+    """登录并连接一个房间的全部客户端，第一个人创建群聊、其余人用邀请码加入；返回成功进入房间的客户端"""
+    timeout = options['timeout']
+    members = []
+    for index in indices:
+        try:
+            client = BenchClient(url, f'bench{index}', recorder, options['ice'])
+            if client.connect(timeout):
+                members.append(client)
+            else:
+                recorder.error('register_timeout')
+                client.disconnect()
+        except Exception:
+            recorder.error('connect_failed')
+    if not members:
+        return []
+
+    owner = members[0]
+    owner.sio.emit('create_invite', {'user_id': owner.user_id, 'type': 'group', 'room_name': f'bench{indices[0]}'})
+    if not owner.invited.wait(timeout):
+        recorder.error('invite_timeout')
+        for client in members:
+            client.disconnect()
+        return []
+
+    for client in members[1:]:
+        client.room_id = owner.room_id
+        client.sio.emit('join_invite', {'user_id': client.user_id, 'code': owner.invite_code})
+    joined = [owner]
+    for client in members[1:]:
+        if client.joined.wait(timeout):
+            joined.append(client)
+        else:
+            recorder.error('join_timeout')
+            client.disconnect()
+    return joined
+
+
+def voice_burst(members, options, recorder):
+    """前 voice_users 个成员依次加入语音（每个新加入者向已在语音中的人发 offer），保持片刻后全部离开"""
+    speakers = members[:options['voice_users']]
+    for client in speakers:
+        client.join_voice()
+        time.sleep(0.05)
+    time.sleep(options['voice_hold'])
+    for client in speakers:
+        client.leave_voice()
+    recorder.burst_done()
+
+
+def drive(rooms, options, recorder):
+    """负载阶段：轮流让每个客户端发消息，使本进程的总速率为 rate * 客户端数"""
+    clients = [client for members in rooms for client in members]
+    if not clients:
+        time.sleep(options['duration'])
+        return
+    padding = 'x' * max(0, options['message_size'] - 24) + ' '
+    total_rate = options['rate'] * len(clients)
+    interval = 1 / total_rate if total_rate > 0 else None
+    voice_rooms = itertools.cycle(rooms)
+    bursts = []
+
+    now = time.monotonic()
+    end = now + options['duration']
+    next_send = now if interval else end
+    next_voice = now + options['voice_interval'] if options['voice_interval'] > 0 else end
+    for client in itertools.cycle(clients):
+        now = time.monotonic()
+        if now >= end:
+            break
+        if now >= next_voice:
+            burst = threading.Thread(target=voice_burst, args=(next(voice_rooms), options, recorder), daemon=True)
+            burst.start()
+            bursts.append(burst)
+            next_voice += options['voice_interval']
+        if now < next_send:
+            time.sleep(min(next_send, next_voice, end) - now)
+            continue
+        try:
+            client.send_message(padding)
+            recorder.sent += 1
+        except Exception:
+            recorder.error('send_failed')
+        next_send += interval
+    for burst in bursts:
+        burst.join()
+
+
+def disconnect_all(clients, timeout=10):
+    """并行断开（每个客户端断开时要等待 websocket 关闭握手，逐个断开很慢）"""
+    threads = [threading.Thread(target=client.disconnect, daemon=True) for client in clients]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+
+
+def run_worker(url, room_groups, options, barrier, results):
+    """一个压测进程：负责若干个房间的全部客户端"""
+    recorder = Recorder()
+    rooms = []
+    try:
+        started = time.monotonic()
+        for indices in room_groups:
+            members = setup_room(url, indices, options, recorder)
+            if members:
+                rooms.append(members)
+        setup_seconds = time.monotonic() - started
+
+        # 1) 全部进程准备好  2) 父进程开始采样后一起开始  3) 负载阶段结束
+        barrier.wait()
+        barrier.wait()
+        drive(rooms, options, recorder)
+        barrier.wait()
+        time.sleep(options['drain'])
+    except Exception as e:
+        barrier.abort()
+        print(f'压测进程出错：{e}')
+        raise
+    finally:
+        disconnect_all([client for members in rooms for client in members])
+
+    results.put({
+        'clients': sum(len(members) for members in rooms),
+        'rooms': [len(members) for members in rooms],
+        'setup_seconds': setup_seconds,
+        'sent': recorder.sent,
+        'delivered': recorder.delivered,
+        'voice_bursts': recorder.voice_bursts,
+        'fanout': recorder.fanout,
+        'signaling': recorder.signaling,
+        'errors': recorder.errors
+    })
+
+
+# ==================== 汇总与对比 ====================
+
+def run_benchmark(args, url, sampler):
+    indices = list(range(args.clients))
+    groups = [indices[i:i + args.room_size] for i in range(0, len(indices), args.room_size)]
+    procs = max(1, min(args.procs, len(groups)))
+    options = {
+        'rate': args.rate,
+        'duration': args.duration,
+        'drain': args.drain,
+        'timeout': args.timeout,
+        'message_size': args.message_size,
+        'voice_interval': args.voice_interval,
+        'voice_users': args.voice_users,
+        'voice_hold': args.voice_hold,
+        'ice': args.ice
+    }
+
+    ctx = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+    barrier = ctx.Barrier(procs + 1)
+    results = ctx.Queue()
+    workers = [
+        ctx.Process(target=run_worker, args=(url, groups[i::procs], options, barrier, results), daemon=True)
+        for i in range(procs)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        barrier.wait(timeout=args.setup_timeout)
+        print('客户端已就绪，开始施加负载')
+        cpu_start = sampler.cpu_seconds() if sampler else None
+        started = time.monotonic()
+        barrier.wait(timeout=args.timeout)
+        barrier.wait(timeout=args.duration + args.setup_timeout)
+        elapsed = time.monotonic() - started
+        cpu_end = sampler.cpu_seconds() if sampler else None
+        parts = [results.get(timeout=args.drain + args.setup_timeout) for _ in workers]
+    except threading.BrokenBarrierError:
+        raise RuntimeError('压测进程出错或准备超时')
+    finally:
+        for worker in workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+    sent = sum(part['sent'] for part in parts)
+    delivered = sum(part['delivered'] for part in parts)
+    # 每条消息应送达房间内的每个其他成员
+    room_sizes = [size for part in parts for size in part['rooms']]
+    clients = sum(room_sizes)
+    expected = sent * (sum(size * (size - 1) for size in room_sizes) / clients) if clients else 0
+    errors = {}
+    for part in parts:
+        for event, count in part['errors'].items():
+            errors[event] = errors.get(event, 0) + count
+
+    server = None
+    if sampler is not None:
+        cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+        server = {
+            'cpu_seconds': round(cpu, 3) if cpu is not None else None,
+            'cpu_percent': round(cpu / elapsed * 100, 1) if cpu is not None else None,
+            'rss_peak_mb': round(sampler.rss_peak, 1) if sampler.rss_peak else None,
+            'rss_end_mb': round(sampler.rss_last, 1) if sampler.rss_last else None
+        }
+
+    return {
+        'clients': clients,
+        'rooms': len(room_sizes),
+        'setup_seconds': round(max(part['setup_seconds'] for part in parts), 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'messages_sent': sent,
+        'messages_per_second': round(sent / elapsed, 2),
+        'deliveries': delivered,
+        'deliveries_per_second': round(delivered / elapsed, 2),
+        'delivery_ratio': round(delivered / expected, 4) if expected else None,
+        'fanout_latency_ms': summarize([x for part in parts for x in part['fanout']]),
+        'voice_bursts': sum(part['voice_bursts'] for part in parts),
+        'signaling_latency_ms': summarize([x for part in parts for x in part['signaling']]),
+        'errors': errors,
+        'server': server
+    }
+
+
+def git_revision():
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=cwd,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=cwd,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def lookup(results, path):
+    value = results
+    for key in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare(baseline, current, tolerance):
+    """逐项对比两次结果，打印变化并返回超出容差的退化指标"""
+    if baseline.get('config') != current.get('config'):
+        print('注意：两次压测的参数不同，对比结果仅供参考')
+    print(f"对比基线 {baseline.get('commit')}（{baseline.get('started_at')}）")
+    regressions = []
+    for path, better in COMPARED:
+        old = lookup(baseline.get('results', {}), path)
+        new = lookup(current['results'], path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = change < -tolerance if better == 'higher' else change > tolerance
+        if worse:
+            regressions.append(path)
+        print(f"  {path:28} {old:>12.3f} -> {new:>12.3f}  {change:+7.1%}{'  退化' if worse else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='mc_chat Socket.IO 压测')
+    parser.add_argument('--url', help='压测已经运行的服务（不启动 app.py，不采集服务端 CPU / RSS）')
+    parser.add_argument('--port', type=int, default=2290, help='启动 app.py 使用的端口')
+    parser.add_argument('--async-mode', default='threading', help='app.py 的服务模式：threading / eventlet / gevent')
+    parser.add_argument('--db', default='temp', help='temp 为临时数据库文件，memory 为只用内存，其他值为数据库路径')
+    parser.add_argument('--server-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='传给 app.py 的额外环境变量，可重复')
+    parser.add_argument('--server-log', help='app.py 的输出写入该文件（默认丢弃）')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--room-size', type=int, default=10)
+    parser.add_argument('--procs', type=int, default=os.cpu_count() or 1, help='压测客户端进程数')
+    parser.add_argument('--rate', type=float, default=0.2, help='每个客户端每秒发送的消息数')
+    parser.add_argument('--message-size', type=int, default=64, help='消息内容的大致字节数')
+    parser.add_argument('--duration', type=float, default=20, help='负载阶段秒数')
+    parser.add_argument('--drain', type=float, default=2, help='负载结束后等待在途消息送达的秒数')
+    parser.add_argument('--voice-interval', type=float, default=2, help='每隔多少秒发起一次语音信令突发，0 为不发起')
+    parser.add_argument('--voice-users', type=int, default=4, help='每次突发加入语音的人数')
+    parser.add_argument('--voice-hold', type=float, default=1, help='突发中保持语音的秒数')
+    parser.add_argument('--ice', type=int, default=8, help='每个 offer / answer 之后发送的 ICE 候选数')
+    parser.add_argument('--timeout', type=float, default=30, help='连接、加入房间等单步操作的超时秒数')
+    parser.add_argument('--setup-timeout', type=float, default=600, help='全部客户端准备就绪的超时秒数')
+    parser.add_argument('--output', help='结果 JSON 写入该文件（默认打印）')
+    parser.add_argument('--compare', help='基线结果 JSON，逐项对比')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='对比时允许的相对退化（0.2 即 20%%）')
+    args = parser.parse_args()
+
+    if websocket is None:
+        sys.exit('压测客户端需要 websocket-client：pip install "python-socketio[client]"')
+    raise_fd_limit()
+
+    commit, dirty = git_revision()
+    extra_env = dict(item.split('=', 1) for item in args.server_env if '=' in item)
+    started_at = datetime.now().isoformat()
+    server = None
+    sampler = None
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.url
+        if not url:
+            db_path = {'temp': os.path.join(tmp, 'bench.db'), 'memory': ''}.get(args.db, args.db)
+            server = start_server(args.port, args.async_mode, db_path, extra_env, args.server_log)
+            url = f'http://127.0.0.1:{args.port}'
+        try:
+            wait_ready(url, server, args.timeout)
+            if server is not None:
+                sampler = ServerSampler(server.pid)
+                sampler.start()
+            results = run_benchmark(args, url, sampler)
+            try:
+                server_stats = http_json(url + '/stats')
+            except OSError:
+                server_stats = None
+        finally:
+            if sampler is not None:
+                sampler.stop()
+            if server is not None:
+                server.terminate()
+                try:
+                    server.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+
+    report = {
+        'version': 1,
+        'commit': commit,
+        'dirty': dirty,
+        'started_at': started_at,
+        'config': {
+            'clients': args.clients,
+            'room_size': args.room_size,
+            'procs': args.procs,
+            'rate': args.rate,
+            'message_size': args.message_size,
+            'duration': args.duration,
+            'voice_interval': args.voice_interval,
+            'voice_users': args.voice_users,
+            'ice': args.ice,
+            'async_mode': None if args.url else args.async_mode,
+            'server_env': extra_env
+        },
+        'results': results,
+        'server_stats': server_stats
+    }
+
+    # 先读基线，--output 与 --compare 可以是同一个文件
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'结果已写入 {args.output}')
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    summary = results['fanout_latency_ms']
+    print(f"{results['clients']} 个客户端 / {results['rooms']} 个房间："
+          f"{results['messages_per_second']} 条/秒，送达 {results['deliveries_per_second']} 次/秒，"
+          f"扇出延迟 p50 {summary.get('p50')} p95 {summary.get('p95')} p99 {summary.get('p99')} ms")
+
+    if baseline is not None and compare(baseline, report, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+本地消息代理 - 多个 app.py 工作进程之间的发布/订阅和计数器
+
+没有 Redis 时的替代品（开发、测试或单机多进程部署），单进程、基于 TCP 的极简协议。
+帧内容使用 pickle，只能监听在本机或可信内网。
+
+帧格式：4 字节大端长度 + pickle((op, ...))
+    ('sub', channel)             订阅频道，之后会收到 ('msg', channel, payload)
+    ('pub', channel, payload)    把 payload（bytes）转发给该频道的所有订阅连接
+    ('incr', key, floor)         计数器加一且不小于 floor + 1，回复 ('val', n)
+    ('take', specs)              多个令牌桶原子取令牌（见 ratelimit.TokenBuckets），回复 ('val', 等待秒数)
+
+运行：python broker.py --host 127.0.0.1 --port 2260
+"""
+import argparse
+import pickle
+import socket
+import socketserver
+import struct
+import threading
+
+from ratelimit import TokenBuckets
+
+_HEADER = struct.Struct('>I')
+
+
+def send_frame(sock, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frame(sock):
+    """读取一帧，连接关闭时返回 None"""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exact(sock, _HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.send_lock = threading.Lock()
+        self.channels = set()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, frame):
+        with self.send_lock:
+            try:
+                send_frame(self.request, frame)
+            except OSError:
+                pass
+
+    def handle(self):
+        broker = self.server
+        while True:
+            try:
+                frame = recv_frame(self.request)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                return
+            if frame is None:
+                return
+
+            op = frame[0]
+            if op == 'pub':
+                broker.publish(frame[1], frame[2])
+            elif op == 'sub':
+                broker.subscribe(frame[1], self)
+                self.channels.add(frame[1])
+            elif op == 'incr':
+                self.send(('val', broker.incr(frame[1], frame[2])))
+            elif op == 'take':
+                self.send(('val', broker.buckets.take(frame[1])))
+
+    def finish(self):
+        for channel in self.channels:
+            self.server.unsubscribe(channel, self)
+
+
+class Broker(socketserver.ThreadingTCPServer):
+    """发布/订阅代理，每个连接一个线程"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, _BrokerHandler)
+        self.subscribers = {}
+        self.counters = {}
+        self.buckets = TokenBuckets()
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, handler):
+        with self._lock:
+            self.subscribers.setdefault(channel, set()).add(handler)
+
+    def unsubscribe(self, channel, handler):
+        with self._lock:
+            handlers = self.subscribers.get(channel)
+            if handlers is not None:
+                handlers.discard(handler)
+
+    def publish(self, channel, payload):
+        with self._lock:
+            handlers = list(self.subscribers.get(channel, ()))
+        frame = ('msg', channel, payload)
+        for handler in handlers:
+            handler.send(frame)
+
+    def incr(self, key, floor=0):
+        with self._lock:
+            value = max(self.counters.get(key, 0), floor or 0) + 1
+            self.counters[key] = value
+            return value
+
+
+def run_broker(host='127.0.0.1', port=2260):
+    server = Broker((host, port))
+    print(f'消息代理已启动：mcq://{host}:{port}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='mc_chat 本地消息代理')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2260)
+    args = parser.parse_args()
+    run_broker(args.host, args.port)
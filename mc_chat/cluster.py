@@ -0,0 +1,464 @@
+"""
+多进程 / 多节点部署 - 跨工作进程的 Socket.IO 广播与聊天状态复制
+
+- BusManager：python-socketio 的 PubSubManager 子类，emit(room=...) / emit(to=sid) 经消息总线到达所有工作进程
+- ClusterLink：把 ChatState 的每次变更发布给其他工作进程，并在本进程应用其他进程的变更；
+  消息的 seq 由总线上的计数器统一分配，保证同一房间内全局唯一且递增
+- 总线支持 redis://（需要安装 redis）和 mcq://（broker.py 本地代理）
+"""
+import pickle
+import queue
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import socketio
+
+from broker import send_frame, recv_frame
+from fanout import FanoutManager
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Redis 上的「加一且不小于 floor + 1」
+_REDIS_INCR_FLOOR = """
+local value = redis.call('INCR', KEYS[1])
+local floor = tonumber(ARGV[1])
+if value <= floor then
+    value = floor + 1
+    redis.call('SET', KEYS[1], value)
+end
+return value
+"""
+
+# Redis 上的多桶原子取令牌，语义同 ratelimit.TokenBuckets.take：KEYS 为桶，ARGV 依次为每个桶的 rate、burst、cost，
+# 全部足够时扣除并返回 '0'，否则不扣除并返回需要等待的秒数
+_REDIS_TAKE = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tokens = {}
+local wait = 0
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local burst = tonumber(ARGV[i * 3 - 1])
+    local cost = tonumber(ARGV[i * 3])
+    local bucket = redis.call('HMGET', KEYS[i], 't', 'ts')
+    local value = tonumber(bucket[1]) or burst
+    local last = tonumber(bucket[2]) or now
+    value = math.min(burst, value + math.max(0, now - last) * rate)
+    tokens[i] = value
+    if value < cost then
+        wait = math.max(wait, (cost - value) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local burst = tonumber(ARGV[i * 3 - 1])
+    redis.call('HSET', KEYS[i], 't', tokens[i] - tonumber(ARGV[i * 3]), 'ts', now)
+    redis.call('PEXPIRE', KEYS[i], math.ceil(burst / rate * 1000) + 1000)
+end
+return '0'
+"""
+
+
+class BrokerBus:
+    """mcq://host:port —— 连接 broker.py"""
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self._request_sock = None
+        self._request_lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, timeout=10)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _request(self, frame, expect_reply):
+        with self._request_lock:
+            for attempt in (1, 2):
+                try:
+                    if self._request_sock is None:
+                        self._request_sock = self._connect()
+                    send_frame(self._request_sock, frame)
+                    if not expect_reply:
+                        return None
+                    reply = recv_frame(self._request_sock)
+                    if reply is None:
+                        raise OSError('消息代理连接已关闭')
+                    return reply
+                except OSError:
+                    if self._request_sock is not None:
+                        self._request_sock.close()
+                        self._request_sock = None
+                    if attempt == 2:
+                        raise
+
+    def publish(self, channel, obj):
+        self._request(('pub', channel, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)), False)
+
+    def incr(self, key, floor=0):
+        return self._request(('incr', key, floor), True)[1]
+
+    def take(self, specs):
+        return self._request(('take', specs), True)[1]
+
+    def listen(self, channel):
+        """阻塞地产生频道上的消息，断线后自动重连"""
+        retry_sleep = 1
+        while True:
+            try:
+                sock = self._connect()
+                send_frame(sock, ('sub', channel))
+                retry_sleep = 1
+                while True:
+                    frame = recv_frame(sock)
+                    if frame is None:
+                        break
+                    if frame[0] == 'msg' and frame[1] == channel:
+                        yield pickle.loads(frame[2])
+                sock.close()
+            except OSError as e:
+                print(f"消息代理连接失败，{retry_sleep} 秒后重试：{e}")
+            time.sleep(retry_sleep)
+            retry_sleep = min(retry_sleep * 2, 30)
+
+
+class RedisBus:
+    """redis://host:port/db"""
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('使用 redis:// 消息队列需要先安装 redis（pip install redis）')
+        self.redis = redis.Redis.from_url(url)
+        self._incr_floor = self.redis.register_script(_REDIS_INCR_FLOOR)
+        self._take = self.redis.register_script(_REDIS_TAKE)
+
+    def publish(self, channel, obj):
+        self.redis.publish(channel, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def incr(self, key, floor=0):
+        return int(self._incr_floor(keys=[key], args=[floor or 0]))
+
+    def take(self, specs):
+        keys = [key for key, _, _, _ in specs]
+        args = [value for _, rate, burst, cost in specs for value in (rate, burst, cost)]
+        return float(self._take(keys=keys, args=args))
+
+    def listen(self, channel):
+        retry_sleep = 1
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(channel)
+                retry_sleep = 1
+                for message in pubsub.listen():
+                    if message.get('type') == 'message':
+                        yield pickle.loads(message['data'])
+            except redis.exceptions.RedisError as e:
+                print(f"Redis 订阅失败，{retry_sleep} 秒后重试：{e}")
+            time.sleep(retry_sleep)
+            retry_sleep = min(retry_sleep * 2, 30)
+
+
+def open_bus(url):
+    """按 URL 创建消息总线：mcq://127.0.0.1:2260 或 redis://localhost:6379/0"""
+    parsed = urlparse(url)
+    if parsed.scheme == 'mcq':
+        return BrokerBus(parsed.hostname or '127.0.0.1', parsed.port or 2260)
+    if parsed.scheme in ('redis', 'rediss', 'unix'):
+        return RedisBus(url)
+    raise ValueError(f'不支持的消息队列地址：{url}')
+
+
+class BusManager(socketio.PubSubManager, FanoutManager):
+    """让 Socket.IO 的 emit 经消息总线到达所有工作进程，各进程在本地扇出给自己的连接"""
+
+    name = 'mc_bus'
+
+    def __init__(self, bus, channel='mc_chat.socketio', write_only=False, logger=None):
+        self.bus = bus
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _publish(self, data):
+        try:
+            self.bus.publish(self.channel, data)
+        except Exception as e:
+            print(f"发布 Socket.IO 消息失败：{e}")
+
+    def _listen(self):
+        return self.bus.listen(self.channel)
+
+
+class ClusterLink:
+    """
+    聊天状态复制
+
+    publish() 只入队并分配本进程内递增的序号，由后台线程按顺序发布，不在房间锁内做网络 IO；
+    发布失败时退避重试同一条，不会跳过。监听线程收到其他工作进程的变更后调用 ChatState.apply()。
+    复制是异步的（通常为毫秒级），不同进程上的状态最终一致。
+
+    补齐：每个进程定期广播心跳（带已发布的最大序号）。收到未知进程的消息、序号不连续
+    或心跳序号超过已收到的序号时（订阅断线重连期间会丢消息），向对方请求全量快照
+    （ChatState.export_snapshot / merge_snapshot）；启动时向所有进程请求一次。
+    快照由对方的发布线程在已发布的事件之后生成，之后的事件序号紧接在快照之后。
+
+    会话归属：最后发布某用户 socket 绑定 / 重连令牌的进程负责该会话，快照中只有它的版本为准；
+    超过 NODE_TIMEOUT 没有收到某进程的任何消息时视为失联，解绑它负责的会话并调用 on('node_lost') 的回调。
+
+    删除（用户、房间、邀请码）额外保留最近 MAX_TOMBSTONES 条记录随快照下发，
+    合并快照时不会把已删除的对象补回。
+    """
+
+    HEARTBEAT_INTERVAL = 2.0
+    NODE_TIMEOUT = 10.0
+    SYNC_TIMEOUT = 10.0
+    MAX_TOMBSTONES = 10000
+
+    # 不占序号的控制消息
+    _CONTROL = ('heartbeat', 'sync_request', 'sync')
+    _TOMBSTONE_KEYS = {
+        'user_removed': ('user', 'user_id'),
+        'user_expired': ('user', 'user_id'),
+        'room_deleted': ('room', 'room_id'),
+        'invite_code_removed': ('invite', 'code')
+    }
+
+    def __init__(self, bus, channel='mc_chat.state', node_id=None):
+        self.bus = bus
+        self.channel = channel
+        self.node_id = node_id or uuid.uuid4().hex
+
+        self.published = 0
+        self.applied = 0
+        self.errors = 0
+        self.gaps = 0
+        self.resyncs = 0
+        self.lost = 0
+
+        self._queue = queue.Queue()
+        self._state = None
+        self._handlers = {}
+        self._seq = 0
+        self._seq_lock = threading.Lock()
+        self._sent_seq = 0
+        # 其他进程：node_id -> {'seq': 已收到的最大序号, 'heard': 最近一次收到消息的时间, 'syncing': 请求快照的时间}
+        self._nodes = {}
+        # user_id -> 负责该会话的 node_id
+        self._owners = {}
+        # ('user' | 'room' | 'invite', ID) -> (kind, data)
+        self._tombstones = OrderedDict()
+        self._lock = threading.Lock()
+        self._started = None
+
+    def on(self, event, handler):
+        """登记回调；目前只有 'node_lost'：handler(node_id, {user_id: 离开的语音房间 ID 列表})"""
+        self._handlers[event] = handler
+
+    def start(self, state):
+        self._state = state
+        self._started = time.monotonic()
+        threading.Thread(target=self._publisher, name='cluster-publish', daemon=True).start()
+        threading.Thread(target=self._listener, name='cluster-listen', daemon=True).start()
+        threading.Thread(target=self._heartbeat, name='cluster-heartbeat', daemon=True).start()
+        self._queue.put((None, 'sync_request', {'target': None}))
+
+    def synced(self):
+        """启动后已过了发现其他进程所需的时间（两个心跳周期），且与已知的每个进程都完成了全量同步"""
+        if self._started is None or time.monotonic() - self._started < self.HEARTBEAT_INTERVAL * 2:
+            return False
+        with self._lock:
+            return not any(node['syncing'] for node in self._nodes.values())
+
+    def publish(self, kind, data):
+        self._track(self.node_id, kind, data)
+        with self._seq_lock:
+            self._seq += 1
+            self._queue.put((self._seq, kind, data))
+
+    def next_seq(self, room_id, floor=0):
+        """从总线计数器取房间内下一个消息序号"""
+        return self.bus.incr(f'mc_chat:seq:{room_id}', floor)
+
+    def claim(self, key):
+        """集群内只有第一个调用者得到 True（用总线计数器实现的一次性租约）"""
+        return self.bus.incr(f'mc_chat:claim:{key}') == 1
+
+    def _track(self, node_id, kind, data):
+        """维护会话归属和删除记录"""
+        with self._lock:
+            if kind in ('user_created', 'socket_bound', 'resume_token_issued'):
+                self._owners[data['user_id']] = node_id
+            elif kind == 'invite_code_added':
+                self._tombstones.pop(('invite', data['code']), None)
+            key = self._TOMBSTONE_KEYS.get(kind)
+            if key is not None:
+                if key[0] == 'user':
+                    self._owners.pop(data['user_id'], None)
+                self._remember((key[0], data[key[1]]), kind, data)
+
+    def _remember(self, key, kind, data):
+        """调用方持有 _lock"""
+        self._tombstones[key] = (kind, data)
+        self._tombstones.move_to_end(key)
+        while len(self._tombstones) > self.MAX_TOMBSTONES:
+            self._tombstones.popitem(last=False)
+
+    def _publisher(self):
+        while True:
+            seq, kind, data = self._queue.get()
+            if kind in self._CONTROL:
+                seq = self._sent_seq
+                if kind == 'sync':
+                    try:
+                        data = {'to': data, 'snapshot': self._export()}
+                    except Exception as e:
+                        self.errors += 1
+                        print(f"导出全量状态失败：{e}")
+                        continue
+            self._send((self.node_id, seq, kind, data))
+            if kind not in self._CONTROL:
+                self._sent_seq = seq
+                self.published += 1
+
+    def _send(self, message):
+        """发布一条消息，失败时退避重试直到成功（后续消息在此期间排队，顺序不变）"""
+        retry_sleep = 0.5
+        while True:
+            try:
+                self.bus.publish(self.channel, message)
+                return
+            except Exception as e:
+                self.errors += 1
+                print(f"发布状态变更失败，{retry_sleep} 秒后重试：{message[2]} {e}")
+                time.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 30)
+
+    def _export(self):
+        with self._lock:
+            owned = [uid for uid, node_id in self._owners.items() if node_id == self.node_id]
+            tombstones = list(self._tombstones.items())
+        snapshot = self._state.export_snapshot(owned)
+        snapshot['tombstones'] = tombstones
+        return snapshot
+
+    def _request_sync(self, node_id, node):
+        """调用方持有 _lock"""
+        node['syncing'] = time.monotonic()
+        self._queue.put((None, 'sync_request', {'target': node_id}))
+
+    def _listener(self):
+        for node_id, seq, kind, data in self.bus.listen(self.channel):
+            if node_id == self.node_id:
+                continue
+            try:
+                self._receive(node_id, seq, kind, data)
+            except Exception as e:
+                self.errors += 1
+                print(f"应用状态变更失败：{kind} {e}")
+
+    def _receive(self, node_id, seq, kind, data):
+        now = time.monotonic()
+        with self._lock:
+            if kind == 'sync_request' and data['target'] in (None, self.node_id):
+                # 先回复快照，对方收到后就不必再反过来请求
+                self._queue.put((None, 'sync', node_id))
+            node = self._nodes.get(node_id)
+            if node is None:
+                node = self._nodes[node_id] = {'seq': seq, 'heard': now, 'syncing': 0}
+                if kind != 'sync' or data['to'] != self.node_id:
+                    self._request_sync(node_id, node)
+            node['heard'] = now
+            if kind == 'sync_request':
+                return
+            if kind == 'sync':
+                if data['to'] != self.node_id:
+                    return
+            elif node['syncing']:
+                if now - node['syncing'] > self.SYNC_TIMEOUT:
+                    self._request_sync(node_id, node)
+            elif seq > node['seq'] + (0 if kind == 'heartbeat' else 1):
+                self.gaps += 1
+                print(f"节点 {node_id} 的状态变更有遗漏（{node['seq']} -> {seq}），请求全量同步")
+                self._request_sync(node_id, node)
+            if kind != 'heartbeat':
+                node['seq'] = max(node['seq'], seq)
+        if kind == 'heartbeat':
+            return
+        if kind == 'sync':
+            self._merge(node_id, seq, data['snapshot'])
+            return
+        self._track(node_id, kind, data)
+        self._state.apply(kind, data)
+        self.applied += 1
+
+    def _merge(self, node_id, seq, snapshot):
+        with self._lock:
+            missed = [(key, kind, data) for key, (kind, data) in snapshot['tombstones']
+                      if key not in self._tombstones]
+            for key, kind, data in missed:
+                self._remember(key, kind, data)
+        for _, kind, data in missed:
+            self._state.apply(kind, data)
+        tombstones = self._tombstones
+        owned = self._state.merge_snapshot(snapshot, lambda key: key in tombstones)
+        with self._lock:
+            for uid in owned:
+                self._owners[uid] = node_id
+            node = self._nodes[node_id]
+            node['seq'] = seq
+            node['syncing'] = 0
+        self.resyncs += 1
+        print(f"已与节点 {node_id} 同步全量状态：{len(snapshot['users'])} 个用户，{len(snapshot['rooms'])} 个房间")
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.HEARTBEAT_INTERVAL)
+            self._queue.put((None, 'heartbeat', None))
+            now = time.monotonic()
+            with self._lock:
+                lost = [node_id for node_id, node in self._nodes.items()
+                        if now - node['heard'] > self.NODE_TIMEOUT]
+                for node_id in lost:
+                    del self._nodes[node_id]
+            for node_id in lost:
+                self._node_lost(node_id)
+
+    def _node_lost(self, node_id):
+        with self._lock:
+            user_ids = [uid for uid, owner in self._owners.items() if owner == node_id]
+            for uid in user_ids:
+                del self._owners[uid]
+        self.lost += 1
+        sessions = self._state.drop_sessions(user_ids)
+        print(f"节点 {node_id} 已失联，解绑其 {len(sessions)} 个会话")
+        handler = self._handlers.get('node_lost')
+        if handler is not None:
+            try:
+                handler(node_id, sessions)
+            except Exception as e:
+                print(f"处理节点失联失败：{node_id} {e}")
+
+    def stats(self):
+        with self._lock:
+            nodes = len(self._nodes)
+        return {
+            'node_id': self.node_id,
+            'nodes': nodes,
+            'queued': self._queue.qsize(),
+            'published': self.published,
+            'applied': self.applied,
+            'errors': self.errors,
+            'gaps': self.gaps,
+            'resyncs': self.resyncs,
+            'lost_nodes': self.lost
+        }
@@ -0,0 +1,161 @@
+"""
+紧凑编码 - 连接时协商、按连接选择的 MessagePack 下行编码
+
+客户端连接时带上 auth {'encoding': 'msgpack'}，之后发给它的事件参数整体编码为一个 MessagePack 二进制附件
+（WebSocket 上以二进制帧发送，不经 base64），其中：
+- user_id / room_id 等 UUID 换成本进程内的整数句柄，句柄第一次发给某个连接前先发 ids {句柄: UUID}
+  （ids 同样是 MessagePack 二进制附件，句柄保持整数键）；句柄号不复用，用户和房间删除后其句柄随之释放
+- timestamp 的 ISO 字符串换成毫秒时间戳
+- 消息 id 换成 16 字节的原始 UUID
+客户端发往服务端的事件仍是 JSON；需要 pip install msgpack，未安装时忽略协商，所有连接使用 JSON。
+"""
+import threading
+import uuid
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 值为 UUID、换成整数句柄的字段（列表字段中的每一项）
+HANDLE_KEYS = frozenset(('user_id', 'room_id', 'from_user_id', 'target_user_id', 'initiator_id'))
+HANDLE_LIST_KEYS = frozenset(('user_ids', 'room_ids'))
+
+# 句柄表至少达到这个大小才清理已删除的用户和房间
+MIN_PRUNE = 1024
+
+
+def compact_available():
+    return msgpack is not None
+
+
+class CompactCodec:
+    """
+    句柄表与启用紧凑编码的连接
+
+    encode() 与接收者无关，一次 emit 只编码一次，并带上这次用到的 句柄 -> UUID；
+    introduce() 返回该连接还不认识的那部分。同一连接的 ids 和使用这些句柄的事件必须按顺序入队，
+    发送方在 lock 内完成两者。
+
+    句柄号只增不复用；表的大小每翻一倍时用 alive(UUID) 清理一次已删除的用户和房间，
+    同时从各连接已告知的集合中移除（摊还 O(1)）。已编码、尚未发出的事件自带映射，不受清理影响。
+    """
+
+    def __init__(self, alive=None):
+        self.lock = threading.Lock()
+        self.alive = alive
+        # UUID 字符串 -> 句柄
+        self._handles = {}
+        self._next = 0
+        self._prune_at = MIN_PRUNE
+        # sid -> 已告知该连接的句柄
+        self._sessions = {}
+
+        self.encoded = 0
+        self.encoded_bytes = 0
+        self.released = 0
+
+    @property
+    def active(self):
+        return bool(self._sessions)
+
+    def enable(self, sid):
+        self._sessions[sid] = set()
+
+    def forget(self, sid):
+        self._sessions.pop(sid, None)
+
+    def is_compact(self, sid):
+        return sid in self._sessions
+
+    def handle(self, value):
+        handle = self._handles.get(value)
+        if handle is None:
+            with self.lock:
+                handle = self._handles.get(value)
+                if handle is None:
+                    if self.alive is not None and len(self._handles) >= self._prune_at:
+                        self._prune()
+                    handle = self._next
+                    self._next += 1
+                    self._handles[value] = handle
+        return handle
+
+    def _prune(self):
+        """释放已删除的用户和房间的句柄（调用方持有 lock）"""
+        dead = {}
+        for value, handle in self._handles.items():
+            if not self.alive(value):
+                dead[value] = handle
+        for value in dead:
+            del self._handles[value]
+        if dead:
+            handles = set(dead.values())
+            for known in self._sessions.values():
+                known -= handles
+        self.released += len(dead)
+        self._prune_at = max(MIN_PRUNE, len(self._handles) * 2)
+
+    def encode(self, args):
+        """把事件参数列表编码为 MessagePack，返回 (bytes, {用到的句柄: UUID})"""
+        handles = {}
+        payload = msgpack.packb(self._compact(args, handles), use_bin_type=True)
+        self.encoded += 1
+        self.encoded_bytes += len(payload)
+        return payload, handles
+
+    def introduce(self, sid, handles):
+        """该连接第一次见到的句柄，编码后的 ids 参数；没有时返回 None（调用方持有 lock）"""
+        known = self._sessions.get(sid)
+        if known is None:
+            return None
+        new = handles.keys() - known
+        if not new:
+            return None
+        known |= new
+        return msgpack.packb({handle: handles[handle] for handle in new})
+
+    def stats(self):
+        return {
+            'sessions': len(self._sessions),
+            'handles': len(self._handles),
+            'released': self.released,
+            'encoded': self.encoded,
+            'encoded_bytes': self.encoded_bytes
+        }
+
+    def _compact(self, value, handles):
+        if isinstance(value, dict):
+            return {key: self._compact_field(key, item, handles) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._compact(item, handles) for item in value]
+        return value
+
+    def _compact_field(self, key, value, handles):
+        if isinstance(value, str):
+            if key in HANDLE_KEYS:
+                handle = self.handle(value)
+                handles[handle] = value
+                return handle
+            if key == 'timestamp':
+                try:
+                    return int(datetime.fromisoformat(value).timestamp() * 1000)
+                except ValueError:
+                    return value
+            if key == 'id' and len(value) == 36:
+                try:
+                    return uuid.UUID(value).bytes
+                except ValueError:
+                    return value
+            return value
+        if key in HANDLE_LIST_KEYS and isinstance(value, (list, tuple)):
+            compacted = []
+            for item in value:
+                if isinstance(item, str):
+                    handle = self.handle(item)
+                    handles[handle] = item
+                    item = handle
+                compacted.append(item)
+            return compacted
+        return self._compact(value, handles)
@@ -0,0 +1,250 @@
+"""
+结构化事件日志 - 有界内存队列 + 后台批量写入
+替代在每个 Socket.IO 处理函数里同步 open/write/close 调试日志文件的做法
+"""
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+from offload import run_blocking
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+DISABLED = 100
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+    'off': DISABLED,
+    'disabled': DISABLED,
+}
+
+
+def parse_level(value, default=INFO):
+    """把 'debug' / 'info' / 'off' 或数字解析成日志级别"""
+    if value is None or value == '':
+        return default
+    if isinstance(value, int):
+        return value
+    value = str(value).strip().lower()
+    if value.isdigit():
+        return int(value)
+    return LEVELS.get(value, default)
+
+
+def parse_sampling(value):
+    """解析采样配置：'webrtc_ice_candidate=0.1,send_message=0.5' -> dict"""
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return {k: float(v) for k, v in value.items()}
+    sampling = {}
+    for part in str(value).split(','):
+        if '=' not in part:
+            continue
+        event, rate = part.split('=', 1)
+        try:
+            sampling[event.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return sampling
+
+
+class EventLogger:
+    """
+    事件日志记录器
+
+    - log() 只做级别/采样判断并把字典放进有界队列，不做序列化和文件 IO
+    - 调用方用 `if event_log.enabled_for(level):` 包住 log()，级别关闭时连数据字典都不构造
+    - 后台线程批量取出、序列化并一次写入，文件句柄常驻
+    - 队列满时直接丢弃并计数，绝不阻塞调用方
+    - 文件超过 max_bytes 时按 path.1 ... path.N 轮转
+    """
+
+    def __init__(self, path, level=INFO, session_id=None, sampling=None,
+                 max_queue=10000, batch_size=256, flush_interval=0.5,
+                 max_bytes=10 * 1024 * 1024, backup_count=3):
+        self.path = path
+        self.level = level
+        self.session_id = session_id
+        self.sampling = dict(sampling or {})
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopped = False
+        self._file = None
+        self._file_size = 0
+
+    @property
+    def enabled(self):
+        return self.level < DISABLED
+
+    def enabled_for(self, level):
+        return level >= self.level
+
+    def log(self, location, message, data=None, level=INFO, event=None):
+        """记录一条事件；禁用或被采样掉时几乎没有开销"""
+        if level < self.level:
+            return
+
+        rate = self.sampling.get(event or location)
+        if rate is not None and rate < 1.0 and random.random() >= rate:
+            self.sampled_out += 1
+            return
+
+        now = int(time.time() * 1000)
+        entry = {
+            "id": f"log_{now}",
+            "timestamp": now,
+            "location": location,
+            "message": message,
+            "data": data or {},
+        }
+        if self.session_id is not None:
+            entry["sessionId"] = self.session_id
+
+        if self._thread is None:
+            self._start()
+
+        try:
+            self._queue.put_nowait(entry)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {
+            'level': self.level,
+            'queued': self._queue.qsize(),
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+        }
+
+    def close(self, timeout=2.0):
+        """停止后台线程并把剩余日志写完"""
+        thread = self._thread
+        if thread is None or self._stopped:
+            return
+        self._stopped = True
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(timeout)
+
+    # ---------- 后台写入 ----------
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            thread = threading.Thread(target=self._run, name='event-log-writer', daemon=True)
+            self._thread = thread
+            thread.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            if None in batch:
+                stop = True
+                batch = [entry for entry in batch if entry is not None]
+
+            if batch:
+                run_blocking(self._write_batch, batch)
+
+            if stop:
+                # 把停止信号之后还没取出的日志也写完
+                rest = []
+                while True:
+                    try:
+                        entry = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if entry is not None:
+                        rest.append(entry)
+                if rest:
+                    run_blocking(self._write_batch, rest)
+                self._close_file()
+                return
+
+    def _write_batch(self, batch):
+        lines = []
+        for entry in batch:
+            try:
+                lines.append(json.dumps(entry, ensure_ascii=False))
+            except (TypeError, ValueError):
+                continue
+        if not lines:
+            return
+
+        chunk = ("\n".join(lines) + "\n").encode('utf-8')
+        try:
+            f = self._open_file()
+            if self.max_bytes and self._file_size + len(chunk) > self.max_bytes and self._file_size > 0:
+                self._rotate()
+                f = self._open_file()
+            f.write(chunk)
+            f.flush()
+            self._file_size += len(chunk)
+            self.written += len(lines)
+        except OSError as e:
+            print(f"写入事件日志失败：{e}")
+            self._close_file()
+
+    def _open_file(self):
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+            self._file_size = self._file.tell()
+        return self._file
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def _rotate(self):
+        self._close_file()
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
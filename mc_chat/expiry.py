@@ -0,0 +1,145 @@
+"""
+过期清理 - 分层时间轮驱动的 TTL 过期
+
+登录后一直没有连接的用户、过期或用完次数的邀请码、长时间没有人在线的房间都登记到同一个时间轮里，
+由一个后台线程每 tick 推进一次；登记、改期和取消都是 O(1)，不为每个对象创建定时器。
+"""
+import threading
+import time
+
+
+class TimingWheel:
+    """
+    分层时间轮：每层 slots 个槽，第 n 层一个槽覆盖 slots ** n 个 tick
+
+    到期时间离当前越远放在越高的层，高层的槽在时间走到时整体下放到低层（摊还 O(1)），
+    第 0 层当前槽里的条目即为到期条目。超出最高层范围的延迟按最大范围登记。
+    """
+
+    def __init__(self, slots=64, levels=4):
+        self.slots = slots
+        self.levels = levels
+        self.current = 0
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        # key -> (层, 槽)
+        self._where = {}
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, ticks):
+        """ticks 个 tick 之后到期；key 已登记时改期"""
+        self.cancel(key)
+        ticks = min(max(1, int(ticks)), self.slots ** self.levels - 1)
+        self._place(key, self.current + ticks)
+
+    def cancel(self, key):
+        where = self._where.pop(key, None)
+        if where is not None:
+            level, slot = where
+            del self._wheels[level][slot][key]
+
+    def advance(self):
+        """推进一个 tick，返回到期的 key"""
+        self.current += 1
+        now = self.current
+        # 低层转完一圈时，把上一层对应的槽下放
+        for level in range(1, self.levels):
+            if now % (self.slots ** level):
+                break
+            bucket = self._wheels[level][(now // self.slots ** level) % self.slots]
+            entries = list(bucket.items())
+            bucket.clear()
+            for key, deadline in entries:
+                self._place(key, deadline)
+
+        bucket = self._wheels[0][now % self.slots]
+        expired = list(bucket)
+        bucket.clear()
+        for key in expired:
+            del self._where[key]
+        return expired
+
+    def _place(self, key, deadline):
+        delta = deadline - self.current
+        for level in range(self.levels):
+            if delta < self.slots ** (level + 1) or level == self.levels - 1:
+                slot = (deadline // self.slots ** level) % self.slots
+                break
+        self._wheels[level][slot][key] = deadline
+        self._where[key] = (level, slot)
+
+
+class ExpiryEngine:
+    """
+    按类别登记 TTL，到期时调用该类别的处理函数
+
+    处理函数 handler(key) 在后台线程中执行，返回 True 表示确实清理了（计入 evicted），
+    返回 False 表示对象在此期间又被使用、不需要清理。
+    """
+
+    def __init__(self, tick=1.0):
+        self.tick = tick
+        self.wheel = TimingWheel()
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.evicted = {}
+        self.skipped = 0
+
+    def on(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def schedule(self, kind, key, ttl):
+        """ttl 秒后检查 (kind, key)，ttl 不大于 0 时不登记"""
+        if ttl <= 0:
+            return
+        with self._lock:
+            self.wheel.schedule((kind, key), -(-ttl // self.tick))
+
+    def cancel(self, kind, key):
+        with self._lock:
+            self.wheel.cancel((kind, key))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='expiry', daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        return {
+            'pending': len(self.wheel),
+            'evicted': dict(self.evicted),
+            'skipped': self.skipped
+        }
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+            # 线程被挂起过时补走落下的 tick
+            expired = []
+            with self._lock:
+                while next_tick <= time.monotonic():
+                    expired.extend(self.wheel.advance())
+                    next_tick += self.tick
+            for kind, key in expired:
+                self._expire(kind, key)
+
+    def _expire(self, kind, key):
+        handler = self._handlers.get(kind)
+        if handler is None:
+            return
+        try:
+            evicted = handler(key)
+        except Exception as e:
+            print(f"过期清理失败：{kind} {key} {e}")
+            return
+        if evicted:
+            self.evicted[kind] = self.evicted.get(kind, 0) + 1
+        else:
+            self.skipped += 1
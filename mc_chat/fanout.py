@@ -0,0 +1,253 @@
+"""
+消息扇出 - 房间广播交给后台线程，并保护慢连接
+
+emit(room=...) 原本在发送者的处理线程里逐个 socket 入队；这里改为：
+- 处理线程只取一次房间成员快照、入队一个任务，立即返回
+- 扇出线程按房间分片（同一房间的消息保持顺序），编码一次，写入每个连接的 engine.io 发送队列
+- engine.io 发送队列由每个连接自己的写线程排空；队列积压超过 max_queue 的连接被标记为「慢连接」，
+  之后发给它的可补回的广播（SHEDDABLE_EVENTS）直接丢弃（只记住涉及的房间），积压回落后补发一条 missed_messages，
+  客户端据此按游标拉取历史；成员进出、房间删除、语音开始 / 结束等控制事件丢了无法恢复，照常入队；
+  持续积压超过 max_lag 秒则断开该连接
+- 启用紧凑编码（compact.CompactCodec）的连接收到 MessagePack 编码的包，JSON 和紧凑编码各只编码一次
+"""
+import queue
+import threading
+import time
+
+import socketio
+from socketio import packet
+from engineio import packet as eio_packet
+
+
+# 慢连接上可以丢弃的广播：消息能按游标从历史补回，活跃发言人下一轮就会刷新
+SHEDDABLE_EVENTS = frozenset(('new_message', 'active_speakers'))
+
+
+class _Outgoing:
+    """一次 emit 要发送的 engine.io 包，按接收者需要的编码延迟生成，每种编码最多生成一次"""
+
+    def __init__(self, server, codec, namespace, event, data):
+        self.server = server
+        self.codec = codec
+        self.namespace = namespace
+        self.event = event
+        self.data = data
+        self._json = None
+        self._compact = None
+
+    def _packets(self, event, data):
+        encoded = self.server.packet_class(packet.EVENT, namespace=self.namespace, data=[event] + data).encode()
+        if not isinstance(encoded, list):
+            encoded = [encoded]
+        return [eio_packet.Packet(eio_packet.MESSAGE, p) for p in encoded]
+
+    def send(self, sid, eio_sid):
+        codec = self.codec
+        if codec is None or not codec.is_compact(sid):
+            if self._json is None:
+                self._json = self._packets(self.event, self.data)
+            for pkt in self._json:
+                self.server._send_eio_packet(eio_sid, pkt)
+            return
+
+        if self._compact is None:
+            payload, handles = codec.encode(self.data)
+            self._compact = (self._packets(self.event, [payload]), handles)
+        pkts, handles = self._compact
+        # 句柄定义必须先于使用它的事件进入该连接的发送队列
+        with codec.lock:
+            ids = codec.introduce(sid, handles)
+            if ids:
+                for pkt in self._packets('ids', [ids]):
+                    self.server._send_eio_packet(eio_sid, pkt)
+            for pkt in pkts:
+                self.server._send_eio_packet(eio_sid, pkt)
+
+
+class Fanout:
+    """
+    扇出线程池与慢连接策略
+
+    stats() 返回排队任务数、投递 / 丢弃 / 断开计数、当前慢连接数和最大的连接发送队列长度。
+    """
+
+    def __init__(self, workers=2, max_queue=256, max_lag=30.0, sheddable=SHEDDABLE_EVENTS):
+        self.workers = max(1, workers)
+        self.sheddable = sheddable
+        self.max_queue = max_queue
+        self.low_watermark = max_queue // 4
+        self.max_lag = max_lag
+
+        self.submitted = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.disconnected = 0
+
+        self.manager = None
+        self._shards = [queue.Queue() for _ in range(self.workers)]
+        # eio_sid -> {'since': 开始积压的时间, 'dropped': 丢弃条数, 'rooms': {涉及的房间}}
+        self._lagging = {}
+        self._lock = threading.Lock()
+
+    def start(self, manager):
+        self.manager = manager
+        for index, shard in enumerate(self._shards):
+            threading.Thread(target=self._run, args=(shard,), name=f'fanout-{index}', daemon=True).start()
+
+    def submit(self, namespace, room, event, data, recipients):
+        self.submitted += 1
+        self._shards[hash(room) % self.workers].put((namespace, room, event, data, recipients))
+
+    def stats(self):
+        sockets = self._sockets()
+        return {
+            'queued': sum(shard.qsize() for shard in self._shards),
+            'submitted': self.submitted,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'disconnected': self.disconnected,
+            'lagging': len(self._lagging),
+            'max_socket_queue': max((s.queue.qsize() for s in list(sockets.values())), default=0)
+        }
+
+    def _sockets(self):
+        eio = getattr(self.manager.server, 'eio', None) if self.manager else None
+        return getattr(eio, 'sockets', {}) if eio is not None else {}
+
+    def _run(self, shard):
+        while True:
+            job = shard.get()
+            try:
+                self._deliver(*job)
+            except Exception as e:
+                print(f"消息扇出失败：{e}")
+
+    def _deliver(self, namespace, room, event, data, recipients):
+        outgoing = _Outgoing(self.manager.server, self.manager.codec, namespace, event, data)
+        sockets = self._sockets()
+        now = time.monotonic()
+        for sid, eio_sid in recipients:
+            sock = sockets.get(eio_sid)
+            if sock is not None and sock.closed:
+                self.forget(eio_sid)
+                continue
+            # 测试客户端等没有 engine.io socket 的连接直接发送
+            depth = sock.queue.qsize() if sock is not None else 0
+            if not self._admit(sid, eio_sid, namespace, room, depth, now, event in self.sheddable):
+                continue
+            outgoing.send(sid, eio_sid)
+            self.delivered += 1
+
+    def _admit(self, sid, eio_sid, namespace, room, depth, now, sheddable):
+        """
+        返回是否发送；慢连接只丢弃可补回的广播并记录，控制事件照常发送；
+        恢复时补发 missed_messages，超时断开
+        """
+        with self._lock:
+            lag = self._lagging.get(eio_sid)
+            if lag is None:
+                if depth < self.max_queue:
+                    return True
+                lag = self._lagging[eio_sid] = {'since': now, 'dropped': 0, 'rooms': set()}
+            elif depth <= self.low_watermark:
+                del self._lagging[eio_sid]
+                recovered = lag
+                lag = None
+
+            if lag is not None:
+                expired = now - lag['since'] > self.max_lag
+                if expired:
+                    del self._lagging[eio_sid]
+                    self.disconnected += 1
+                elif sheddable:
+                    lag['dropped'] += 1
+                    lag['rooms'].add(room)
+                    self.dropped += 1
+
+        if lag is None:
+            # 积压已回落：先告诉客户端哪些房间漏了消息，再继续正常投递
+            if recovered['dropped']:
+                self.manager.server._send_packet(eio_sid, self.manager.server.packet_class(
+                    packet.EVENT, namespace=namespace,
+                    data=['missed_messages', {
+                        'room_ids': [r for r in recovered['rooms'] if r is not None],
+                        'dropped': recovered['dropped']
+                    }]
+                ))
+            return True
+
+        if expired:
+            print(f"连接 {sid} 积压超过 {self.max_lag} 秒，已断开")
+            self.manager.server.start_background_task(self._kick, eio_sid)
+            return False
+        return not sheddable
+
+    def _kick(self, eio_sid):
+        """直接中止 engine.io 连接：正常关闭会等待发送队列排空，而慢连接恰恰排不空"""
+        eio = self.manager.server.eio
+        sock = eio.sockets.get(eio_sid)
+        if sock is None:
+            return
+        sock.close(wait=False, abort=True)
+        eio.sockets.pop(eio_sid, None)
+
+    def forget(self, eio_sid):
+        with self._lock:
+            self._lagging.pop(eio_sid, None)
+
+
+class FanoutManager(socketio.Manager):
+    """
+    把房间广播交给 Fanout 扇出；发给单个 sid、带回调的 emit 仍同步发送
+
+    多进程部署时与 PubSubManager 组合（见 cluster.BusManager），
+    本进程和其他进程发来的广播都在本地扇出，也在本地按连接选择编码。
+    """
+
+    fanout = None
+    codec = None
+    metrics = None
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        if self.metrics is not None:
+            # 接收者数量按房间人数估算（不扣除 skip_sid），room 为 sid 时即 1
+            self.metrics.emitted(event, data, len(self.rooms.get(namespace, {}).get(room, ())))
+        fanout = self.fanout
+        compact = self.codec is not None and self.codec.active
+        if callback or namespace not in self.rooms:
+            return super().emit(event, data, namespace, room=room, skip_sid=skip_sid,
+                                callback=callback, **kwargs)
+        direct = fanout is None or room in self.rooms[namespace].get(None, ())
+        if direct and not compact:
+            return super().emit(event, data, namespace, room=room, skip_sid=skip_sid, **kwargs)
+
+        if isinstance(data, tuple):
+            data = list(data)
+        elif data is not None:
+            data = [data]
+        else:
+            data = []
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+
+        recipients = [
+            (sid, eio_sid) for sid, eio_sid in self.get_participants(namespace, room)
+            if sid not in skip_sid
+        ]
+        if not recipients:
+            return
+        if direct:
+            outgoing = _Outgoing(self.server, self.codec, namespace, event, data)
+            for sid, eio_sid in recipients:
+                outgoing.send(sid, eio_sid)
+        else:
+            fanout.submit(namespace, room, event, data, recipients)
+
+    def disconnect(self, sid, namespace, **kwargs):
+        if self.fanout is not None:
+            eio_sid = self.eio_sid_from_sid(sid, namespace)
+            if eio_sid is not None:
+                self.fanout.forget(eio_sid)
+        if self.codec is not None:
+            self.codec.forget(sid)
+        return super().disconnect(sid, namespace, **kwargs)
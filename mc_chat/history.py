@@ -0,0 +1,114 @@
+"""
+房间消息历史 - 固定容量环形缓冲区
+"""
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import islice
+
+
+def _seq(message):
+    return message['seq']
+
+
+class MessageHistory:
+    """
+    基于 deque(maxlen) 的环形缓冲区
+
+    append 为 O(1)，超出容量时自动丢弃最旧的消息，不会复制整个列表；
+    last(n) 从尾部反向取 n 条，只与 n 有关、与历史长度无关。
+
+    每条消息带有房间内递增的 seq，缓冲区按 seq 有序，游标位置用二分查找定位；
+    _index 维护 消息 ID -> seq，随淘汰同步删除。
+    多进程部署时 seq 由总线统一分配，其他进程的消息可能稍晚到达，此时按 seq 插入到对应位置。
+    """
+
+    __slots__ = ('_items', '_index')
+
+    def __init__(self, capacity=100):
+        self._items = deque(maxlen=max(1, int(capacity)))
+        self._index = {}
+
+    @property
+    def capacity(self):
+        return self._items.maxlen
+
+    @property
+    def first_seq(self):
+        """缓冲区中最早一条消息的 seq，为空时返回 None"""
+        return self._items[0]['seq'] if self._items else None
+
+    def append(self, message):
+        """追加一条消息，返回因此离开缓冲区的消息（没有时返回 None）"""
+        items = self._items
+        seq = message['seq']
+        if message['id'] in self._index:
+            return None
+        full = len(items) == items.maxlen
+        if full and seq < items[0]['seq']:
+            # 比缓冲区内所有消息都旧，本来就会被淘汰
+            return message
+        evicted = None
+        if full:
+            evicted = items.popleft()
+            self._index.pop(evicted['id'], None)
+        if not items or seq > items[-1]['seq']:
+            items.append(message)
+        else:
+            items.insert(bisect_left(items, seq, key=_seq), message)
+        self._index[message['id']] = seq
+        return evicted
+
+    def get(self, seq):
+        """按 seq 取缓冲区内的消息，不在缓冲区时返回 None"""
+        items = self._items
+        i = bisect_left(items, seq, key=_seq)
+        if i < len(items) and items[i]['seq'] == seq:
+            return items[i]
+        return None
+
+    def seq_of(self, message_id):
+        """消息 ID -> seq，已被淘汰或不存在时返回 None"""
+        return self._index.get(message_id)
+
+    def before(self, seq, count):
+        """seq 之前（不含）最近的 count 条消息，seq 为 None 时取最新的 count 条（按时间正序）"""
+        if seq is None:
+            return self.last(count)
+        end = bisect_left(self._items, seq, key=_seq)
+        return self._slice(max(0, end - count), end)
+
+    def after(self, seq, count):
+        """seq 之后（不含）最早的 count 条消息（按时间正序）"""
+        start = bisect_right(self._items, seq, key=_seq)
+        return self._slice(start, min(len(self._items), start + count))
+
+    def _slice(self, start, end):
+        size = len(self._items)
+        if start >= end:
+            return []
+        if start > size // 2:
+            # 靠近尾部时从右侧反向截取，避免从头遍历
+            tail = list(islice(reversed(self._items), size - end, size - start))
+            tail.reverse()
+            return tail
+        return list(islice(self._items, start, end))
+
+    def last(self, count):
+        """返回最近 count 条消息（按时间正序）"""
+        if count <= 0:
+            return []
+        if count >= len(self._items):
+            return list(self._items)
+        tail = list(islice(reversed(self._items), count))
+        tail.reverse()
+        return tail
+
+    def clear(self):
+        self._items.clear()
+        self._index.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
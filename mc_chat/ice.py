@@ -0,0 +1,114 @@
+"""
+ICE 候选合并转发 - 按 (房间, 发送方, 接收方 socket) 在短窗口内攒批
+
+大群同时开启语音时，每对用户双向各有十几个 trickle ICE 候选；逐条转发意味着每条一次 emit。
+这里把同一对用户在 window 秒内的候选合并成一个 webrtc_ice_candidates 事件，
+收到 end-of-candidates 或攒满 max_batch 条时立即发出。
+"""
+import threading
+import time
+from collections import deque
+
+
+class IceCoalescer:
+    """
+    ICE 候选合并器
+
+    add() 只把候选追加到缓冲区并在首次出现时登记截止时间；单个后台线程按截止时间顺序刷新，
+    窗口固定，所以登记顺序就是截止顺序，用 deque 即可。截止时间记着登记它的那一批，
+    该批已提前发出（或被丢弃）时跳过，不会提前刷新同一对用户随后的新一批。
+    flush_fn(to_sid, payload) 负责实际发送，payload 为
+        {'room_id', 'from_user_id', 'candidates': [...], 'end': bool}
+    """
+
+    def __init__(self, flush_fn, window=0.01, max_batch=32):
+        self.flush_fn = flush_fn
+        self.window = window
+        self.max_batch = max_batch
+
+        self.candidates = 0
+        self.batches = 0
+
+        self._pending = {}
+        self._deadlines = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, room_id, from_user_id, to_sid, candidate=None, end=False):
+        """登记一个候选；candidate 为 None 且 end=True 表示对方已收集完毕"""
+        key = (room_id, from_user_id, to_sid)
+        ready = None
+        with self._cond:
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = {'candidates': [], 'end': False}
+                self._pending[key] = batch
+                self._deadlines.append((time.monotonic() + self.window, key, batch))
+                if self._thread is None:
+                    self._start()
+                self._cond.notify()
+            if candidate is not None:
+                batch['candidates'].append(candidate)
+                self.candidates += 1
+            if end:
+                batch['end'] = True
+
+            # 收集完毕、攒满或不合并时立即发出
+            if end or len(batch['candidates']) >= self.max_batch or self.window <= 0:
+                ready = self._pending.pop(key)
+
+        if ready is not None:
+            self._flush(key, ready)
+
+    def discard(self, to_sid):
+        """接收方断开时丢弃发给它的候选"""
+        with self._cond:
+            for key in [key for key in self._pending if key[2] == to_sid]:
+                del self._pending[key]
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'candidates': self.candidates,
+            'batches': self.batches
+        }
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='ice-coalescer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            due = []
+            with self._cond:
+                while not self._deadlines:
+                    self._cond.wait()
+                deadline = self._deadlines[0][0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                now = time.monotonic()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    _, key, batch = self._deadlines.popleft()
+                    if self._pending.get(key) is batch:
+                        del self._pending[key]
+                        due.append((key, batch))
+
+            for key, batch in due:
+                self._flush(key, batch)
+
+    def _flush(self, key, batch):
+        if not batch['candidates'] and not batch['end']:
+            return
+        room_id, from_user_id, to_sid = key
+        self.batches += 1
+        try:
+            self.flush_fn(to_sid, {
+                'room_id': room_id,
+                'from_user_id': from_user_id,
+                'candidates': batch['candidates'],
+                'end': batch['end']
+            })
+        except Exception as e:
+            print(f"转发 ICE 候选失败：{e}")
@@ -0,0 +1,216 @@
+"""
+运行指标 - 处理函数的调用次数、错误数、耗时直方图、负载大小、扇出宽度，以 Prometheus 文本格式导出
+
+热路径只更新当前原生线程自己的分片，不加锁；抓取 /metrics 时把各分片相加。
+协程模式（eventlet / gevent）下所有协程共用所在原生线程的分片，更新过程中没有 IO，不会切换协程。
+"""
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+from offload import native_get_ident
+from ratelimit import payload_size
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+WIDTH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# 指标名 -> (类型, 说明, 标签名, 直方图分桶)
+FAMILIES = {
+    'mc_handler_errors_total': (
+        'counter', '处理函数抛出异常（HTTP 另含 5xx 响应）的次数', ('transport', 'handler'), None),
+    'mc_handler_latency_seconds': (
+        'histogram', '处理函数耗时（秒）', ('transport', 'handler'), LATENCY_BUCKETS),
+    'mc_payload_in_bytes': (
+        'histogram', '收到的负载大小（socket 事件为字符串和二进制的总长度，HTTP 为请求体长度）',
+        ('transport', 'handler'), SIZE_BUCKETS),
+    'mc_emit_bytes': (
+        'histogram', '每次 emit 的负载大小（字符串和二进制的总长度，与接收者数量无关）', ('event',), SIZE_BUCKETS),
+    'mc_http_response_bytes': (
+        'histogram', 'HTTP 响应体大小（流式响应不计）', ('handler',), SIZE_BUCKETS),
+    'mc_fanout_width': (
+        'histogram', '每次 emit 在本进程的接收连接数', ('event',), WIDTH_BUCKETS),
+    'mc_skin_job_seconds': (
+        'histogram', '皮肤任务从提交到处理完成的耗时（秒）', ('status',), LATENCY_BUCKETS),
+}
+
+
+class _Shard:
+    """一个原生线程的计数：(指标名, 标签值) -> 计数 / [各分桶计数..., 总和]"""
+
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+
+class Metrics:
+    """
+    指标注册表
+
+    inc() / observe() 在处理线程中调用；gauge() 登记抓取时才计算的当前值；render() 生成 Prometheus 文本。
+    """
+
+    def __init__(self):
+        self._get_ident = native_get_ident()
+        self._shards = {}
+        self._lock = threading.Lock()
+        self._gauges = []
+
+    def _shard(self):
+        ident = self._get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            # 线程 ID 被复用时新线程接着使用旧线程的分片，两者不会同时运行
+            with self._lock:
+                shard = self._shards.setdefault(ident, _Shard())
+        return shard
+
+    def inc(self, name, labels, value=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            counts = histograms[key] = [0] * (len(FAMILIES[name][3]) + 1) + [0]
+        counts[bisect_left(FAMILIES[name][3], value)] += 1
+        counts[-1] += value
+
+    def gauge(self, name, help_text, fn):
+        """登记一个瞬时值，fn() 在抓取时调用"""
+        self._gauges.append((name, help_text, fn))
+
+    # ==================== 埋点 ====================
+
+    def instrument_socketio(self, server):
+        """给 python-socketio 服务端已注册的全部事件处理函数加上统计（在所有 @socketio.on 之后调用）"""
+        for handlers in server.handlers.values():
+            for event, handler in list(handlers.items()):
+                handlers[event] = self._wrap_socket_handler(event, handler)
+
+    def _wrap_socket_handler(self, event, handler):
+        labels = ('socket', event)
+        # connect 的参数是 WSGI environ，不计负载
+        measure = event not in ('connect', 'disconnect')
+
+        @functools.wraps(handler)
+        def wrapper(sid, *args):
+            if measure:
+                self.observe('mc_payload_in_bytes', labels, payload_size(args))
+            started = time.perf_counter()
+            try:
+                return handler(sid, *args)
+            except Exception:
+                self.inc('mc_handler_errors_total', labels)
+                raise
+            finally:
+                self.observe('mc_handler_latency_seconds', labels, time.perf_counter() - started)
+
+        return wrapper
+
+    def instrument_flask(self, app):
+        """统计全部 HTTP 路由（按 endpoint 名称区分，Socket.IO 长轮询不经过 Flask，不计入）"""
+        from flask import g, request
+
+        @app.before_request
+        def _metrics_start():
+            g.metrics_started = time.perf_counter()
+
+        @app.after_request
+        def _metrics_response(response):
+            g.metrics_status = response.status_code
+            if response.content_length is not None and not response.is_streamed:
+                self.observe('mc_http_response_bytes', (request.endpoint or 'unmatched',), response.content_length)
+            return response
+
+        @app.teardown_request
+        def _metrics_finish(error):
+            started = g.pop('metrics_started', None)
+            if started is None:
+                return
+            labels = ('http', request.endpoint or 'unmatched')
+            self.observe('mc_handler_latency_seconds', labels, time.perf_counter() - started)
+            self.observe('mc_payload_in_bytes', labels, request.content_length or 0)
+            if error is not None or g.pop('metrics_status', 500) >= 500:
+                self.inc('mc_handler_errors_total', labels)
+
+    def emitted(self, event, data, width):
+        """记录一次 emit 的负载大小和本进程内的接收连接数"""
+        labels = (event,)
+        self.observe('mc_emit_bytes', labels, payload_size(data))
+        self.observe('mc_fanout_width', labels, width)
+
+    # ==================== 导出 ====================
+
+    def collect(self):
+        """合并各线程分片，返回 (计数, 直方图)"""
+        counters = {}
+        histograms = {}
+        for shard in list(self._shards.values()):
+            for key, value in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, counts in list(shard.histograms.items()):
+                total = histograms.get(key)
+                if total is None:
+                    histograms[key] = list(counts)
+                else:
+                    for i, count in enumerate(counts):
+                        total[i] += count
+        return counters, histograms
+
+    def render(self):
+        counters, histograms = self.collect()
+        lines = []
+
+        # 调用次数直接取耗时直方图的计数，热路径上不再单独计数
+        lines.append('# HELP mc_handler_calls_total 处理函数调用次数')
+        lines.append('# TYPE mc_handler_calls_total counter')
+        label_names = FAMILIES['mc_handler_latency_seconds'][2]
+        for (name, labels), counts in sorted(histograms.items()):
+            if name == 'mc_handler_latency_seconds':
+                lines.append(f'mc_handler_calls_total{_labels(label_names, labels)} {sum(counts[:-1])}')
+
+        for name, (kind, help_text, label_names, buckets) in FAMILIES.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'counter':
+                for (key_name, labels), value in sorted(counters.items()):
+                    if key_name == name:
+                        lines.append(f'{name}{_labels(label_names, labels)} {value}')
+                continue
+            for (key_name, labels), counts in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else f'{bound:g}'
+                    lines.append(f'{name}_bucket{_labels(label_names + ("le",), labels + (le,))} {cumulative}')
+                lines.append(f'{name}_sum{_labels(label_names, labels)} {counts[-1]}')
+                lines.append(f'{name}_count{_labels(label_names, labels)} {cumulative}')
+
+        for name, help_text, fn in self._gauges:
+            try:
+                value = fn()
+            except Exception as e:
+                print(f"读取指标 {name} 失败：{e}")
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(names, values):
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,52 @@
+"""
+服务模式与阻塞调用卸载
+
+- threading（默认）：每个连接一个线程，阻塞调用直接执行
+- eventlet / gevent：协程模式，空闲连接只占一个协程；必须在导入其他模块之前 monkey_patch()，
+  SQLite 提交、日志写盘、文件保存等阻塞操作通过 run_blocking() 放到原生线程池，避免卡住事件循环
+"""
+ASYNC_MODES = ('threading', 'eventlet', 'gevent')
+
+_mode = 'threading'
+
+
+def monkey_patch(mode):
+    """按服务模式打补丁并记录当前模式，返回实际使用的模式"""
+    global _mode
+    if mode not in ASYNC_MODES:
+        raise ValueError(f'不支持的服务模式：{mode}（可选 {", ".join(ASYNC_MODES)}）')
+    if mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    _mode = mode
+    return mode
+
+
+def async_mode():
+    return _mode
+
+
+def native_get_ident():
+    """返回取原生线程 ID 的函数；协程模式下打过补丁的 threading.get_ident 返回的是协程 ID"""
+    if _mode == 'eventlet':
+        from eventlet import patcher
+        return patcher.original('_thread').get_ident
+    if _mode == 'gevent':
+        from gevent import monkey
+        return monkey.get_original('_thread', 'get_ident')
+    import threading
+    return threading.get_ident
+
+
+def run_blocking(fn, *args, **kwargs):
+    """在原生线程中执行阻塞调用；threading 模式下直接调用"""
+    if _mode == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(fn, *args, **kwargs)
+    if _mode == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
@@ -0,0 +1,417 @@
+"""
+持久化 - SQLite (WAL) 追加写事件日志 + 定期压缩快照
+
+- 房间/成员/消息/邀请码/用户的每次变更记为一条事件，由后台线程批量写入 events 表，
+  一个批次一次提交（组提交），处理函数只做入队，不承担写盘延迟
+- 定期把 events 折叠进快照表（users / rooms / members / invite_codes / messages）并清空已折叠的事件
+- 启动时先折叠尚未压缩的事件，再从快照表加载，重启不丢历史和邀请码
+- 消息本身就是只追加的，message_sent 在提交事务里直接写入 messages 表，历史分页可以立即读到
+"""
+import atexit
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+from offload import run_blocking
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    nickname TEXT NOT NULL,
+    avatar TEXT,
+    skin_path TEXT
+);
+CREATE TABLE IF NOT EXISTS rooms (
+    room_id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (
+    room_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (room_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS invite_codes (
+    code TEXT PRIMARY KEY,
+    room_id TEXT NOT NULL,
+    expires_at REAL,
+    max_uses INTEGER NOT NULL DEFAULT 0,
+    uses INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_invite_codes_room ON invite_codes (room_id);
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    room_id TEXT NOT NULL,
+    seq INTEGER,
+    payload TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+"""
+
+
+def _migrate(conn):
+    """旧库的 messages 表没有 seq 列：补上并按写入顺序编号；invite_codes 表补上有效期和次数列"""
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(invite_codes)')}
+    if 'expires_at' not in columns:
+        conn.execute('ALTER TABLE invite_codes ADD COLUMN expires_at REAL')
+        conn.execute('ALTER TABLE invite_codes ADD COLUMN max_uses INTEGER NOT NULL DEFAULT 0')
+        conn.execute('ALTER TABLE invite_codes ADD COLUMN uses INTEGER NOT NULL DEFAULT 0')
+
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(messages)')}
+    if 'seq' not in columns:
+        conn.execute('ALTER TABLE messages ADD COLUMN seq INTEGER')
+        conn.execute(
+            'UPDATE messages SET seq = (SELECT COUNT(*) FROM messages m '
+            'WHERE m.room_id = messages.room_id AND m.rowid <= messages.rowid)'
+        )
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_room_seq ON messages (room_id, seq)')
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=FULL')
+    conn.execute('PRAGMA foreign_keys=OFF')
+    return conn
+
+
+def _insert_message(conn, room_id, message, ts):
+    conn.execute(
+        'INSERT OR IGNORE INTO messages (id, room_id, seq, payload, ts) VALUES (?, ?, ?, ?, ?)',
+        (message['id'], room_id, message.get('seq'), json.dumps(message, ensure_ascii=False), ts)
+    )
+
+
+def _load_message(payload, seq):
+    message = json.loads(payload)
+    message.setdefault('seq', seq)
+    return message
+
+
+def _fold_event(conn, kind, data):
+    """把一条事件应用到快照表"""
+    if kind == 'user_created':
+        conn.execute(
+            'INSERT OR REPLACE INTO users (user_id, nickname, avatar, skin_path) VALUES (?, ?, NULL, NULL)',
+            (data['user_id'], data['nickname'])
+        )
+    elif kind == 'user_updated':
+        fields = {k: v for k, v in data.items() if k in ('avatar', 'skin_path', 'nickname')}
+        if fields:
+            assignments = ', '.join(f'{k} = ?' for k in fields)
+            conn.execute(f'UPDATE users SET {assignments} WHERE user_id = ?',
+                         (*fields.values(), data['user_id']))
+    elif kind in ('user_removed', 'user_expired'):
+        conn.execute('DELETE FROM users WHERE user_id = ?', (data['user_id'],))
+        conn.execute('DELETE FROM members WHERE user_id = ?', (data['user_id'],))
+    elif kind == 'room_created':
+        conn.execute(
+            'INSERT OR REPLACE INTO rooms (room_id, type, name, created_at) VALUES (?, ?, ?, ?)',
+            (data['room_id'], data['type'], data['name'], data['ts'])
+        )
+        conn.execute('INSERT OR IGNORE INTO members (room_id, user_id) VALUES (?, ?)',
+                     (data['room_id'], data['owner_id']))
+    elif kind == 'member_joined':
+        conn.execute('INSERT OR IGNORE INTO members (room_id, user_id) VALUES (?, ?)',
+                     (data['room_id'], data['user_id']))
+    elif kind == 'message_sent':
+        _insert_message(conn, data['room_id'], data['message'], data['ts'])
+    elif kind == 'room_deleted':
+        for table in ('rooms', 'members', 'invite_codes', 'messages'):
+            conn.execute(f'DELETE FROM {table} WHERE room_id = ?', (data['room_id'],))
+    elif kind == 'invite_code_added':
+        conn.execute(
+            'INSERT OR REPLACE INTO invite_codes (code, room_id, expires_at, max_uses, uses) VALUES (?, ?, ?, ?, 0)',
+            (data['code'], data['room_id'], data.get('expires_at'), data.get('max_uses') or 0)
+        )
+    elif kind == 'invite_code_used':
+        conn.execute('UPDATE invite_codes SET uses = uses + 1 WHERE code = ?', (data['code'],))
+    elif kind == 'invite_code_removed':
+        conn.execute('DELETE FROM invite_codes WHERE code = ?', (data['code'],))
+
+
+class ChatJournal:
+    """
+    聊天状态的持久化日志
+
+    record() 只把事件放进队列；后台线程把当时积压的所有事件放在一个事务里写入并提交，
+    并发量越大每次 fsync 摊到的事件越多。
+    """
+
+    def __init__(self, path, batch_size=1000, snapshot_interval=60.0, snapshot_events=20000):
+        self.path = path
+        self.batch_size = batch_size
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_events = snapshot_events
+
+        self.recorded = 0
+        self.committed = 0
+        self.commits = 0
+        self.snapshots = 0
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._local = threading.local()
+        self._since_snapshot = 0
+        self._last_snapshot = time.time()
+
+        conn = connect(path)
+        conn.executescript(SCHEMA)
+        _migrate(conn)
+        conn.close()
+
+    # ---------- 写入 ----------
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='chat-journal', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def record(self, kind, **data):
+        data['ts'] = time.time()
+        self._queue.put((kind, data))
+        self.recorded += 1
+
+    def close(self, timeout=5.0):
+        thread = self._thread
+        if thread is None:
+            return
+        self._thread = None
+        self._queue.put(None)
+        thread.join(timeout)
+
+    def _run(self):
+        conn = connect(self.path)
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=1.0)
+                except queue.Empty:
+                    run_blocking(self._maybe_snapshot, conn)
+                    continue
+
+                batch = [item]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stop = None in batch
+                batch = [entry for entry in batch if entry is not None]
+                # 提交和压缩会 fsync，协程模式下放到原生线程执行
+                if batch:
+                    run_blocking(self._commit, conn, batch)
+
+                if stop:
+                    run_blocking(self.compact, conn)
+                    return
+                run_blocking(self._maybe_snapshot, conn)
+        finally:
+            conn.close()
+
+    def _commit(self, conn, batch):
+        rows = []
+        messages = []
+        for kind, data in batch:
+            if kind == 'message_sent':
+                messages.append(data)
+                continue
+            try:
+                rows.append((kind, json.dumps(data, ensure_ascii=False), data['ts']))
+            except (TypeError, ValueError) as e:
+                print(f"持久化事件序列化失败：{kind} {e}")
+        try:
+            conn.execute('BEGIN')
+            conn.executemany('INSERT INTO events (kind, payload, ts) VALUES (?, ?, ?)', rows)
+            for data in messages:
+                try:
+                    _insert_message(conn, data['room_id'], data['message'], data['ts'])
+                except (TypeError, ValueError) as e:
+                    print(f"持久化消息序列化失败：{e}")
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            print(f"写入持久化日志失败：{e}")
+            try:
+                conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            return
+        self.committed += len(rows) + len(messages)
+        self.commits += 1
+        self._since_snapshot += len(rows)
+
+    def _maybe_snapshot(self, conn):
+        if not self._since_snapshot:
+            return
+        if (self._since_snapshot >= self.snapshot_events
+                or time.time() - self._last_snapshot >= self.snapshot_interval):
+            self.compact(conn)
+
+    # ---------- 快照 ----------
+
+    def compact(self, conn=None):
+        """把 events 折叠进快照表，删除已折叠的事件并截断 WAL"""
+        own_conn = conn is None
+        if own_conn:
+            conn = connect(self.path)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            last_seq = 0
+            for seq, kind, payload in conn.execute('SELECT seq, kind, payload FROM events ORDER BY seq'):
+                _fold_event(conn, kind, json.loads(payload))
+                last_seq = seq
+            if last_seq:
+                conn.execute('DELETE FROM events WHERE seq <= ?', (last_seq,))
+            conn.execute('COMMIT')
+            # 只有提交成功才算一次快照；失败时保留计数，下次写入后继续尝试
+            self.snapshots += 1
+            self._since_snapshot = 0
+            self._last_snapshot = time.time()
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error as e:
+            print(f"压缩持久化快照失败：{e}")
+            try:
+                conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+        finally:
+            if own_conn:
+                conn.close()
+
+    def load(self, history_limits):
+        """
+        启动时加载：先折叠未压缩的事件，再读取快照表
+        history_limits: room_type -> 每个房间加载的最近消息条数
+        """
+        self.compact()
+        conn = connect(self.path)
+        try:
+            users = {
+                user_id: {'nickname': nickname, 'avatar': avatar, 'skin_path': skin_path}
+                for user_id, nickname, avatar, skin_path in conn.execute(
+                    'SELECT user_id, nickname, avatar, skin_path FROM users')
+            }
+
+            rooms = {}
+            for room_id, room_type, name in conn.execute(
+                    'SELECT room_id, type, name FROM rooms ORDER BY created_at'):
+                rooms[room_id] = {'type': room_type, 'name': name, 'members': [], 'messages': [], 'last_seq': 0}
+
+            for room_id, user_id in conn.execute('SELECT room_id, user_id FROM members ORDER BY rowid'):
+                if room_id in rooms:
+                    rooms[room_id]['members'].append(user_id)
+
+            for room_id, room in rooms.items():
+                limit = history_limits.get(room['type'], 100)
+                rows = conn.execute(
+                    'SELECT payload, seq FROM messages WHERE room_id = ? ORDER BY seq DESC LIMIT ?',
+                    (room_id, limit)
+                ).fetchall()
+                room['messages'] = [_load_message(payload, seq) for payload, seq in reversed(rows)]
+                if rows:
+                    room['last_seq'] = rows[0][1] or 0
+
+            invite_codes = {}
+            invite_limits = {}
+            for code, room_id, expires_at, max_uses, uses in conn.execute(
+                    'SELECT code, room_id, expires_at, max_uses, uses FROM invite_codes'):
+                if room_id not in rooms:
+                    continue
+                invite_codes[code] = room_id
+                if expires_at or max_uses:
+                    invite_limits[code] = {'expires_at': expires_at, 'max_uses': max_uses, 'uses': uses}
+        finally:
+            conn.close()
+
+        return {'users': users, 'rooms': rooms, 'invite_codes': invite_codes, 'invite_limits': invite_limits}
+
+    # ---------- 历史查询 ----------
+
+    def _reader(self):
+        """每个请求线程一条只读连接，WAL 模式下读不阻塞后台写入"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect(self.path)
+            self._local.conn = conn
+        return conn
+
+    def _query(self, sql, params):
+        return run_blocking(lambda: self._reader().execute(sql, params).fetchall())
+
+    def message_seq(self, room_id, message_id):
+        rows = self._query('SELECT seq FROM messages WHERE id = ? AND room_id = ?', (message_id, room_id))
+        return rows[0][0] if rows else None
+
+    def messages_before(self, room_id, before_seq, limit):
+        """seq < before_seq 的最近 limit 条（按时间正序），before_seq 为 None 时取最新的"""
+        if before_seq is None:
+            rows = self._query(
+                'SELECT payload, seq FROM messages WHERE room_id = ? ORDER BY seq DESC LIMIT ?',
+                (room_id, limit)
+            )
+        else:
+            rows = self._query(
+                'SELECT payload, seq FROM messages WHERE room_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?',
+                (room_id, before_seq, limit)
+            )
+        return [_load_message(payload, seq) for payload, seq in reversed(rows)]
+
+    def messages_after(self, room_id, after_seq, before_seq, limit):
+        """after_seq < seq（< before_seq）的最早 limit 条（按时间正序）"""
+        if before_seq is None:
+            rows = self._query(
+                'SELECT payload, seq FROM messages WHERE room_id = ? AND seq > ? ORDER BY seq LIMIT ?',
+                (room_id, after_seq, limit)
+            )
+        else:
+            rows = self._query(
+                'SELECT payload, seq FROM messages WHERE room_id = ? AND seq > ? AND seq < ? ORDER BY seq LIMIT ?',
+                (room_id, after_seq, before_seq, limit)
+            )
+        return [_load_message(payload, seq) for payload, seq in rows]
+
+    def messages_by_seq(self, room_id, seqs):
+        """按 seq 批量读取消息，返回 seq -> 消息（搜索命中内存缓冲区之外的旧消息时使用）"""
+        seqs = list(seqs)
+        found = {}
+        # SQLite 默认最多 999 个绑定参数
+        for start in range(0, len(seqs), 500):
+            chunk = seqs[start:start + 500]
+            marks = ','.join('?' * len(chunk))
+            rows = self._query(
+                f'SELECT payload, seq FROM messages WHERE room_id = ? AND seq IN ({marks})',
+                (room_id, *chunk)
+            )
+            for payload, seq in rows:
+                found[seq] = _load_message(payload, seq)
+        return found
+
+    def iter_messages(self):
+        """按房间、seq 顺序逐条读出全部已持久化的消息，返回 (room_id, 消息)（启动时建立搜索索引）"""
+        conn = connect(self.path)
+        try:
+            for room_id, payload, seq in conn.execute(
+                    'SELECT room_id, payload, seq FROM messages ORDER BY room_id, seq'):
+                yield room_id, _load_message(payload, seq)
+        finally:
+            conn.close()
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'recorded': self.recorded,
+            'committed': self.committed,
+            'commits': self.commits,
+            'snapshots': self.snapshots
+        }
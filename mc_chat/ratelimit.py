@@ -0,0 +1,204 @@
+"""
+限流 - 按用户（socket / 客户端地址）和房间对高频事件做令牌桶限流
+
+每条规则是 (rate, burst)：每秒补充 rate 个令牌，最多攒 burst 个。
+- user：每个 socket 连接（HTTP 请求按客户端地址）每次事件消耗 1 个令牌
+- room：同一房间内所有人共享，每次事件消耗 1 个令牌
+- bytes：每个 socket / 客户端地址按负载字节数消耗令牌，即每秒字节数
+
+令牌在取用时按经过的时间惰性补充，不需要定时线程；长时间未使用（已补满）的桶定期顺带清理。
+一次事件涉及的多个桶要么全部扣除、要么都不扣除。
+多进程部署时房间桶和 HTTP 的桶可以放到消息总线上（broker.py 或 Redis）共享，socket 桶始终在本进程。
+"""
+import threading
+import time
+
+# 规则配置中的作用域
+SCOPES = ('user', 'room', 'bytes')
+
+
+def parse_limits(value):
+    """
+    解析限流配置：'send_message=5/20,send_message:room=30/60,upload_voice:bytes=262144/10485760'
+    -> {'send_message': {'user': (5.0, 20.0), 'room': (30.0, 60.0)}, ...}
+    作用域省略时为 user，burst 省略时等于 rate；rate 为 0 表示取消该规则
+    """
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return {event: dict(rules) for event, rules in value.items()}
+    limits = {}
+    for part in str(value).split(','):
+        if '=' not in part:
+            continue
+        name, spec = part.split('=', 1)
+        event, _, scope = name.strip().partition(':')
+        scope = scope or 'user'
+        if scope not in SCOPES:
+            continue
+        rate, _, burst = spec.partition('/')
+        try:
+            rate = float(rate)
+            burst = float(burst) if burst else rate
+        except ValueError:
+            continue
+        limits.setdefault(event, {})[scope] = (rate, max(burst, 1.0)) if rate > 0 else None
+    return limits
+
+
+def merge_limits(defaults, overrides):
+    """在默认规则上应用覆盖项（值为 None 的作用域被删除）"""
+    merged = {event: dict(rules) for event, rules in defaults.items()}
+    for event, rules in overrides.items():
+        target = merged.setdefault(event, {})
+        for scope, rule in rules.items():
+            if rule is None:
+                target.pop(scope, None)
+            else:
+                target[scope] = rule
+        if not target:
+            del merged[event]
+    return merged
+
+
+def payload_size(data):
+    """粗略估算事件负载的字节数：只累加字符串和二进制的长度，不做序列化"""
+    if isinstance(data, (str, bytes, bytearray)):
+        return len(data)
+    if isinstance(data, dict):
+        return sum(payload_size(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(payload_size(value) for value in data)
+    return 0
+
+
+class TokenBuckets:
+    """
+    内存中的令牌桶集合
+
+    take() 的 specs 为 [(key, rate, burst, cost), ...]；桶不存在时视为满的。
+    broker.py 也用它实现共享的限流计数。
+    """
+
+    def __init__(self, sweep_every=4096):
+        self.sweep_every = sweep_every
+        # key -> [令牌数, 上次补充时间, rate, burst]
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._ops = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, specs, now=None):
+        """令牌全部足够时一起扣除并返回 0，否则不扣除，返回最长需要等待的秒数"""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self._ops += 1
+            if self._ops % self.sweep_every == 0:
+                self._sweep(now)
+
+            levels = []
+            wait = 0.0
+            for key, rate, burst, cost in specs:
+                bucket = self._buckets.get(key)
+                tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * rate)
+                levels.append(tokens)
+                if tokens < cost:
+                    wait = max(wait, (cost - tokens) / rate)
+            if wait > 0:
+                return wait
+
+            for (key, rate, burst, cost), tokens in zip(specs, levels):
+                self._buckets[key] = [tokens - cost, now, rate, burst]
+            return 0.0
+
+    def refund(self, specs):
+        """归还 take() 扣除的令牌（跨后端的多桶取用失败时回滚）"""
+        with self._lock:
+            for key, rate, burst, cost in specs:
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    bucket[0] = min(burst, bucket[0] + cost)
+
+    def _sweep(self, now):
+        """删除已经补满的桶，与不存在的桶等价"""
+        for key in [key for key, (tokens, last, rate, burst) in self._buckets.items()
+                    if tokens + (now - last) * rate >= burst]:
+            del self._buckets[key]
+
+
+class RateLimiter:
+    """
+    按事件类型配置的限流器
+
+    check() 返回 0 表示放行，否则返回建议的重试等待秒数。
+    shared 为消息总线（需要 take(specs) 方法）时，房间桶和 HTTP 请求的桶经总线在所有工作进程间共享；
+    总线不可用时在 retry_interval 秒内退回本进程计数，避免每次检查都等待重连。
+    """
+
+    def __init__(self, rules, shared=None, retry_interval=5.0):
+        self.rules = rules
+        self.shared = shared
+        self.retry_interval = retry_interval
+        self.buckets = TokenBuckets()
+        self._shared_down_until = 0.0
+
+        self.allowed = 0
+        # 事件类型 -> 被拒绝次数
+        self.limited = {}
+
+    def measures(self, event):
+        """该事件是否按字节限流（调用方据此决定是否计算负载大小）"""
+        rules = self.rules.get(event)
+        return bool(rules) and 'bytes' in rules
+
+    def check(self, event, client_key, room_id=None, size=0, shared_client=False):
+        """
+        client_key 为 socket sid 或 HTTP 客户端地址；shared_client 为 True 时客户端的桶也在进程间共享
+        """
+        rules = self.rules.get(event)
+        if not rules:
+            return 0.0
+
+        local = []
+        shared = []
+        client_specs = shared if shared_client and self.shared is not None else local
+        if 'user' in rules:
+            client_specs.append((f'rl:{event}:u:{client_key}',) + rules['user'] + (1,))
+        if 'bytes' in rules and size > 0:
+            rate, burst = rules['bytes']
+            # 单次超过 burst 的负载在桶满时放行并耗尽令牌（大小上限由各处理函数单独检查）
+            client_specs.append((f'rl:{event}:b:{client_key}', rate, burst, min(size, burst)))
+        if 'room' in rules and room_id:
+            room_specs = shared if self.shared is not None else local
+            room_specs.append((f'rl:{event}:r:{room_id}',) + rules['room'] + (1,))
+
+        wait = self.buckets.take(local) if local else 0.0
+        if not wait and shared:
+            wait = self._take_shared(shared)
+            if wait:
+                self.buckets.refund(local)
+
+        if wait:
+            self.limited[event] = self.limited.get(event, 0) + 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def _take_shared(self, specs):
+        if time.monotonic() >= self._shared_down_until:
+            try:
+                return self.shared.take(specs)
+            except Exception as e:
+                print(f"共享限流不可用，{self.retry_interval:g} 秒内改用本进程计数：{e}")
+                self._shared_down_until = time.monotonic() + self.retry_interval
+        return self.buckets.take(specs)
+
+    def stats(self):
+        return {
+            'buckets': len(self.buckets),
+            'allowed': self.allowed,
+            'limited': dict(self.limited)
+        }
@@ -0,0 +1,241 @@
+"""
+消息搜索 - 按房间增量维护的倒排索引
+
+分词：拉丁字母和数字按连续的词（小写）切分，'/tp 100 64 -200' 得到 tp、100、64、200；
+中日韩文字切成相邻两字的 bigram，同时保留单字，只搜一个字时也能命中。语音消息没有文字，只参与筛选。
+
+每个房间一个 RoomIndex：词 -> {seq: 词频}，seq -> (user_id, type, 时间戳, 词数, 不重复的词)。
+索引全部在内存中：每个房间最多保留 max_messages 条（默认 50000），超出时淘汰最早加入的消息，
+更早的历史仍能按游标翻页读取，但搜不到。
+查询从最短的倒排表出发逐条检查其余词，耗时只与最稀有的词命中多少条有关，与历史总量无关；
+按 BM25 打分（同分时新消息在前），或按时间倒序（从最新的命中往前找，凑够一页即停）。
+按相关度排序时只给最新的 MAX_SCORED 条命中打分，很常见的词也不会扫描整个房间的历史。
+
+索引本身不加锁，由 ChatState 在对应房间的分段锁内调用。
+"""
+import heapq
+import math
+import re
+import sys
+from datetime import datetime
+
+# 拉丁字母（含带音调的字母）和数字组成的词，或连续的中日韩文字
+_RUNS = re.compile(r'[0-9a-z_À-ɏ]+|[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+')
+MAX_TOKEN_LENGTH = 32
+
+MESSAGE_TYPES = ('text', 'command', 'voice')
+SORTS = ('relevance', 'recent')
+
+# BM25 参数
+K1 = 1.2
+B = 0.75
+# 按相关度排序时最多打分的命中条数（从最新的往前）
+MAX_SCORED = 500
+# 每个房间默认最多索引的消息条数
+DEFAULT_MAX_MESSAGES = 50000
+
+
+def _is_cjk(run):
+    return run[0] >= '぀'
+
+
+def tokenize(text):
+    """索引用的词（含重复，用于计算词频）"""
+    tokens = []
+    for run in _RUNS.findall(text.casefold()):
+        if not _is_cjk(run):
+            tokens.append(run[:MAX_TOKEN_LENGTH])
+            continue
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def query_terms(text):
+    """查询用的词（去重）：两个字以上的中日韩文字只用 bigram，比单字精确"""
+    terms = []
+    for run in _RUNS.findall(text.casefold()):
+        if not _is_cjk(run):
+            terms.append(run[:MAX_TOKEN_LENGTH])
+        elif len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return list(dict.fromkeys(terms))
+
+
+def parse_time(value):
+    """筛选时间：Unix 秒数或 ISO 8601 字符串，空值返回 None，无法解析时抛出 ValueError"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(str(value)).timestamp()
+
+
+def _message_time(message):
+    try:
+        return datetime.fromisoformat(message['timestamp']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _message_tokens(message):
+    content = message.get('content')
+    if message.get('type') == 'voice' or not isinstance(content, str):
+        return []
+    return tokenize(content)
+
+
+class RoomIndex:
+    """一个房间的倒排表和消息元数据"""
+
+    __slots__ = ('postings', 'docs', 'total_length')
+
+    def __init__(self):
+        self.postings = {}
+        self.docs = {}
+        self.total_length = 0
+
+    def add(self, seq, user_id, message_type, ts, tokens):
+        if seq in self.docs:
+            return
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        # 同一个词在各条消息的元数据中共用一个字符串对象
+        terms = tuple(sys.intern(token) for token in counts)
+        postings = self.postings
+        for token, count in counts.items():
+            posting = postings.get(token)
+            if posting is None:
+                postings[token] = {seq: count}
+            else:
+                posting[seq] = count
+        self.docs[seq] = (user_id, message_type, ts, len(tokens), terms)
+        self.total_length += len(tokens)
+
+    def remove(self, seq):
+        doc = self.docs.pop(seq, None)
+        if doc is None:
+            return
+        self.total_length -= doc[3]
+        for token in doc[4]:
+            posting = self.postings.get(token)
+            if posting is not None:
+                posting.pop(seq, None)
+                if not posting:
+                    del self.postings[token]
+
+    def evict_oldest(self):
+        """淘汰最早加入索引的消息（docs 按插入顺序，基本即 seq 顺序）"""
+        self.remove(next(iter(self.docs)))
+
+    def search(self, terms, user_id=None, message_type=None, since=None, until=None,
+               sort='relevance', offset=0, limit=20):
+        """返回 ([(seq, 得分)], has_more)；按时间排序或没有查询词时得分为 None"""
+        lists = []
+        for term in terms:
+            posting = self.postings.get(term)
+            if not posting:
+                return [], False
+            lists.append(posting)
+        lists.sort(key=len)
+
+        wanted = offset + limit
+        matching = self._matching(lists, user_id, message_type, since, until)
+        if sort == 'recent' or not lists:
+            hits = []
+            for seq in matching:
+                hits.append(seq)
+                if len(hits) > wanted:
+                    break
+            return [(seq, None) for seq in hits[offset:wanted]], len(hits) > wanted
+
+        docs = self.docs
+        count = len(docs)
+        scale = B * count / (self.total_length or 1)
+        weights = [(posting, math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5)) * (K1 + 1))
+                   for posting in lists]
+        scored = []
+        for seq in matching:
+            norm = K1 * (1 - B + scale * docs[seq][3])
+            score = 0.0
+            for posting, weight in weights:
+                tf = posting[seq]
+                score += weight * tf / (tf + norm)
+            scored.append((score, seq))
+            if len(scored) >= MAX_SCORED:
+                break
+        top = heapq.nlargest(wanted + 1, scored)
+        return [(seq, round(score, 4)) for score, seq in top[offset:wanted]], len(top) > wanted
+
+    def _matching(self, lists, user_id, message_type, since, until):
+        """从新到旧逐条产出包含全部查询词且满足筛选条件的 seq（倒排表和元数据都按 seq 顺序插入）"""
+        docs = self.docs
+        rest = lists[1:]
+        filtered = user_id is not None or message_type is not None or since is not None or until is not None
+        for seq in reversed(lists[0] if lists else docs):
+            for posting in rest:
+                if seq not in posting:
+                    break
+            else:
+                if filtered:
+                    doc_user, doc_type, ts = docs[seq][:3]
+                    if user_id is not None and doc_user != user_id:
+                        continue
+                    if message_type is not None and doc_type != message_type:
+                        continue
+                    if since is not None and (ts is None or ts < since):
+                        continue
+                    if until is not None and (ts is None or ts > until):
+                        continue
+                yield seq
+
+
+class SearchIndex:
+    """全部房间的索引；max_messages 为每个房间最多索引的条数，0 为不限"""
+
+    def __init__(self, max_messages=DEFAULT_MAX_MESSAGES):
+        self.rooms = {}
+        self.max_messages = max_messages
+        self.queries = 0
+        self.evicted = 0
+
+    def add(self, room_id, message):
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = RoomIndex()
+        room.add(message['seq'], message.get('user_id'), message.get('type', 'text'),
+                 _message_time(message), _message_tokens(message))
+        if self.max_messages and len(room.docs) > self.max_messages:
+            room.evict_oldest()
+            self.evicted += 1
+
+    def remove(self, room_id, message):
+        room = self.rooms.get(room_id)
+        if room is not None:
+            room.remove(message['seq'])
+
+    def drop_room(self, room_id):
+        self.rooms.pop(room_id, None)
+
+    def search(self, room_id, terms, **options):
+        self.queries += 1
+        room = self.rooms.get(room_id)
+        if room is None:
+            return [], False
+        return room.search(terms, **options)
+
+    def stats(self):
+        rooms = list(self.rooms.values())
+        return {
+            'rooms': len(rooms),
+            'messages': sum(len(room.docs) for room in rooms),
+            'terms': sum(len(room.postings) for room in rooms),
+            'evicted': self.evicted,
+            'queries': self.queries
+        }
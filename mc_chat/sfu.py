@@ -0,0 +1,268 @@
+"""
+语音转发（SFU）模式 - 大群语音不再使用全连接 mesh
+
+mesh 模式下每个人都要把自己的音频上传 N-1 份，人数一多客户端上行带宽和 CPU 就撑不住。
+转发模式下每个客户端只和服务端建立一条 PeerConnection、上传一路音频，由服务端转给房间内其他参与者。
+
+基于 aiortc（需要 pip install aiortc），asyncio 事件循环运行在单独的线程中，
+Socket.IO 处理函数只把请求投递到该循环，应答和重新协商的 Offer 由 signal_fn 发回客户端。
+aiortc 的发送端会对每个订阅者重新编码 Opus，服务端 CPU 开销随 发布者 × 订阅者 增长。
+"""
+import asyncio
+import threading
+
+try:
+    from aiortc import RTCConfiguration, RTCIceServer, RTCPeerConnection, RTCSessionDescription
+    from aiortc.contrib.media import MediaRelay
+except ImportError:
+    RTCPeerConnection = None
+
+
+def sfu_available():
+    return RTCPeerConnection is not None
+
+
+class _Participant:
+    """一个客户端到服务端的 PeerConnection：上行一路音频，下行每个发布者一个 transceiver"""
+
+    __slots__ = ('user_id', 'sid', 'pc', 'track', 'senders', 'idle', 'negotiating', 'renegotiate')
+
+    def __init__(self, user_id, sid, pc):
+        self.user_id = user_id
+        self.sid = sid
+        self.pc = pc
+        self.track = None
+        # 发布者 user_id -> 下行 transceiver
+        self.senders = {}
+        # 发布者离开后空出的 transceiver，复用以免 SDP 中的 m-line 越来越多
+        self.idle = []
+        # 服务端发出的 Offer 尚未收到应答；期间的变更在应答后再协商一次
+        self.negotiating = False
+        self.renegotiate = False
+
+    def track_map(self):
+        return {
+            transceiver.mid: publisher_id
+            for publisher_id, transceiver in self.senders.items() if transceiver.mid
+        }
+
+
+class VoiceRelay:
+    """
+    语音转发器
+
+    客户端流程：
+        sfu_publish(offer)  ->  sfu_publish_answer(answer)
+        sfu_offer(offer, tracks)  <-  服务端增加下行音频时重新协商，客户端回复 sfu_answer
+        sfu_tracks(tracks)  <-  transceiver 与发布者的对应关系变化（mid -> user_id）
+    set_paused() 根据活跃发言人暂停转发静音的发布者，大群只转发正在说话的几路音频。
+    _rooms 只在事件循环线程中修改。
+    """
+
+    def __init__(self, signal_fn, ice_servers=()):
+        self.signal_fn = signal_fn
+        self.ice_servers = list(ice_servers)
+
+        self._rooms = {}
+        self._media = None
+        self._loop = None
+
+    def start(self):
+        if RTCPeerConnection is None:
+            raise RuntimeError('语音转发模式需要先安装 aiortc（pip install aiortc）')
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        threading.Thread(target=self._run, args=(ready,), name='voice-relay', daemon=True).start()
+        ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self._loop)
+        self._media = MediaRelay()
+        ready.set()
+        self._loop.run_forever()
+
+    def _submit(self, coro):
+        asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    # ==================== Socket.IO 处理线程调用 ====================
+
+    def is_active(self, room_id):
+        """房间内是否已有人通过服务端转发语音"""
+        return room_id in self._rooms
+
+    def publish(self, room_id, user_id, sid, offer):
+        self._submit(self._publish(room_id, user_id, sid, offer))
+
+    def answer(self, room_id, user_id, answer):
+        self._submit(self._answer(room_id, user_id, answer))
+
+    def leave(self, room_id, user_id):
+        self._submit(self._leave(room_id, user_id))
+
+    def leave_sid(self, sid):
+        """socket 断开时离开它所在的所有转发房间"""
+        self._submit(self._leave_sid(sid))
+
+    def close_room(self, room_id):
+        self._submit(self._close_room(room_id))
+
+    def set_paused(self, room_id, user_ids):
+        """暂停转发这些发布者的音频（不在活跃发言人中的静音用户），其余恢复转发"""
+        self._submit(self._set_paused(room_id, set(user_ids)))
+
+    def stats(self):
+        rooms = list(self._rooms.values())
+        return {
+            'rooms': len(rooms),
+            'participants': sum(len(participants) for participants in rooms),
+            'subscriptions': sum(
+                len(p.senders) for participants in rooms for p in list(participants.values())
+            )
+        }
+
+    # ==================== 事件循环线程 ====================
+
+    async def _publish(self, room_id, user_id, sid, offer):
+        participants = self._rooms.setdefault(room_id, {})
+        old = participants.pop(user_id, None)
+        if old is not None:
+            await self._drop(room_id, participants, old)
+
+        pc = RTCPeerConnection(RTCConfiguration(
+            iceServers=[RTCIceServer(urls=url) for url in self.ice_servers]
+        ))
+        me = _Participant(user_id, sid, pc)
+        participants[user_id] = me
+
+        @pc.on('track')
+        def on_track(track):
+            if track.kind == 'audio' and me.track is None:
+                me.track = track
+
+        @pc.on('connectionstatechange')
+        async def on_connection_state():
+            if pc.connectionState in ('failed', 'closed') and participants.get(user_id) is me:
+                await self._leave(room_id, user_id)
+
+        try:
+            await pc.setRemoteDescription(RTCSessionDescription(sdp=offer['sdp'], type=offer['type']))
+            await pc.setLocalDescription(await pc.createAnswer())
+        except Exception as e:
+            print(f"语音转发协商失败：{user_id} {e}")
+            participants.pop(user_id, None)
+            await pc.close()
+            if not participants:
+                self._rooms.pop(room_id, None)
+            self.signal_fn(sid, 'voice_error', {'message': '语音连接失败'})
+            return
+
+        self.signal_fn(sid, 'sfu_publish_answer', {
+            'room_id': room_id,
+            'answer': {'sdp': pc.localDescription.sdp, 'type': pc.localDescription.type}
+        })
+
+        # 新发布者的音频转给已有参与者，已有参与者的音频转给新发布者
+        for other in list(participants.values()):
+            if other is me:
+                continue
+            if me.track is not None:
+                await self._subscribe(room_id, other, me)
+            if other.track is not None:
+                await self._subscribe(room_id, me, other)
+
+    async def _subscribe(self, room_id, subscriber, publisher):
+        track = self._media.subscribe(publisher.track)
+        if subscriber.idle:
+            transceiver = subscriber.idle.pop()
+            transceiver.sender.replaceTrack(track)
+            subscriber.senders[publisher.user_id] = transceiver
+            self._send_tracks(room_id, subscriber)
+        else:
+            subscriber.senders[publisher.user_id] = subscriber.pc.addTransceiver(track, direction='sendonly')
+            await self._negotiate(room_id, subscriber)
+
+    async def _negotiate(self, room_id, participant):
+        if participant.negotiating:
+            participant.renegotiate = True
+            return
+        participant.negotiating = True
+        participant.renegotiate = False
+        pc = participant.pc
+        await pc.setLocalDescription(await pc.createOffer())
+        self.signal_fn(participant.sid, 'sfu_offer', {
+            'room_id': room_id,
+            'offer': {'sdp': pc.localDescription.sdp, 'type': pc.localDescription.type},
+            'tracks': participant.track_map()
+        })
+
+    async def _answer(self, room_id, user_id, answer):
+        participant = self._rooms.get(room_id, {}).get(user_id)
+        if participant is None or not participant.negotiating:
+            return
+        try:
+            await participant.pc.setRemoteDescription(
+                RTCSessionDescription(sdp=answer['sdp'], type=answer['type'])
+            )
+        except Exception as e:
+            print(f"语音转发重新协商失败：{user_id} {e}")
+            await self._leave(room_id, user_id)
+            return
+        participant.negotiating = False
+        if participant.renegotiate:
+            await self._negotiate(room_id, participant)
+
+    def _send_tracks(self, room_id, participant):
+        self.signal_fn(participant.sid, 'sfu_tracks', {
+            'room_id': room_id,
+            'tracks': participant.track_map()
+        })
+
+    async def _leave(self, room_id, user_id):
+        participants = self._rooms.get(room_id)
+        if not participants or user_id not in participants:
+            return
+        await self._drop(room_id, participants, participants.pop(user_id))
+        if not participants:
+            del self._rooms[room_id]
+
+    async def _drop(self, room_id, participants, participant):
+        """停止转发该参与者的音频，空出的 transceiver 留给之后的发布者"""
+        for other in participants.values():
+            transceiver = other.senders.pop(participant.user_id, None)
+            if transceiver is None:
+                continue
+            track = transceiver.sender.track
+            transceiver.sender.replaceTrack(None)
+            if track is not None:
+                track.stop()
+            other.idle.append(transceiver)
+            self._send_tracks(room_id, other)
+        await participant.pc.close()
+
+    async def _set_paused(self, room_id, paused):
+        participants = self._rooms.get(room_id)
+        if not participants:
+            return
+        for subscriber in participants.values():
+            for publisher_id, transceiver in subscriber.senders.items():
+                publisher = participants.get(publisher_id)
+                if publisher is None or publisher.track is None:
+                    continue
+                track = transceiver.sender.track
+                # 暂停时停止订阅，MediaRelay 不再为该订阅者缓存帧，发送端也不再编码
+                if publisher_id in paused and track is not None:
+                    transceiver.sender.replaceTrack(None)
+                    track.stop()
+                elif publisher_id not in paused and track is None:
+                    transceiver.sender.replaceTrack(self._media.subscribe(publisher.track))
+
+    async def _leave_sid(self, sid):
+        for room_id, participants in list(self._rooms.items()):
+            for user_id, participant in list(participants.items()):
+                if participant.sid == sid:
+                    await self._leave(room_id, user_id)
+
+    async def _close_room(self, room_id):
+        participants = self._rooms.pop(room_id, None)
+        for participant in (participants or {}).values():
+            await participant.pc.close()
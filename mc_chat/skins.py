@@ -0,0 +1,351 @@
+"""
+皮肤处理 - 从皮肤 PNG 中截取 8x8 脸部并放大为 64x64 头像
+上传的请求体边读边解析，皮肤的 PNG 文件头一到就校验尺寸，不合法或超过上限时不再读取剩余部分；
+合法的皮肤再在独立进程池中解码、重新编码为压缩后的 PNG 并生成头像，不占用请求线程。
+皮肤按重新编码后的内容哈希保存，上传内容的哈希只用来识别重复上传。
+"""
+import os
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NEED_DATA
+
+from offload import run_blocking
+from storage import ContentStore, content_digest, is_digest
+
+AVATAR_SIZE = 64
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# 签名(8) + IHDR 长度(4) + 类型(4) + 宽(4) + 高(4)
+PNG_HEADER_SIZE = 24
+
+# 合法皮肤宽度：标准 64 以及高清倍数；高度等于宽度，或旧版 64x32 格式的一半
+SKIN_WIDTHS = (64, 128, 256, 512)
+MAX_SKIN_WIDTH = SKIN_WIDTHS[-1]
+
+# 超过该像素数 Pillow 直接拒绝解码（解压炸弹保护）
+Image.MAX_IMAGE_PIXELS = MAX_SKIN_WIDTH * MAX_SKIN_WIDTH
+
+
+# 上传表单中普通字段的长度上限
+MAX_FORM_FIELD = 1024
+
+
+class SkinValidationError(ValueError):
+    pass
+
+
+class SkinTooLargeError(SkinValidationError):
+    pass
+
+
+def read_png_size(header):
+    """只解析 PNG 签名和 IHDR 块，返回 (宽, 高)，不解码图像数据"""
+    if len(header) < PNG_HEADER_SIZE or header[:8] != PNG_SIGNATURE:
+        raise SkinValidationError('不是有效的 PNG 文件')
+    length, chunk_type, width, height = struct.unpack('>I4sII', header[8:PNG_HEADER_SIZE])
+    if chunk_type != b'IHDR' or length != 13:
+        raise SkinValidationError('不是有效的 PNG 文件')
+    return width, height
+
+
+def is_valid_skin_size(width, height):
+    return width in SKIN_WIDTHS and height in (width, width // 2)
+
+
+def validate_skin_header(header):
+    """校验 PNG 文件头中的尺寸是否为合法皮肤尺寸，返回 (宽, 高)"""
+    width, height = read_png_size(header)
+    if not is_valid_skin_size(width, height):
+        raise SkinValidationError(f'皮肤尺寸 {width}x{height} 无效，仅支持 64x64、64x32 及其高清倍数')
+    return width, height
+
+
+def read_skin_form(stream, boundary, max_bytes, chunk_size=16 * 1024):
+    """
+    边读边解析 multipart/form-data 请求体，返回 (字段 dict, 皮肤文件名, 皮肤字节)
+
+    只保留名为 skin 的文件；收到前 PNG_HEADER_SIZE 字节时立即校验 PNG 文件头，
+    不合法时抛出 SkinValidationError，超过 max_bytes 时抛出 SkinTooLargeError，剩余请求体都不再读取。
+    请求体格式错误或被截断时抛出 SkinValidationError。
+    """
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+    fields = {}
+    filename = None
+    skin = None
+    part = None
+    buffer = bytearray()
+    checked = False
+    try:
+        while True:
+            event = decoder.next_event()
+            if event is NEED_DATA:
+                decoder.receive_data(stream.read(chunk_size) or None)
+            elif isinstance(event, (Field, File)):
+                part = event
+                buffer = bytearray()
+                checked = False
+            elif isinstance(event, Data):
+                is_skin = isinstance(part, File) and part.name == 'skin'
+                if is_skin or isinstance(part, Field):
+                    buffer += event.data
+                if is_skin:
+                    if len(buffer) > max_bytes:
+                        raise SkinTooLargeError('皮肤文件过大')
+                    if not checked and len(buffer) >= PNG_HEADER_SIZE:
+                        validate_skin_header(bytes(buffer[:PNG_HEADER_SIZE]))
+                        checked = True
+                elif len(buffer) > MAX_FORM_FIELD:
+                    raise SkinValidationError('表单字段过长')
+                if not event.more_data:
+                    if is_skin:
+                        if not checked:
+                            validate_skin_header(bytes(buffer))
+                        filename = part.filename
+                        skin = bytes(buffer)
+                    elif isinstance(part, Field):
+                        fields[part.name] = buffer.decode('utf-8', 'replace')
+            elif isinstance(event, Epilogue):
+                return fields, filename, skin
+    except ValueError as e:
+        if isinstance(e, SkinValidationError):
+            raise
+        raise SkinValidationError('上传内容格式错误') from e
+
+
+def open_skin(skin_bytes):
+    """解码皮肤并再次确认实际尺寸"""
+    img = Image.open(BytesIO(skin_bytes))
+    if img.format != 'PNG' or not is_valid_skin_size(*img.size):
+        raise SkinValidationError('皮肤尺寸无效')
+    img.load()
+    return img
+
+
+def normalize_skin(img):
+    """重新编码为压缩后的 RGBA PNG，去掉多余的元数据块"""
+    buffer = BytesIO()
+    img.convert('RGBA').save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def render_avatar(img):
+    """截取脸部（按高清倍数缩放坐标）并返回 64x64 头像 PNG 字节"""
+    scale = img.width // 64
+    face = img.crop((8 * scale, 8 * scale, 16 * scale, 16 * scale))
+    avatar = face.resize((AVATAR_SIZE, AVATAR_SIZE), Image.NEAREST)
+    buffer = BytesIO()
+    avatar.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def process_skin(skin_bytes, skin_root):
+    """
+    工作进程入口：解码一次，保存规范化后的皮肤并生成头像，返回 (皮肤哈希, 头像 PNG 字节)
+    皮肤哈希是实际保存的字节的哈希；必须是模块级函数，才能被进程池序列化
+    """
+    img = open_skin(skin_bytes)
+    skin_hash, _ = ContentStore(skin_root, '.png').put(normalize_skin(img))
+    return skin_hash, render_avatar(img)
+
+
+def migrate_legacy_skins(store):
+    """
+    把旧版以 <uuid>_<原文件名>.png 保存的皮肤规范化后按内容哈希存入 store 并删除旧文件，
+    返回 {旧路径: 新路径}；不是合法皮肤的旧文件保留原样
+    """
+    moved = {}
+    skipped = 0
+    try:
+        names = os.listdir(store.root)
+    except FileNotFoundError:
+        return moved
+    for name in names:
+        stem, ext = os.path.splitext(name)
+        if ext.lower() != '.png' or is_digest(stem):
+            continue
+        path = os.path.join(store.root, name)
+        try:
+            with open(path, 'rb') as f:
+                img = open_skin(f.read())
+            digest, _ = store.put(normalize_skin(img))
+            os.remove(path)
+        except FileNotFoundError:
+            # 多个工作进程同时启动时已被其他进程迁移
+            continue
+        except Exception:
+            skipped += 1
+            continue
+        moved[path] = store.path(digest)
+    if skipped:
+        print(f"{skipped} 个旧版皮肤文件不是合法皮肤，未迁移")
+    return moved
+
+
+class SkinAliases:
+    """上传内容哈希 -> 保存后的皮肤哈希，容量有限的 LRU（重复上传同一文件时跳过解码）"""
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, upload_hash):
+        with self._lock:
+            skin_hash = self._items.get(upload_hash)
+            if skin_hash is not None:
+                self._items.move_to_end(upload_hash)
+            return skin_hash
+
+    def put(self, upload_hash, skin_hash):
+        with self._lock:
+            self._items[upload_hash] = skin_hash
+            self._items.move_to_end(upload_hash)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+
+class SkinJobQueue:
+    """
+    有界的皮肤处理队列
+
+    - 同时排队+执行的任务不超过 max_pending，超出时 submit 返回 None（背压）
+    - 同一上传内容正在处理时复用同一个任务
+    - 任务完成后 job['skin_hash'] 为保存后的皮肤哈希，再调用 on_done(job, 头像字节)，由调用方写入头像缓存并推送 skin_ready
+    - offload=True 时不使用进程池，改为在协程中经 run_blocking 交给原生线程池
+      （eventlet 补丁与 ProcessPoolExecutor 的管理线程不兼容）
+    """
+
+    def __init__(self, max_workers=2, max_pending=32, use_processes=True, job_ttl=600, offload=False):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.use_processes = use_processes
+        self.job_ttl = job_ttl
+        self.offload = offload
+
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+
+        self._executor = None
+        self._jobs = {}
+        self._inflight = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='skin-worker')
+        return self._executor
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def submit(self, user_id, upload_hash, skin_bytes, skin_root, on_done):
+        """提交任务，返回 job 字典；队列已满时返回 None"""
+        with self._lock:
+            self._prune()
+
+            job_id = self._inflight.get(upload_hash)
+            if job_id is not None:
+                job = self._jobs[job_id]
+                job['user_ids'].append(user_id)
+                return job
+
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                return None
+
+            job = {
+                'job_id': uuid.uuid4().hex,
+                'upload_hash': upload_hash,
+                'skin_hash': None,
+                'user_ids': [user_id],
+                'status': 'processing',
+                'avatar': None,
+                'error': None,
+                'created': time.time()
+            }
+            self._jobs[job['job_id']] = job
+            self._inflight[upload_hash] = job['job_id']
+            self._pending += 1
+            self.submitted += 1
+
+        if self.offload:
+            threading.Thread(
+                target=self._run_offloaded, args=(job, skin_bytes, skin_root, on_done),
+                daemon=True
+            ).start()
+            return job
+
+        try:
+            future = self._get_executor().submit(process_skin, skin_bytes, skin_root)
+        except Exception as e:
+            self._finish(job, None, e, on_done)
+            return job
+
+        future.add_done_callback(lambda f: self._finish(job, f, None, on_done))
+        return job
+
+    def _run_offloaded(self, job, skin_bytes, skin_root, on_done):
+        future = Future()
+        try:
+            future.set_result(run_blocking(process_skin, skin_bytes, skin_root))
+        except Exception as e:
+            future.set_exception(e)
+        self._finish(job, future, None, on_done)
+
+    def _finish(self, job, future, error, on_done):
+        avatar_bytes = None
+        if error is None:
+            try:
+                job['skin_hash'], avatar_bytes = future.result()
+            except Exception as e:
+                error = e
+
+        with self._lock:
+            self._pending -= 1
+            self._inflight.pop(job['upload_hash'], None)
+            job['finished'] = time.time()
+            if error is not None:
+                self.failed += 1
+                job['status'] = 'failed'
+                job['error'] = str(error)
+
+        try:
+            on_done(job, avatar_bytes)
+        except Exception as e:
+            print(f"皮肤处理回调失败：{e}")
+
+    def _prune(self):
+        cutoff = time.time() - self.job_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.get('finished') and job['finished'] < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def stats(self):
+        return {
+            'pending': self._pending,
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'failed': self.failed
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,108 @@
+"""
+活跃发言人 - 按客户端上报的音量统计每个语音房间的前 K 个发言人
+
+客户端通过 voice_levels 上报本地麦克风音量（0~1），这里对每个用户做指数平滑，
+后台线程每 interval 秒计算一次各房间的前 K 名，名单变化时才调用 flush_fn 广播，
+因此每个房间的 active_speakers 事件频率不超过 1 / interval。
+"""
+import threading
+import time
+
+
+class ActiveSpeakers:
+    """
+    每个房间的活跃发言人
+
+    flush_fn(room_id, speakers) 中 speakers 为 [[user_id, level], ...]，按音量从大到小排列；
+    超过 stale 秒没有上报的用户视为已静音。
+    """
+
+    def __init__(self, flush_fn, top_k=3, interval=0.25, threshold=0.02, smoothing=0.5, stale=2.0):
+        self.flush_fn = flush_fn
+        self.top_k = top_k
+        self.interval = interval
+        self.threshold = threshold
+        self.smoothing = smoothing
+        self.stale = stale
+
+        self.reports = 0
+        self.broadcasts = 0
+
+        # room_id -> {user_id: [平滑后的音量, 最后上报时间]}
+        self._levels = {}
+        # room_id -> 上次广播的发言人 ID
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def report(self, room_id, user_id, level):
+        now = time.monotonic()
+        with self._lock:
+            levels = self._levels.setdefault(room_id, {})
+            entry = levels.get(user_id)
+            if entry is None:
+                levels[user_id] = [level, now]
+            else:
+                entry[0] += (level - entry[0]) * self.smoothing
+                entry[1] = now
+            self.reports += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='active-speakers', daemon=True)
+                self._thread.start()
+
+    def remove(self, room_id, user_id):
+        with self._lock:
+            levels = self._levels.get(room_id)
+            if levels is not None:
+                levels.pop(user_id, None)
+
+    def clear_room(self, room_id):
+        with self._lock:
+            self._levels.pop(room_id, None)
+            self._active.pop(room_id, None)
+
+    def reporters(self, room_id):
+        """最近上报过音量的用户（未上报的客户端不参与转发暂停）"""
+        with self._lock:
+            return set(self._levels.get(room_id, ()))
+
+    def active(self, room_id):
+        with self._lock:
+            return list(self._active.get(room_id, ()))
+
+    def stats(self):
+        return {
+            'rooms': len(self._levels),
+            'reports': self.reports,
+            'broadcasts': self.broadcasts
+        }
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            changed = []
+            now = time.monotonic()
+            with self._lock:
+                for room_id, levels in list(self._levels.items()):
+                    for user_id in [uid for uid, (_, seen) in levels.items() if now - seen > self.stale]:
+                        del levels[user_id]
+
+                    ranked = sorted(
+                        ((uid, level) for uid, (level, _) in levels.items() if level >= self.threshold),
+                        key=lambda item: item[1], reverse=True
+                    )[:self.top_k]
+                    active = tuple(uid for uid, _ in ranked)
+                    if active != self._active.get(room_id, ()):
+                        self._active[room_id] = active
+                        changed.append((room_id, [[uid, round(level, 2)] for uid, level in ranked]))
+
+                    if not levels:
+                        del self._levels[room_id]
+                        self._active.pop(room_id, None)
+
+            for room_id, speakers in changed:
+                self.broadcasts += 1
+                try:
+                    self.flush_fn(room_id, speakers)
+                except Exception as e:
+                    print(f"广播活跃发言人失败：{e}")
@@ -0,0 +1,871 @@
+"""
+内存状态存储 - 用户 / 房间 / 邀请码 / WebRTC 对等表
+维护反向索引，断线、删房、成员判断都是常数时间
+"""
+import secrets
+import threading
+import time
+
+from history import MessageHistory
+
+# 每种房间保留的历史消息条数
+DEFAULT_HISTORY_CAPACITY = {'private': 100, 'group': 100}
+
+
+class ChatState:
+    """
+    聊天室全部内存状态
+
+    主表：
+        users        user_id -> {nickname, skin_path, avatar, socket_id}
+        rooms        room_id -> {type, name, members: {user_id: None}, messages: MessageHistory, last_seq}
+        user_rooms   user_id -> {room_id: None}
+        room_peers   room_id -> {user_id: socket_id}
+        room_voice   room_id -> {user_id: None}  正在语音中的用户，与聊天成员分开
+        invite_codes 短邀请码 -> room_id
+        invite_limits 短邀请码 -> {expires_at, max_uses, uses}  有效期（Unix 时间，None 为不过期）与次数上限（0 为不限）
+        resume_tokens 断线重连令牌 -> user_id
+
+    反向索引：
+        _sid_users   socket_id -> user_id
+        _room_codes  room_id -> {邀请码}
+        user_voice   user_id -> {room_id: None}
+        _user_tokens user_id -> 断线重连令牌
+
+    members / user_rooms 用 dict 充当有序集合：保持加入顺序，增删查均为 O(1)。
+
+    并发（async_mode='threading' 下处理函数会在多个线程同时执行）：
+        _users_lock  全局短锁，只保护 users / _sid_users / user_rooms / 重连令牌
+        _codes_lock  保护 invite_codes / _room_codes
+        room_lock()  按 room_id 分段的可重入锁，保护单个房间的成员、消息和对等表
+    加锁顺序固定为「房间锁 -> 用户锁」，且同一时刻最多持有一把房间锁，
+    不同房间的操作互不阻塞。对外返回的都是快照，调用方在锁外 emit。
+
+    持久化：传入 journal（见 persistence.ChatJournal）后，每次变更在持有对应锁时记一条事件，
+    同一房间内的事件顺序与内存中的顺序一致；journal 只负责入队，不在锁内写盘。
+
+    多进程：传入 cluster（见 cluster.ClusterLink）后，同样的事件连同 socket 绑定等临时变更
+    一起发布给其他工作进程，对方用 apply() 重放；消息 seq 改由 cluster 统一分配。
+    journal_remote 为 True 时重放的事件也写入本进程的 journal（每个节点使用独立数据库时）。
+    新加入或漏收了事件的进程用 export_snapshot() / merge_snapshot() 从其他进程补齐全量状态。
+
+    搜索：传入 search（见 search.SearchIndex）后，消息在追加时于房间锁内写入倒排索引。
+    有 journal 时被挤出环形缓冲区的旧消息仍留在索引里，命中后从 journal 读取；
+    没有 journal 时随淘汰一并移出索引。
+    """
+
+    def __init__(self, lock_stripes=64, history_capacity=None, journal=None,
+                 cluster=None, journal_remote=False, search=None):
+        self.history_capacity = dict(DEFAULT_HISTORY_CAPACITY)
+        self.history_capacity.update(history_capacity or {})
+        self.journal = journal
+        self.cluster = cluster
+        self.journal_remote = journal_remote
+        self.search = search
+        self._applying = threading.local()
+
+        self.users = {}
+        self.rooms = {}
+        self.user_rooms = {}
+        self.room_peers = {}
+        self.room_voice = {}
+        self.user_voice = {}
+        self.invite_codes = {}
+        self.invite_limits = {}
+        self.resume_tokens = {}
+        self._sid_users = {}
+        self._room_codes = {}
+        self._user_tokens = {}
+
+        self._users_lock = threading.Lock()
+        self._codes_lock = threading.Lock()
+        self._room_locks = [threading.RLock() for _ in range(lock_stripes)]
+
+    def room_lock(self, room_id):
+        """返回 room_id 对应的分段锁"""
+        return self._room_locks[hash(room_id) % len(self._room_locks)]
+
+    def _record(self, kind, durable=True, **data):
+        """记录一次变更：durable 的写入 journal，全部发布给其他工作进程（重放时不再发布）"""
+        if getattr(self._applying, 'active', False):
+            if durable and self.journal_remote and self.journal is not None:
+                self.journal.record(kind, **data)
+            return
+        if durable and self.journal is not None:
+            self.journal.record(kind, **data)
+        if self.cluster is not None:
+            self.cluster.publish(kind, data)
+
+    def apply(self, kind, data):
+        """重放其他工作进程发布的变更"""
+        handler = self._APPLY.get(kind)
+        if handler is None:
+            return
+        self._replay(handler, self, data)
+
+    def _replay(self, fn, *args):
+        """以重放方式执行：期间的变更不再发布给其他工作进程"""
+        self._applying.active = True
+        try:
+            return fn(*args)
+        finally:
+            self._applying.active = False
+
+    _APPLY = {
+        'user_created': lambda s, d: s.add_user(d['user_id'], d['nickname']),
+        'user_updated': lambda s, d: s.update_user(
+            d['user_id'], **{k: v for k, v in d.items() if k != 'user_id'}),
+        'user_removed': lambda s, d: s.remove_user(d['user_id']),
+        # 发起清理的进程已按集群的在线状态判断过，这里不再检查本地是否在线，否则各进程的状态会分叉
+        'user_expired': lambda s, d: s._remove_user(d['user_id'], 'user_expired', offline_only=False),
+        'socket_bound': lambda s, d: s.bind_socket(d['user_id'], d['sid']),
+        'resume_token_issued': lambda s, d: s.issue_resume_token(d['user_id'], d['token']),
+        'room_created': lambda s, d: s.create_room(
+            d['room_id'], d['type'], d['name'], d['owner_id'], d.get('owner_sid')),
+        'member_joined': lambda s, d: s.add_member(d['room_id'], d['user_id'], d.get('sid')),
+        'message_sent': lambda s, d: s.append_message(d['room_id'], d['message']),
+        'room_deleted': lambda s, d: s.delete_room(d['room_id']),
+        'invite_code_added': lambda s, d: s.add_invite_code(
+            d['code'], d['room_id'], d.get('expires_at'), d.get('max_uses', 0)),
+        'invite_code_used': lambda s, d: s.use_invite_code(d['code']),
+        'invite_code_removed': lambda s, d: s.remove_invite_code(d['code']),
+        'peer_set': lambda s, d: s.set_peer(d['room_id'], d['user_id'], d['sid']),
+        'peer_removed': lambda s, d: s.remove_peer(d['room_id'], d['user_id']),
+        'voice_joined': lambda s, d: s.join_voice(d['room_id'], d['user_id']),
+        'voice_left': lambda s, d: s.leave_voice(d['room_id'], d['user_id']),
+    }
+
+    def restore(self, snapshot):
+        """从持久化快照恢复用户、房间、历史消息和邀请码（启动时调用，不再写回 journal）"""
+        for user_id, fields in snapshot['users'].items():
+            user = dict(fields)
+            user['socket_id'] = None
+            self.users[user_id] = user
+
+        for room_id, data in snapshot['rooms'].items():
+            messages = MessageHistory(self.history_capacity.get(data['type'], 100))
+            for message in data['messages']:
+                messages.append(message)
+            members = {uid: None for uid in data['members'] if uid in self.users}
+            self.rooms[room_id] = {
+                'type': data['type'],
+                'name': data['name'],
+                'members': members,
+                'messages': messages,
+                'last_seq': data['last_seq']
+            }
+            self.room_peers[room_id] = {}
+            for uid in members:
+                self.user_rooms.setdefault(uid, {})[room_id] = None
+
+        for code, room_id in snapshot['invite_codes'].items():
+            self.invite_codes[code] = room_id
+            self._room_codes.setdefault(room_id, set()).add(code)
+        for code, limits in snapshot.get('invite_limits', {}).items():
+            if code in self.invite_codes:
+                self.invite_limits[code] = dict(limits)
+
+    # ==================== 集群同步 ====================
+
+    def export_snapshot(self, session_user_ids):
+        """
+        导出全量快照，供新加入或漏收了事件的工作进程合并（见 merge_snapshot）
+        session_user_ids 为由本进程负责的会话，只有它们的 socket 绑定、重连令牌、对等表和语音在线会导出
+        """
+        sessions = {}
+        with self._users_lock:
+            users = {uid: {'nickname': user['nickname'], 'skin_path': user.get('skin_path'),
+                           'avatar': user.get('avatar')}
+                     for uid, user in self.users.items()}
+            for uid in session_user_ids:
+                user = self.users.get(uid)
+                if user is not None:
+                    sessions[uid] = {
+                        'sid': user.get('socket_id'),
+                        'token': self._user_tokens.get(uid),
+                        'peers': {},
+                        'voice': list(self.user_voice.get(uid, ()))
+                    }
+
+        rooms = {}
+        for room_id in list(self.rooms):
+            with self.room_lock(room_id):
+                room = self.rooms.get(room_id)
+                if room is None:
+                    continue
+                rooms[room_id] = {
+                    'type': room['type'],
+                    'name': room['name'],
+                    'members': list(room['members']),
+                    'messages': list(room['messages']),
+                    'last_seq': room['last_seq']
+                }
+                for uid, sid in self.room_peers.get(room_id, {}).items():
+                    if sid and uid in sessions:
+                        sessions[uid]['peers'][room_id] = sid
+
+        with self._codes_lock:
+            invite_codes = dict(self.invite_codes)
+            invite_limits = {code: dict(limits) for code, limits in self.invite_limits.items()}
+        return {'users': users, 'rooms': rooms, 'invite_codes': invite_codes,
+                'invite_limits': invite_limits, 'sessions': sessions}
+
+    def merge_snapshot(self, snapshot, removed=None):
+        """
+        合并其他工作进程导出的快照，返回快照中由对方负责的会话的用户 ID
+
+        用户、房间、成员、消息和邀请码只补齐本地缺少的部分（不会覆盖已有房间），
+        removed(('user' | 'room' | 'invite', ID)) 为 True 的对象已被删除，不再补回；
+        sessions 中的 socket 绑定、重连令牌、对等表和语音在线以对方为准。
+        """
+        return self._replay(self._merge_snapshot, snapshot, removed or (lambda key: False))
+
+    def _merge_snapshot(self, snapshot, removed):
+        sessions = snapshot['sessions']
+        for uid, fields in snapshot['users'].items():
+            user = self.users.get(uid)
+            if user is None:
+                if removed(('user', uid)):
+                    continue
+                user = self.add_user(uid, fields['nickname'])
+            elif uid not in sessions:
+                continue
+            changes = {k: v for k, v in fields.items() if user.get(k) != v}
+            if changes:
+                self.update_user(uid, **changes)
+
+        for room_id, data in snapshot['rooms'].items():
+            if removed(('room', room_id)):
+                continue
+            members = [uid for uid in data['members'] if uid in self.users]
+            with self.room_lock(room_id):
+                room = self.rooms.get(room_id)
+                if room is None:
+                    if not members:
+                        continue
+                    room = {
+                        'type': data['type'],
+                        'name': data['name'],
+                        'members': {members[0]: None},
+                        'messages': MessageHistory(self.history_capacity.get(data['type'], 100)),
+                        'last_seq': 0
+                    }
+                    self.rooms[room_id] = room
+                    self.room_peers.setdefault(room_id, {})
+                    self._record('room_created', room_id=room_id, type=data['type'], name=data['name'],
+                                 owner_id=members[0], owner_sid=None)
+                    with self._users_lock:
+                        self.user_rooms.setdefault(members[0], {})[room_id] = None
+                for uid in members:
+                    if uid in room['members']:
+                        continue
+                    with self._users_lock:
+                        if uid not in self.users:
+                            continue
+                        self.user_rooms.setdefault(uid, {})[room_id] = None
+                    room['members'][uid] = None
+                    self._record('member_joined', room_id=room_id, user_id=uid, sid=None)
+                for message in data['messages']:
+                    self.append_message(room_id, dict(message))
+                room['last_seq'] = max(room['last_seq'], data['last_seq'])
+
+        for code, room_id in snapshot['invite_codes'].items():
+            limits = snapshot['invite_limits'].get(code)
+            if code not in self.invite_codes:
+                if removed(('invite', code)) or room_id not in self.rooms:
+                    continue
+                self.add_invite_code(code, room_id, limits and limits['expires_at'],
+                                     limits['max_uses'] if limits else 0)
+            if limits:
+                with self._codes_lock:
+                    local = self.invite_limits.get(code)
+                    if local is not None:
+                        local['uses'] = max(local['uses'], limits['uses'])
+
+        for uid, session in sessions.items():
+            if not self.bind_socket(uid, session['sid']):
+                continue
+            if session['token']:
+                self.issue_resume_token(uid, session['token'])
+            for room_id in self.rooms_of(uid):
+                sid = session['peers'].get(room_id)
+                if sid:
+                    self.set_peer(room_id, uid, sid)
+                else:
+                    self.remove_peer(room_id, uid)
+            for room_id in session['voice']:
+                self.join_voice(room_id, uid)
+            for room_id in self.voice_rooms_of(uid):
+                if room_id not in session['voice']:
+                    self.leave_voice(room_id, uid)
+        return list(sessions)
+
+    def drop_sessions(self, user_ids):
+        """
+        负责这些会话的工作进程已失联：解绑 socket、移出对等表和语音，保留用户、成员关系和重连令牌，
+        返回 {user_id: 离开的语音房间 ID 列表}（只含仍存在的用户）
+        """
+        return self._replay(self._drop_sessions, user_ids)
+
+    def _drop_sessions(self, user_ids):
+        dropped = {}
+        for uid in user_ids:
+            user = self.users.get(uid)
+            if user is None:
+                continue
+            voice_room_ids = self.voice_rooms_of(uid)
+            for room_id in voice_room_ids:
+                self.leave_voice(room_id, uid)
+            sid = user.get('socket_id')
+            if sid:
+                self.suspend_session(uid, sid)
+            dropped[uid] = voice_room_ids
+        return dropped
+
+    def stats(self):
+        """当前规模：用户数、在线用户数、房间数、内存中的历史消息条数、语音中的用户数（不加锁，近似值）"""
+        rooms = list(self.rooms.values())
+        return {
+            'users': len(self.users),
+            'online': len(self._sid_users),
+            'rooms': len(rooms),
+            'messages': sum(len(room['messages']) for room in rooms),
+            'voice_peers': sum(len(users) for users in list(self.room_voice.values()))
+        }
+
+    # ==================== 用户 ====================
+
+    def add_user(self, user_id, nickname):
+        user = {
+            'nickname': nickname,
+            'skin_path': None,
+            'avatar': None,
+            'socket_id': None
+        }
+        with self._users_lock:
+            self.users[user_id] = user
+            self._record('user_created', user_id=user_id, nickname=nickname)
+        return user
+
+    def get_user(self, user_id):
+        return self.users.get(user_id) if user_id else None
+
+    def has_user(self, user_id):
+        return bool(user_id) and user_id in self.users
+
+    def nickname(self, user_id, default=''):
+        user = self.users.get(user_id)
+        return user['nickname'] if user else default
+
+    def update_user(self, user_id, **fields):
+        with self._users_lock:
+            user = self.users.get(user_id)
+            if user is not None:
+                user.update(fields)
+                self._record('user_updated', user_id=user_id, **fields)
+        return user
+
+    def bind_socket(self, user_id, sid):
+        """把用户绑定到新的 socket，同时维护 sid -> user_id 索引"""
+        if not user_id:
+            return False
+        with self._users_lock:
+            user = self.users.get(user_id)
+            if user is None:
+                return False
+            old_sid = user.get('socket_id')
+            if old_sid and old_sid != sid and self._sid_users.get(old_sid) == user_id:
+                del self._sid_users[old_sid]
+            user['socket_id'] = sid
+            if sid:
+                self._sid_users[sid] = user_id
+            self._record('socket_bound', durable=False, user_id=user_id, sid=sid)
+        return True
+
+    def user_by_sid(self, sid):
+        return self._sid_users.get(sid)
+
+    def issue_resume_token(self, user_id, token=None):
+        """为用户签发断线重连令牌（替换旧令牌），用户不存在时返回 None"""
+        token = token or secrets.token_urlsafe(24)
+        with self._users_lock:
+            if user_id not in self.users:
+                return None
+            old_token = self._user_tokens.get(user_id)
+            if old_token is not None:
+                self.resume_tokens.pop(old_token, None)
+            self._user_tokens[user_id] = token
+            self.resume_tokens[token] = user_id
+            self._record('resume_token_issued', durable=False, user_id=user_id, token=token)
+        return token
+
+    def suspend_session(self, user_id, sid):
+        """
+        socket 断开但保留会话：解绑 socket 并移出各房间的对等表，房间成员关系不变；
+        用户已经绑定到其他 socket（重连先于断开到达）时返回 False
+        """
+        with self._users_lock:
+            user = self.users.get(user_id)
+            if user is None or user.get('socket_id') != sid:
+                return False
+            user['socket_id'] = None
+            if self._sid_users.get(sid) == user_id:
+                del self._sid_users[sid]
+            room_ids = list(self.user_rooms.get(user_id, ()))
+            self._record('socket_bound', durable=False, user_id=user_id, sid=None)
+        for room_id in room_ids:
+            self.remove_peer(room_id, user_id)
+        return True
+
+    def resume_session(self, token, sid):
+        """
+        用重连令牌把会话绑定到新 socket，返回 (user_id, 房间 ID 列表, 新令牌)；令牌无效或用户已被清理时返回 None
+        令牌只能用一次：取出时即作废，同一令牌并发的两次重连只有一次成功，成功后换发新令牌
+        """
+        with self._users_lock:
+            user_id = self.resume_tokens.pop(token, None) if token else None
+            if user_id is None:
+                return None
+            if self._user_tokens.get(user_id) == token:
+                del self._user_tokens[user_id]
+        if not self.bind_socket(user_id, sid):
+            return None
+        new_token = self.issue_resume_token(user_id)
+        room_ids = self.rooms_of(user_id)
+        for room_id in room_ids:
+            self.set_peer(room_id, user_id, sid)
+        return user_id, room_ids, new_token
+
+    def remove_user(self, user_id):
+        """
+        从所有房间和对等表中移除用户，返回其离开的房间 ID 列表
+        """
+        return self._remove_user(user_id, 'user_removed', offline_only=False) or []
+
+    def expire_user(self, user_id):
+        """
+        移除从未绑定（或已解绑）socket 的用户，返回其离开的房间 ID 列表；用户已在线或不存在时返回 None
+        """
+        return self._remove_user(user_id, 'user_expired', offline_only=True)
+
+    def _remove_user(self, user_id, kind, offline_only):
+        with self._users_lock:
+            user = self.users.get(user_id)
+            if user is None or (offline_only and user.get('socket_id')):
+                return None
+            del self.users[user_id]
+            self._record(kind, user_id=user_id)
+
+            sid = user.get('socket_id')
+            if sid and self._sid_users.get(sid) == user_id:
+                del self._sid_users[sid]
+            token = self._user_tokens.pop(user_id, None)
+            if token is not None:
+                self.resume_tokens.pop(token, None)
+            room_ids = list(self.user_rooms.pop(user_id, ()))
+            voice_room_ids = list(self.user_voice.pop(user_id, ()))
+
+        left_rooms = []
+        for room_id in room_ids:
+            with self.room_lock(room_id):
+                room = self.rooms.get(room_id)
+                if room is not None:
+                    room['members'].pop(user_id, None)
+                    left_rooms.append(room_id)
+                peers = self.room_peers.get(room_id)
+                if peers is not None:
+                    peers.pop(user_id, None)
+        for room_id in voice_room_ids:
+            with self.room_lock(room_id):
+                self._discard_voice(room_id, user_id)
+        return left_rooms
+
+    # ==================== 房间 ====================
+
+    def create_room(self, room_id, room_type, name, owner_id, owner_sid):
+        room = {
+            'type': room_type,
+            'name': name,
+            'members': {owner_id: None},
+            'messages': MessageHistory(self.history_capacity.get(room_type, 100)),
+            'last_seq': 0
+        }
+        with self.room_lock(room_id):
+            self.rooms[room_id] = room
+            self.room_peers[room_id] = {owner_id: owner_sid}
+            self._record('room_created', room_id=room_id, type=room_type, name=name,
+                         owner_id=owner_id, owner_sid=owner_sid)
+            with self._users_lock:
+                self.user_rooms.setdefault(owner_id, {})[room_id] = None
+        return room
+
+    def get_room(self, room_id):
+        return self.rooms.get(room_id) if room_id else None
+
+    def has_room(self, room_id):
+        return bool(room_id) and room_id in self.rooms
+
+    def is_member(self, room_id, user_id):
+        room = self.rooms.get(room_id)
+        return room is not None and user_id in room['members']
+
+    def member_ids(self, room_id):
+        with self.room_lock(room_id):
+            room = self.rooms.get(room_id)
+            return list(room['members']) if room else []
+
+    def member_count(self, room_id):
+        room = self.rooms.get(room_id)
+        return len(room['members']) if room else 0
+
+    def is_room_idle(self, room_id):
+        """房间存在且没有任何成员在线"""
+        with self.room_lock(room_id):
+            room = self.rooms.get(room_id)
+            if room is None:
+                return False
+            users = self.users
+            return not any(
+                uid in users and users[uid].get('socket_id') for uid in room['members']
+            )
+
+    def add_member(self, room_id, user_id, sid):
+        """
+        加入房间，返回是否为新成员；房间或用户已被并发删除时返回 None
+        """
+        with self.room_lock(room_id):
+            room = self.rooms.get(room_id)
+            if room is None:
+                return None
+            with self._users_lock:
+                if user_id not in self.users:
+                    return None
+                self.user_rooms.setdefault(user_id, {})[room_id] = None
+            is_new = user_id not in room['members']
+            if is_new:
+                room['members'][user_id] = None
+                self._record('member_joined', room_id=room_id, user_id=user_id, sid=sid)
+            else:
+                self._record('peer_set', durable=False, room_id=room_id, user_id=user_id, sid=sid)
+            self.room_peers.setdefault(room_id, {})[user_id] = sid
+            return is_new
+
+    def rooms_of(self, user_id):
+        with self._users_lock:
+            return list(self.user_rooms.get(user_id, ()))
+
+    def append_message(self, room_id, message):
+        """追加消息（环形缓冲区，O(1)）并分配房间内递增的 seq，房间已不存在时返回 False"""
+        if 'seq' not in message and self.cluster is not None:
+            # 在锁外向总线取号；本地 last_seq 作为下限，总线计数器丢失后也不会回退
+            room = self.rooms.get(room_id)
+            if room is None:
+                return False
+            message['seq'] = self.cluster.next_seq(room_id, room['last_seq'])
+
+        with self.room_lock(room_id):
+            room = self.rooms.get(room_id)
+            if room is None:
+                return False
+            if message.get('id') is not None and room['messages'].seq_of(message['id']) is not None:
+                # 快照与随后的事件可能重复送达同一条消息
+                return True
+            if 'seq' not in message:
+                message['seq'] = room['last_seq'] + 1
+            room['last_seq'] = max(room['last_seq'], message['seq'])
+            dropped = room['messages'].append(message)
+            if self.search is not None:
+                self.search.add(room_id, message)
+                if dropped is not None and self.journal is None:
+                    self.search.remove(room_id, dropped)
+            self._record('message_sent', room_id=room_id, message=message)
+            return True
+
+    def recent_messages(self, room_id, count):
+        with self.room_lock(room_id):
+            room = self.rooms.get(room_id)
+            return room['messages'].last(count) if room else []
+
+    def history_page(self, room_id, before=None, after=None, limit=50):
+        """
+        按消息 ID 游标分页读取历史，房间不存在时返回 None
+
+        before: 早于该消息的最近 limit 条；after: 晚于该消息的最早 limit 条；都不传时返回最新 limit 条。
+        返回 {'messages', 'has_more', 'reset'}，has_more 表示游标方向上还有更多消息；
+        游标对应的消息已找不到时按最新一页返回并置 reset=True，客户端应丢弃本地缓存。
+        内存环形缓冲区之外的旧消息从 journal 读取，没有 journal 时只能取到缓冲区内的部分。
+        """
+        cursor = before or after
+        seq = None
+        page = None
+        with self.room_lock(room_id):
+            room = self.rooms.get(room_id)
+            if room is None:
+                return None
+            history = room['messages']
+            if cursor:
+                seq = history.seq_of(cursor)
+            # 常见情况（游标在内存中）一次加锁内完成截取
+            if not cursor or seq is not None:
+                page = self._history_slice(room, seq, bool(after), limit)
+        if page is not None:
+            return self._history_fill(room_id, page, seq, bool(after), limit, False)
+
+        reset = False
+        if self.journal is not None:
+            seq = self.journal.message_seq(room_id, cursor)
+        if seq is None:
+            reset = True
+
+        forward = bool(after) and not reset
+        with self.room_lock(room_id):
+            room = self.rooms.get(room_id)
+            if room is None:
+                return None
+            page = self._history_slice(room, seq, forward, limit)
+        return self._history_fill(room_id, page, seq, forward, limit, reset)
+
+    def _history_slice(self, room, seq, forward, limit):
+        """
+        在房间锁内截取缓冲区中的部分（多取一条用来判断 has_more），返回 (消息, 缓冲区起始 seq)
+        seq 不要求连续（多进程部署下由总线分配，可能有间隔）
+        """
+        history = room['messages']
+        if forward:
+            return history.after(seq, limit + 1), history.first_seq
+        return history.before(seq, limit + 1), history.first_seq
+
+    def _history_fill(self, room_id, page, seq, forward, limit, reset):
+        """在锁外用 journal 补齐缓冲区之外的部分，避免磁盘读取阻塞同一锁分片上的房间"""
+        messages, first_seq = page
+        journal = self.journal
+
+        if forward:
+            if journal is not None and (first_seq is None or seq < first_seq):
+                messages = journal.messages_after(room_id, seq, first_seq, limit + 1) + messages
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+        else:
+            if len(messages) <= limit and journal is not None:
+                bound = messages[0]['seq'] if messages else (seq if seq is not None else first_seq)
+                older = journal.messages_before(room_id, bound, limit + 1 - len(messages))
+                messages = older + messages
+            has_more = len(messages) > limit
+            messages = messages[-limit:]
+
+        return {'messages': messages, 'has_more': has_more, 'reset': reset}
+
+    def index_history(self, messages):
+        """把 (room_id, 消息) 逐条写入搜索索引（启动时用 journal 中的全部历史建立索引），返回条数"""
+        count = 0
+        for room_id, message in messages:
+            with self.room_lock(room_id):
+                if room_id in self.rooms:
+                    self.search.add(room_id, message)
+                    count += 1
+        return count
+
+    def search_messages(self, room_id, terms, offset=0, limit=20, **filters):
+        """
+        在房间历史中搜索，房间不存在时返回 None
+
+        terms 为 search.query_terms() 的结果，filters 见 RoomIndex.search()。
+        返回 {'messages', 'has_more'}，按相关度排序时每条消息附带 score；
+        命中内存缓冲区之外的旧消息时在锁外从 journal 读取。
+        """
+        with self.room_lock(room_id):
+            room = self.rooms.get(room_id)
+            if room is None:
+                return None
+            hits, has_more = self.search.search(room_id, terms, offset=offset, limit=limit, **filters)
+            history = room['messages']
+            found = {}
+            for seq, _ in hits:
+                message = history.get(seq)
+                if message is not None:
+                    found[seq] = message
+
+        missing = [seq for seq, _ in hits if seq not in found]
+        if missing and self.journal is not None:
+            found.update(self.journal.messages_by_seq(room_id, missing))
+
+        messages = []
+        for seq, score in hits:
+            message = found.get(seq)
+            if message is None:
+                continue
+            if score is not None:
+                message = dict(message, score=score)
+            messages.append(message)
+        return {'messages': messages, 'has_more': has_more}
+
+    def delete_room(self, room_id):
+        """删除房间及其对等表、邀请码和用户房间索引，返回被删除的房间"""
+        with self.room_lock(room_id):
+            room = self.rooms.pop(room_id, None)
+            if room is None:
+                return None
+            if self.search is not None:
+                self.search.drop_room(room_id)
+            self._record('room_deleted', room_id=room_id)
+
+            peers = self.room_peers.pop(room_id, {})
+            voice = self.room_voice.pop(room_id, {})
+            with self._users_lock:
+                for uid in set(room['members']).union(peers):
+                    r_set = self.user_rooms.get(uid)
+                    if r_set is not None:
+                        r_set.pop(room_id, None)
+                        if not r_set:
+                            del self.user_rooms[uid]
+                for uid in voice:
+                    v_set = self.user_voice.get(uid)
+                    if v_set is not None:
+                        v_set.pop(room_id, None)
+                        if not v_set:
+                            del self.user_voice[uid]
+
+        with self._codes_lock:
+            for code in self._room_codes.pop(room_id, ()):
+                if self.invite_codes.get(code) == room_id:
+                    del self.invite_codes[code]
+                    self.invite_limits.pop(code, None)
+        return room
+
+    # ==================== 邀请码 ====================
+
+    def add_invite_code(self, code, room_id, expires_at=None, max_uses=0):
+        """登记邀请码；已存在时重新计算有效期和使用次数"""
+        with self._codes_lock:
+            old_room_id = self.invite_codes.get(code)
+            if old_room_id is not None and old_room_id != room_id:
+                self._room_codes.get(old_room_id, set()).discard(code)
+            self.invite_codes[code] = room_id
+            self._room_codes.setdefault(room_id, set()).add(code)
+            if expires_at or max_uses:
+                self.invite_limits[code] = {'expires_at': expires_at, 'max_uses': max_uses, 'uses': 0}
+            else:
+                self.invite_limits.pop(code, None)
+            self._record('invite_code_added', code=code, room_id=room_id,
+                         expires_at=expires_at, max_uses=max_uses)
+
+    def resolve_invite_code(self, code):
+        room_id = self.invite_codes.get(code)
+        if room_id is not None:
+            limits = self.invite_limits.get(code)
+            # 过期清理由后台 tick 驱动，这里再检查一次，到期和清理之间的窗口内也不能再用
+            if limits is not None and limits['expires_at'] and limits['expires_at'] <= time.time():
+                return None
+        return room_id
+
+    def use_invite_code(self, code):
+        """记一次使用（有人通过邀请码成为新成员），达到次数上限时删除邀请码并返回 True"""
+        with self._codes_lock:
+            limits = self.invite_limits.get(code)
+            if limits is None or code not in self.invite_codes:
+                return False
+            limits['uses'] += 1
+            self._record('invite_code_used', code=code)
+            exhausted = bool(limits['max_uses']) and limits['uses'] >= limits['max_uses']
+        return exhausted and self.remove_invite_code(code)
+
+    def remove_invite_code(self, code):
+        """删除邀请码，返回是否存在"""
+        with self._codes_lock:
+            room_id = self.invite_codes.pop(code, None)
+            if room_id is None:
+                return False
+            self.invite_limits.pop(code, None)
+            codes = self._room_codes.get(room_id)
+            if codes is not None:
+                codes.discard(code)
+                if not codes:
+                    del self._room_codes[room_id]
+            self._record('invite_code_removed', code=code)
+            return True
+
+    def invite_expiries(self):
+        """有有效期的邀请码 -> 过期时间（启动时登记到过期引擎）"""
+        with self._codes_lock:
+            return {code: limits['expires_at'] for code, limits in self.invite_limits.items()
+                    if limits['expires_at']}
+
+    # ==================== WebRTC 对等表 ====================
+
+    def set_peer(self, room_id, user_id, sid):
+        with self.room_lock(room_id):
+            if room_id in self.rooms:
+                self.room_peers.setdefault(room_id, {})[user_id] = sid
+                self._record('peer_set', durable=False, room_id=room_id, user_id=user_id, sid=sid)
+
+    def remove_peer(self, room_id, user_id):
+        with self.room_lock(room_id):
+            peers = self.room_peers.get(room_id)
+            if peers is not None and user_id in peers:
+                del peers[user_id]
+                self._record('peer_removed', durable=False, room_id=room_id, user_id=user_id)
+
+    def peer_sid(self, room_id, user_id):
+        peers = self.room_peers.get(room_id)
+        return peers.get(user_id) if peers else None
+
+    def peer_ids(self, room_id):
+        with self.room_lock(room_id):
+            return list(self.room_peers.get(room_id, ()))
+
+    # ==================== 语音在线 ====================
+
+    def join_voice(self, room_id, user_id):
+        """
+        加入房间语音，返回此前已在语音中的其他用户 ID；房间不存在时返回 None
+        """
+        with self.room_lock(room_id):
+            if room_id not in self.rooms:
+                return None
+            voice = self.room_voice.setdefault(room_id, {})
+            others = [uid for uid in voice if uid != user_id]
+            if user_id not in voice:
+                voice[user_id] = None
+                with self._users_lock:
+                    self.user_voice.setdefault(user_id, {})[room_id] = None
+                self._record('voice_joined', durable=False, room_id=room_id, user_id=user_id)
+            return others
+
+    def leave_voice(self, room_id, user_id):
+        """
+        离开房间语音，返回语音中剩余的人数；用户本来不在语音中时返回 None
+        """
+        with self.room_lock(room_id):
+            remaining = self._discard_voice(room_id, user_id)
+            if remaining is None:
+                return None
+            with self._users_lock:
+                v_set = self.user_voice.get(user_id)
+                if v_set is not None:
+                    v_set.pop(room_id, None)
+                    if not v_set:
+                        del self.user_voice[user_id]
+            self._record('voice_left', durable=False, room_id=room_id, user_id=user_id)
+            return remaining
+
+    def _discard_voice(self, room_id, user_id):
+        """调用方持有房间锁"""
+        voice = self.room_voice.get(room_id)
+        if not voice or user_id not in voice:
+            return None
+        del voice[user_id]
+        if not voice:
+            del self.room_voice[room_id]
+        return len(voice)
+
+    def voice_ids(self, room_id):
+        with self.room_lock(room_id):
+            return list(self.room_voice.get(room_id, ()))
+
+    def voice_count(self, room_id):
+        voice = self.room_voice.get(room_id)
+        return len(voice) if voice else 0
+
+    def voice_rooms_of(self, user_id):
+        with self._users_lock:
+            return list(self.user_voice.get(user_id, ()))
@@ -12,8 +12,15 @@ let currentRoomType = null;
 let currentInviteType = null;
 let socket = null;
 let socketEventsInitialized = false;
+let resumeToken = null;    // 断线重连令牌，重连后用它恢复会话
 let isMobile = /Android|iPhone|iPad|iPod|webOS/i.test(navigator.userAgent);
 
+// 消息历史：每个房间在本地缓存已收到的消息（按 seq 升序），重新进入房间时只请求缺失的部分
+const HISTORY_PAGE_SIZE = 50;
+let roomMessages = {};     // room_id -> [message]
+let roomHasMore = {};      // room_id -> 服务器上是否还有更早的消息
+let historyLoading = false;
+
 // 语音消息相关
 let mediaRecorder = null;
 let audioChunks = [];
@@ -23,6 +30,16 @@ let recordStartTime = 0;
 // WebRTC 相关
 let localStream = null;
 let peerConnections = {};  // user_id -> RTCPeerConnection
+let voiceMode = 'mesh';     // mesh：两两直连；sfu：只连服务端，由服务端转发
+let sfuConnection = null;
+let sfuTrackUsers = {};     // 服务端下行 transceiver 的 mid -> 发布者 user_id
+let sfuQueue = Promise.resolve();  // 转发模式的信令按顺序处理
+let activeSpeakers = new Set();    // 服务端广播的活跃发言人
+let levelMeter = null;             // 本地麦克风音量检测
+let sendGateOpen = true;           // mesh 模式下本端是否在发送音频
+const VOICE_LEVEL_INTERVAL = 200;
+const VOICE_LEVEL_THRESHOLD = 0.02;
+const VOICE_HANG_MS = 1500;
 let isVoiceChatActive = false;
 let isMuted = false;
 let audioContext = null;
@@ -164,16 +181,15 @@ function initSkinUpload() {
                 body: formData
             });
 
-            const data = await response.json();
-            if (data.success) {
-                userAvatar = data.avatar;
-                saveAvatar(data.avatar);
+            let data = await response.json();
+            if (data.success && data.status === 'processing') {
+                // 服务器在后台处理皮肤，轮询任务状态（进入聊天室后也会收到 skin_ready 推送）
+                enterBtn.textContent = '处理中...';
+                data = await waitForSkinJob(data.job_id);
+            }
 
-                const model = document.getElementById('skin-model');
-                if (model) {
-                    model.style.backgroundImage = `url(${data.skin_url}?t=${Date.now()})`;
-                    model.style.backgroundSize = '64px 64px';
-                }
+            if (data.success) {
+                applySkinResult(data);
 
                 enterBtn.disabled = false;
                 enterBtn.textContent = '进入聊天室';
@@ -194,6 +210,37 @@ function initSkinUpload() {
     document.getElementById('enter-btn').addEventListener('click', enterChatRoom);
 }
 
+async function waitForSkinJob(jobId, timeoutMs = 30000) {
+    const deadline = Date.now() + timeoutMs;
+    while (Date.now() < deadline) {
+        await new Promise(resolve => setTimeout(resolve, 300));
+        const response = await fetch(`/skin_job/${jobId}`);
+        const data = await response.json();
+        if (!data.success || data.status !== 'processing') {
+            return data;
+        }
+    }
+    return { success: false, message: '皮肤处理超时，请稍后重试' };
+}
+
+function applySkinResult(data) {
+    if (data.avatar) {
+        userAvatar = data.avatar;
+        saveAvatar(data.avatar);
+
+        const avatarImg = document.getElementById('user-avatar');
+        if (avatarImg) {
+            avatarImg.src = data.avatar;
+        }
+    }
+
+    const model = document.getElementById('skin-model');
+    if (model && data.skin_url) {
+        model.style.backgroundImage = `url(${data.skin_url})`;
+        model.style.backgroundSize = '64px 64px';
+    }
+}
+
 // ========== 本地存储功能 ==========
 function saveUser(nickname) {
     try {
@@ -204,9 +251,9 @@ function saveUser(nickname) {
     }
 }
 
-function saveAvatar(avatarBase64) {
+function saveAvatar(avatarUrl) {
     try {
-        localStorage.setItem('mc_chat_avatar', avatarBase64);
+        localStorage.setItem('mc_chat_avatar', avatarUrl);
     } catch (e) {
         console.error('保存头像失败:', e);
     }
@@ -265,11 +312,112 @@ function clearSavedData() {
     location.reload();
 }
 
+// ========== 紧凑编码 ==========
+// 连接时请求 MessagePack 编码：服务端发来的事件参数是一个二进制附件，
+// 其中的 user_id / room_id 是整数句柄（由 ids 事件告知对应的 UUID），消息 id 是 16 字节 UUID，timestamp 是毫秒时间戳
+const HANDLE_KEYS = new Set(['user_id', 'room_id', 'from_user_id', 'target_user_id', 'initiator_id']);
+const HANDLE_LIST_KEYS = new Set(['user_ids', 'room_ids']);
+let compactIds = {};  // 句柄 -> UUID
+
+function connectSocket() {
+    const s = io({ auth: { encoding: 'msgpack' } });
+    const on = s.on.bind(s);
+    s.on = (event, handler) => on(event, (...args) => {
+        if (args.length === 1 && (args[0] instanceof ArrayBuffer || ArrayBuffer.isView(args[0]))) {
+            args = expandCompact(decodeMsgpack(args[0]));
+        }
+        return handler(...args);
+    });
+    // ids 也是 MessagePack 二进制附件（整数键），不经过上面的句柄展开
+    on('ids', (payload) => {
+        Object.entries(decodeMsgpack(payload)).forEach(([handle, id]) => { compactIds[handle] = id; });
+    });
+    return s;
+}
+
+function uuidFromBytes(bytes) {
+    const hex = Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+    return `${hex.slice(0, 8)}-${hex.slice(8, 12)}-${hex.slice(12, 16)}-${hex.slice(16, 20)}-${hex.slice(20)}`;
+}
+
+function expandCompact(value, key) {
+    if (typeof value === 'number' && HANDLE_KEYS.has(key)) {
+        return compactIds[value] ?? value;
+    }
+    if (value instanceof Uint8Array) {
+        return key === 'id' && value.length === 16 ? uuidFromBytes(value) : value;
+    }
+    if (Array.isArray(value)) {
+        return HANDLE_LIST_KEYS.has(key)
+            ? value.map(item => (typeof item === 'number' ? compactIds[item] ?? item : item))
+            : value.map(item => expandCompact(item));
+    }
+    if (value && typeof value === 'object') {
+        const result = {};
+        Object.keys(value).forEach(k => { result[k] = expandCompact(value[k], k); });
+        return result;
+    }
+    return value;
+}
+
+// 只实现服务端会产生的 MessagePack 类型（不含 ext）
+function decodeMsgpack(buffer) {
+    const bytes = buffer instanceof ArrayBuffer
+        ? new Uint8Array(buffer)
+        : new Uint8Array(buffer.buffer, buffer.byteOffset, buffer.byteLength);
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    const text = new TextDecoder();
+    let pos = 0;
+
+    const str = (n) => { const s = text.decode(bytes.subarray(pos, pos + n)); pos += n; return s; };
+    const bin = (n) => { const b = bytes.slice(pos, pos + n); pos += n; return b; };
+    const arr = (n) => { const a = []; for (let i = 0; i < n; i++) a.push(read()); return a; };
+    const map = (n) => { const m = {}; for (let i = 0; i < n; i++) { const k = read(); m[k] = read(); } return m; };
+    const num = (getter, size) => { const v = view[getter](pos); pos += size; return v; };
+
+    function read() {
+        const b = bytes[pos++];
+        if (b <= 0x7f) return b;
+        if (b <= 0x8f) return map(b & 0x0f);
+        if (b <= 0x9f) return arr(b & 0x0f);
+        if (b <= 0xbf) return str(b & 0x1f);
+        if (b >= 0xe0) return b - 0x100;
+        switch (b) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return bin(num('getUint8', 1));
+            case 0xc5: return bin(num('getUint16', 2));
+            case 0xc6: return bin(num('getUint32', 4));
+            case 0xca: return num('getFloat32', 4);
+            case 0xcb: return num('getFloat64', 8);
+            case 0xcc: return num('getUint8', 1);
+            case 0xcd: return num('getUint16', 2);
+            case 0xce: return num('getUint32', 4);
+            case 0xcf: return Number(num('getBigUint64', 8));
+            case 0xd0: return num('getInt8', 1);
+            case 0xd1: return num('getInt16', 2);
+            case 0xd2: return num('getInt32', 4);
+            case 0xd3: return Number(num('getBigInt64', 8));
+            case 0xd9: return str(num('getUint8', 1));
+            case 0xda: return str(num('getUint16', 2));
+            case 0xdb: return str(num('getUint32', 4));
+            case 0xdc: return arr(num('getUint16', 2));
+            case 0xdd: return arr(num('getUint32', 4));
+            case 0xde: return map(num('getUint16', 2));
+            case 0xdf: return map(num('getUint32', 4));
+        }
+        throw new Error(`不支持的 MessagePack 类型 0x${b.toString(16)}`);
+    }
+
+    return read();
+}
+
 // ========== 进入聊天室 ==========
 async function enterChatRoom() {
     console.log('进入聊天室，userId:', userId);
 
-    socket = io();
+    socket = connectSocket();
 
     await new Promise((resolve) => {
         if (socket.connected) {
@@ -338,6 +486,15 @@ function initSocketEvents() {
         closeModal('join-modal');
         saveRoom(data.room_id, data.room_name, data.room_type);
 
+        if (data.history_after) {
+            // 断线或切换房间后只补发了缺失的消息，超过一页时继续向后拉取
+            mergeRoomMessages(data.room_id, data.messages || []);
+            if (data.has_more) requestHistory(data.room_id, { after: lastMessageId(data.room_id) });
+        } else {
+            roomMessages[data.room_id] = (data.messages || []).slice();
+            roomHasMore[data.room_id] = !!data.has_more;
+        }
+
         const roomsContainer = document.getElementById('rooms-container');
         if (roomsContainer && !document.querySelector(`[data-room-id="${data.room_id}"]`)) {
             addRoomToList(data.room_id, data.room_name, data.room_type);
@@ -354,13 +511,149 @@ function initSocketEvents() {
     });
 
     socket.on('new_message', (data) => {
-        appendMessage(data);
+        const roomId = data.room_id || currentRoomId;
+        if (!mergeRoomMessages(roomId, [data])) return;
+        if (roomId === currentRoomId) appendMessage(data);
+    });
+
+    socket.on('history', (data) => {
+        historyLoading = false;
+        const roomId = data.room_id;
+
+        if (data.reset) {
+            roomMessages[roomId] = data.messages.slice();
+            roomHasMore[roomId] = !!data.has_more;
+            if (roomId === currentRoomId) renderRoomMessages(roomId);
+            return;
+        }
+
+        if (data.before) {
+            roomHasMore[roomId] = !!data.has_more;
+            prependRoomMessages(roomId, data.messages);
+        } else {
+            data.messages.forEach(m => {
+                if (mergeRoomMessages(roomId, [m]) && roomId === currentRoomId) appendMessage(m);
+            });
+            if (data.has_more) requestHistory(roomId, { after: lastMessageId(roomId) });
+        }
+    });
+
+    // 服务端发送队列积压期间丢弃了这些房间的广播：当前房间按游标补拉，其他房间清掉缓存，打开时重新加载
+    socket.on('missed_messages', (data) => {
+        console.warn('连接积压，漏收消息:', data);
+        (data.room_ids || []).forEach(roomId => {
+            if (roomId === currentRoomId && roomMessages[roomId] && roomMessages[roomId].length) {
+                historyLoading = false;
+                requestHistory(roomId, { after: lastMessageId(roomId) });
+            } else {
+                delete roomMessages[roomId];
+            }
+        });
+    });
+
+    // ========== 断线重连 ==========
+    // 首次连接在 enterChatRoom 中完成，这里只处理自动重连：带上令牌和各房间本地最后一条消息的 ID 恢复会话
+    socket.on('session', (data) => {
+        resumeToken = data.resume_token;
+    });
+
+    socket.on('connect', () => {
+        if (!resumeToken) {
+            socket.emit('register_user', { user_id: userId });
+            return;
+        }
+        const rooms = {};
+        Object.keys(roomMessages).forEach(roomId => {
+            const last = lastMessageId(roomId);
+            if (last) rooms[roomId] = last;
+        });
+        console.log('重新连接，恢复会话');
+        socket.emit('resume_session', { resume_token: resumeToken, rooms });
+    });
+
+    socket.on('session_resumed', (data) => {
+        historyLoading = false;
+        // 语音连接不会跨断线保留，服务端已经让本端离开语音
+        if (isVoiceChatActive) leaveVoiceChat();
+        (data.rooms || []).forEach(room => {
+            const roomId = room.room_id;
+            if (room.reset) {
+                roomMessages[roomId] = room.messages.slice();
+                roomHasMore[roomId] = !!room.has_more;
+                if (roomId === currentRoomId) renderRoomMessages(roomId);
+                return;
+            }
+            room.messages.forEach(m => {
+                if (mergeRoomMessages(roomId, [m]) && roomId === currentRoomId) appendMessage(m);
+            });
+            if (room.has_more) requestHistory(roomId, { after: lastMessageId(roomId) });
+        });
+    });
+
+    // 宽限期已过或服务端重启过：重新注册 socket，再按原方式加入当前房间
+    socket.on('session_expired', () => {
+        resumeToken = null;
+        socket.emit('register_user', { user_id: userId });
+        if (currentRoomId) {
+            socket.emit('join_invite', { user_id: userId, code: currentRoomId, after: lastMessageId(currentRoomId) });
+        }
+    });
+
+    socket.on('register_error', (data) => {
+        alert(data.message);
+        location.reload();
+    });
+
+    socket.on('history_error', (data) => {
+        historyLoading = false;
+        console.warn('加载历史失败:', data);
     });
 
     socket.on('message_error', (data) => {
         alert(data.message);
     });
 
+    socket.on('search_results', (data) => {
+        if (data.room_id !== currentRoomId) return;
+        renderSearchResults(data);
+    });
+
+    socket.on('search_error', (data) => {
+        showSearchError(data.message);
+    });
+
+    // 服务端限流：用户主动的操作给出提示，信令等后台事件只记录
+    socket.on('rate_limited', (data) => {
+        console.warn('操作被限流:', data);
+        switch (data.event) {
+            case 'send_message':
+                if (data.room_id === currentRoomId) {
+                    appendSystemMessage(`发送过于频繁，请 ${Math.ceil(data.retry_after)} 秒后再试`);
+                }
+                break;
+            case 'get_history':
+                historyLoading = false;
+                break;
+            case 'search_messages':
+                showSearchError(`搜索过于频繁，请 ${Math.ceil(data.retry_after)} 秒后再试`);
+                break;
+            case 'create_invite':
+            case 'join_invite':
+            case 'invite_to_room':
+            case 'delete_room':
+            case 'join_voice_room':
+                alert(data.message);
+                break;
+        }
+    });
+
+    // 后台皮肤处理完成
+    socket.on('skin_ready', (data) => {
+        if (data.status === 'ready') {
+            applySkinResult(data);
+        }
+    });
+
     socket.on('user_joined', (data) => {
         if (currentRoomId) {
             appendSystemMessage(`${data.nickname} 加入了聊天`);
@@ -417,6 +710,8 @@ function initSocketEvents() {
 
         removeRoomFromList(room_id);
         removeRoomFromStorage(room_id);
+        delete roomMessages[room_id];
+        delete roomHasMore[room_id];
 
         const tipName = initiator_nickname || '有人';
         alert(`${tipName} 删除了房间「${room_name || ''}」`);
@@ -430,39 +725,38 @@ function initSocketEvents() {
 
     // ========== WebRTC 信令事件 ==========
     
-    // 新用户加入语音房间
+    // 有人加入语音（只有语音中的用户会收到）；新加入者负责发起连接，这里只更新面板
     socket.on('user_joined_voice', (data) => {
         console.log('用户加入语音房间:', data);
+        if (isVoiceChatActive && data.room_id === currentRoomId) {
+            addVoiceParticipant(data.user_id);
+        }
+    });
 
-        // 如果是自己加入，连接到已存在的用户
-        if (data.user_id === userId) {
-            data.existing_users.forEach(existingUser => {
-                createPeerConnection(existingUser.user_id, true);
-            });
-            // 添加现有用户到语音面板
-            data.existing_users.forEach(existingUser => {
-                addVoiceParticipant(existingUser.user_id);
-            });
-            return;
+    // 房间内有人发起语音时，给未加入语音的用户一个"可加入语音"的通知
+    socket.on('voice_started', (data) => {
+        if (isVoiceChatActive || data.room_id !== currentRoomId) return;
+
+        pendingVoiceInviteRoomId = data.room_id;
+        pendingVoiceInviteFromUser = data.nickname || '有人';
+
+        const notif = document.getElementById('voice-notification');
+        const text = document.getElementById('voice-notification-text');
+        if (notif && text) {
+            text.textContent = `${pendingVoiceInviteFromUser} 发起了语音聊天，点击加入`;
+            notif.classList.remove('hidden');
         }
+    });
 
-        // 如果语音聊天已激活，自动连接到新用户
-        if (isVoiceChatActive && currentRoomId) {
-            createPeerConnection(data.user_id, true);
-            addVoiceParticipant(data.user_id);
-        } else {
-            // 其他人发起语音时，给当前用户一个"可加入语音"的通知
-            if (currentRoomId) {
-                pendingVoiceInviteRoomId = currentRoomId;
-                pendingVoiceInviteFromUser = data.nickname || '有人';
-
-                const notif = document.getElementById('voice-notification');
-                const text = document.getElementById('voice-notification-text');
-                if (notif && text) {
-                    text.textContent = `${pendingVoiceInviteFromUser} 发起了语音聊天，点击加入`;
-                    notif.classList.remove('hidden');
-                }
-            }
+    // 语音中的最后一个人离开
+    socket.on('voice_ended', (data) => {
+        if (data.room_id !== pendingVoiceInviteRoomId) return;
+
+        pendingVoiceInviteRoomId = null;
+        pendingVoiceInviteFromUser = null;
+        const notif = document.getElementById('voice-notification');
+        if (notif) {
+            notif.classList.add('hidden');
         }
     });
 
@@ -470,17 +764,69 @@ function initSocketEvents() {
     socket.on('voice_room_users', (data) => {
         console.log('语音房间用户列表:', data);
 
+        voiceMode = data.mode || 'mesh';
+        data.users.forEach(user => addVoiceParticipant(user.user_id));
+        if (voiceMode === 'sfu') {
+            startSfuPublish();
+            return;
+        }
+
+        // mesh：新加入者向语音中的每个人发起连接，对方收到 Offer 时再创建连接
         data.users.forEach(user => {
             createPeerConnection(user.user_id, true);
         });
     });
 
+    // 转发模式：服务端对发布 Offer 的应答
+    socket.on('sfu_publish_answer', (data) => {
+        enqueueSfu(async () => {
+            if (!sfuConnection || data.room_id !== currentRoomId) return;
+            await sfuConnection.setRemoteDescription(new RTCSessionDescription(data.answer));
+        });
+    });
+
+    // 转发模式：服务端增加下行音频时重新协商
+    socket.on('sfu_offer', (data) => {
+        enqueueSfu(async () => {
+            if (!sfuConnection || data.room_id !== currentRoomId) return;
+            sfuTrackUsers = data.tracks || {};
+            await sfuConnection.setRemoteDescription(new RTCSessionDescription(data.offer));
+            await sfuConnection.setLocalDescription(await sfuConnection.createAnswer());
+            await waitIceGathering(sfuConnection);
+            socket.emit('sfu_answer', {
+                room_id: currentRoomId,
+                user_id: userId,
+                answer: sfuConnection.localDescription
+            });
+        });
+    });
+
+    // 活跃发言人：高亮正在说话的人；mesh 模式下自己不说话时暂停发送
+    socket.on('active_speakers', (data) => {
+        if (data.room_id !== currentRoomId) return;
+        activeSpeakers = new Set(data.speakers.map(speaker => speaker[0]));
+        document.querySelectorAll('.voice-participant').forEach(el => {
+            const uid = el.id === 'voice-user-self' ? userId : el.id.replace('voice-user-', '');
+            el.classList.toggle('speaking', activeSpeakers.has(uid));
+        });
+        updateSendGate();
+    });
+
+    socket.on('sfu_tracks', (data) => {
+        enqueueSfu(async () => {
+            if (data.room_id === currentRoomId) {
+                sfuTrackUsers = data.tracks || {};
+            }
+        });
+    });
+
     // 用户离开语音房间
     socket.on('user_left_voice', (data) => {
         console.log('用户离开语音房间:', data);
-        if (peerConnections[data.user_id]) {
-            peerConnections[data.user_id].close();
-            delete peerConnections[data.user_id];
+        const peerId = getPeerId(data.user_id, userId);
+        if (peerConnections[peerId]) {
+            peerConnections[peerId].close();
+            delete peerConnections[peerId];
         }
         removeVoiceParticipant(data.user_id);
     });
@@ -528,17 +874,14 @@ function initSocketEvents() {
         }
     });
 
-    // 接收 ICE 候选
+    // 接收 ICE 候选（服务端按发送方合并成批，end 表示对方已收集完毕）
+    socket.on('webrtc_ice_candidates', async (data) => {
+        await addRemoteIceCandidates(data.from_user_id, data.candidates || [], data.end);
+    });
+
     socket.on('webrtc_ice_candidate', async (data) => {
-        try {
-            const peerId = getPeerId(data.from_user_id, userId);
-            const peerConnection = peerConnections[peerId];
-            
-            if (peerConnection && data.candidate) {
-                await peerConnection.addIceCandidate(new RTCIceCandidate(data.candidate));
-            }
-        } catch (error) {
-            console.error('添加 ICE 候选失败:', error);
+        if (data.candidate) {
+            await addRemoteIceCandidates(data.from_user_id, [data.candidate], false);
         }
     });
 
@@ -549,6 +892,186 @@ function initSocketEvents() {
 
 // ========== WebRTC 核心功能 ==========
 
+/**
+ * 把对方的一批 ICE 候选加入对应的 Peer 连接
+ */
+async function addRemoteIceCandidates(fromUserId, candidates, end) {
+    const peerConnection = peerConnections[getPeerId(fromUserId, userId)];
+    if (!peerConnection) return;
+
+    for (const candidate of candidates) {
+        try {
+            await peerConnection.addIceCandidate(new RTCIceCandidate(candidate));
+        } catch (error) {
+            console.error('添加 ICE 候选失败:', error);
+        }
+    }
+    if (end) {
+        try {
+            await peerConnection.addIceCandidate(null);
+        } catch (error) {
+            console.error('处理 end-of-candidates 失败:', error);
+        }
+    }
+}
+
+/**
+ * 转发模式的信令串行执行，避免 Answer 还未应用时就处理下一次 Offer
+ */
+function enqueueSfu(task) {
+    sfuQueue = sfuQueue.then(task).catch(error => {
+        console.error('语音转发信令失败:', error);
+    });
+    return sfuQueue;
+}
+
+/**
+ * 等待 ICE 收集完成（服务端不接收 trickle 候选，SDP 需要带上全部候选）
+ */
+function waitIceGathering(pc) {
+    if (pc.iceGatheringState === 'complete') return Promise.resolve();
+    return new Promise(resolve => {
+        const check = () => {
+            if (pc.iceGatheringState === 'complete') {
+                pc.removeEventListener('icegatheringstatechange', check);
+                resolve();
+            }
+        };
+        pc.addEventListener('icegatheringstatechange', check);
+    });
+}
+
+/**
+ * 转发模式：与服务端建立一条 PeerConnection，上传本地音频，接收其他人的音频
+ */
+function startSfuPublish() {
+    enqueueSfu(async () => {
+        closeSfuConnection();
+
+        const pc = new RTCPeerConnection(rtcConfig);
+        sfuConnection = pc;
+        sfuTrackUsers = {};
+
+        if (localStream) {
+            localStream.getAudioTracks().forEach(track => {
+                pc.addTransceiver(track, { direction: 'sendonly', streams: [localStream] });
+            });
+        }
+
+        pc.ontrack = (event) => {
+            const mid = event.transceiver.mid;
+            console.log('收到转发音频:', mid, sfuTrackUsers[mid]);
+            playRemoteStream(event.streams[0] || new MediaStream([event.track]), `sfu-${mid}`);
+        };
+
+        pc.onconnectionstatechange = () => {
+            console.log('语音转发连接状态:', pc.connectionState);
+        };
+
+        await pc.setLocalDescription(await pc.createOffer());
+        await waitIceGathering(pc);
+        socket.emit('sfu_publish', {
+            room_id: currentRoomId,
+            user_id: userId,
+            offer: pc.localDescription
+        });
+    });
+}
+
+/**
+ * 本地音量检测：每 200ms 计算一次麦克风 RMS，音量变化明显或每秒一次上报 voice_levels
+ */
+function startLevelMeter() {
+    stopLevelMeter();
+    if (!localStream) return;
+
+    try {
+        if (!audioContext) {
+            audioContext = new (window.AudioContext || window.webkitAudioContext)();
+        }
+        const analyser = audioContext.createAnalyser();
+        analyser.fftSize = 512;
+        const source = audioContext.createMediaStreamSource(localStream);
+        source.connect(analyser);
+        const samples = new Float32Array(analyser.fftSize);
+        const meter = { source, lastSent: 0, lastSentAt: 0, lastVoiceAt: 0, timer: null };
+
+        meter.timer = setInterval(() => {
+            analyser.getFloatTimeDomainData(samples);
+            let sum = 0;
+            for (let i = 0; i < samples.length; i++) {
+                sum += samples[i] * samples[i];
+            }
+            const level = isMuted ? 0 : Math.min(1, Math.sqrt(sum / samples.length));
+            const now = Date.now();
+            if (level >= VOICE_LEVEL_THRESHOLD) {
+                meter.lastVoiceAt = now;
+            }
+
+            // 持续静音时只发心跳
+            const speaking = level >= VOICE_LEVEL_THRESHOLD || meter.lastSent >= VOICE_LEVEL_THRESHOLD;
+            if ((speaking && Math.abs(level - meter.lastSent) > 0.01) || now - meter.lastSentAt > 1000) {
+                meter.lastSent = level;
+                meter.lastSentAt = now;
+                socket.emit('voice_levels', {
+                    room_id: currentRoomId,
+                    user_id: userId,
+                    level: Math.round(level * 1000) / 1000
+                });
+            }
+            updateSendGate();
+        }, VOICE_LEVEL_INTERVAL);
+
+        levelMeter = meter;
+    } catch (error) {
+        console.error('音量检测启动失败:', error);
+    }
+}
+
+function stopLevelMeter() {
+    if (levelMeter) {
+        clearInterval(levelMeter.timer);
+        levelMeter.source.disconnect();
+        levelMeter = null;
+    }
+    activeSpeakers = new Set();
+    sendGateOpen = true;
+    document.querySelectorAll('.voice-participant.speaking').forEach(el => el.classList.remove('speaking'));
+}
+
+/**
+ * mesh 模式下自己既不在活跃发言人中、最近也没说话时暂停各连接的音频发送，恢复说话时立即打开
+ */
+function updateSendGate() {
+    if (voiceMode !== 'mesh' || !levelMeter) return;
+
+    const open = activeSpeakers.has(userId) || Date.now() - levelMeter.lastVoiceAt < VOICE_HANG_MS;
+    if (open === sendGateOpen) return;
+    sendGateOpen = open;
+
+    Object.values(peerConnections).forEach(pc => {
+        pc.getSenders().forEach(sender => {
+            if (!sender.track || sender.track.kind !== 'audio') return;
+            const params = sender.getParameters();
+            if (!params.encodings || !params.encodings.length) return;
+            params.encodings.forEach(encoding => {
+                encoding.active = open;
+            });
+            sender.setParameters(params).catch(error => {
+                console.warn('切换音频发送失败:', error);
+            });
+        });
+    });
+}
+
+function closeSfuConnection() {
+    if (sfuConnection) {
+        sfuConnection.close();
+        sfuConnection = null;
+    }
+    sfuTrackUsers = {};
+}
+
 /**
  * 生成唯一的 Peer 连接 ID（排序确保两端一致）
  */
@@ -577,11 +1100,12 @@ function createPeerConnection(targetUserId, isInitiator) {
     const peerConnection = new RTCPeerConnection(rtcConfig);
     peerConnections[peerId] = peerConnection;
 
-    // 添加本地音频流
+    // 添加本地音频流；新连接默认发送，下一次音量检测时再按发言状态暂停
     if (localStream) {
         localStream.getTracks().forEach(track => {
             peerConnection.addTrack(track, localStream);
         });
+        sendGateOpen = true;
     }
 
     // 接收远端音频流
@@ -590,17 +1114,18 @@ function createPeerConnection(targetUserId, isInitiator) {
         playRemoteStream(event.streams[0], targetUserId);
     };
 
-    // ICE 候选
+    // ICE 候选；event.candidate 为 null 表示本端收集完毕，通知对方 end-of-candidates
     peerConnection.onicecandidate = (event) => {
         if (event.candidate) {
             console.log('发送 ICE 候选到:', targetUserId);
-            socket.emit('webrtc_ice_candidate', {
-                room_id: currentRoomId,
-                target_user_id: targetUserId,
-                candidate: event.candidate,
-                from_user_id: userId
-            });
         }
+        socket.emit('webrtc_ice_candidate', {
+            room_id: currentRoomId,
+            target_user_id: targetUserId,
+            candidate: event.candidate || null,
+            end: !event.candidate,
+            from_user_id: userId
+        });
     };
 
     // 连接状态变化
@@ -722,14 +1247,15 @@ function openRoom(roomId, name, type) {
     console.log('打开房间:', roomId, name, type);
 
     if (!socket || !socket.connected) {
-        socket = io();
+        socket = connectSocket();
         setTimeout(() => openRoom(roomId, name, type), 500);
         return;
     }
 
     socket.emit('join_invite', {
         user_id: userId,
-        code: roomId
+        code: roomId,
+        after: lastMessageId(roomId)
     });
 
     openChat(roomId, name, type, []);
@@ -839,8 +1365,7 @@ function openChat(roomId, name, type, members) {
         voiceBtn.disabled = true;
     }
 
-    const container = document.getElementById('messages-container');
-    container.innerHTML = '';
+    renderRoomMessages(roomId);
 
     // 显示/隐藏邀请按钮（仅群聊显示）
     const inviteBtn = document.getElementById('invite-to-room-btn');
@@ -861,7 +1386,81 @@ function openChat(roomId, name, type, members) {
     }
 }
 
-function appendMessage(data) {
+// ========== 消息历史 ==========
+function lastMessageId(roomId) {
+    const list = roomMessages[roomId];
+    return list && list.length ? list[list.length - 1].id : null;
+}
+
+// 把新消息按 seq 追加到本地缓存，返回是否追加在末尾；
+// 多进程部署下其他进程的消息可能稍晚到达，此时插入到对应位置并重新渲染当前房间
+function mergeRoomMessages(roomId, messages) {
+    const list = roomMessages[roomId] || (roomMessages[roomId] = []);
+    let added = false;
+    let reordered = false;
+    messages.forEach(m => {
+        const last = list[list.length - 1];
+        if (!last || !m.seq || !last.seq || m.seq > last.seq) {
+            list.push(m);
+            added = true;
+        } else if (!list.some(x => x.id === m.id)) {
+            const pos = list.findIndex(x => x.seq > m.seq);
+            list.splice(pos, 0, m);
+            reordered = true;
+        }
+    });
+    if (reordered && roomId === currentRoomId) {
+        renderRoomMessages(roomId);
+        return false;
+    }
+    return added;
+}
+
+function renderRoomMessages(roomId) {
+    const container = document.getElementById('messages-container');
+    container.innerHTML = '';
+    (roomMessages[roomId] || []).forEach(m => appendMessage(m));
+}
+
+function requestHistory(roomId, cursor) {
+    if (!socket || historyLoading) return;
+    historyLoading = true;
+    socket.emit('get_history', {
+        user_id: userId,
+        room_id: roomId,
+        limit: HISTORY_PAGE_SIZE,
+        ...cursor
+    });
+}
+
+// 滚动到顶部时加载更早的一页
+function loadOlderHistory() {
+    const list = roomMessages[currentRoomId];
+    if (!currentRoomId || !roomHasMore[currentRoomId] || !list || !list.length) return;
+    requestHistory(currentRoomId, { before: list[0].id });
+}
+
+function prependRoomMessages(roomId, messages) {
+    const list = roomMessages[roomId] || (roomMessages[roomId] = []);
+    const first = list[0];
+    const older = first && first.seq ? messages.filter(m => m.seq < first.seq) : messages;
+    roomMessages[roomId] = older.concat(list);
+    if (roomId !== currentRoomId || !older.length) return;
+
+    // 保持当前可见位置不跳动
+    const container = document.getElementById('messages-container');
+    const prevHeight = container.scrollHeight;
+    for (let i = older.length - 1; i >= 0; i--) {
+        appendMessage(older[i], true);
+    }
+    container.scrollTop += container.scrollHeight - prevHeight;
+}
+
+document.getElementById('messages-container').addEventListener('scroll', (e) => {
+    if (e.target.scrollTop < 40) loadOlderHistory();
+});
+
+function appendMessage(data, prepend = false) {
     const container = document.getElementById('messages-container');
     const isOwn = data.user_id === userId;
 
@@ -873,10 +1472,12 @@ function appendMessage(data) {
 
     let contentHtml = data.content;
     if (data.type === 'voice') {
-        // 语音消息：显示一个可点击的播放按钮
+        // 语音消息：显示一个可点击的播放按钮，点击时才按需下载音频
+        const voice = data.voice || { id: data.content, duration: 0 };
+        const seconds = voice.duration ? ` ${Math.max(1, Math.round(voice.duration / 1000))}″` : '';
         contentHtml = `
-            <button class="voice-play-btn" data-audio="data:audio/webm;base64,${data.content}">
-                🎤 播放语音
+            <button class="voice-play-btn" data-audio="/voice/${voice.id}">
+                🎤 播放语音${seconds}
             </button>
         `;
     }
@@ -892,8 +1493,12 @@ function appendMessage(data) {
         </div>
     `;
 
-    container.appendChild(messageDiv);
-    container.scrollTop = container.scrollHeight;
+    if (prepend) {
+        container.insertBefore(messageDiv, container.firstChild);
+    } else {
+        container.appendChild(messageDiv);
+        container.scrollTop = container.scrollHeight;
+    }
 
     // 如果是语音消息，为播放按钮绑定事件
     if (data.type === 'voice') {
@@ -903,7 +1508,9 @@ function appendMessage(data) {
                 const src = playBtn.getAttribute('data-audio');
                 if (!src) return;
 
-                const audio = new Audio(src);
+                const audio = new Audio();
+                audio.preload = 'none';
+                audio.src = src;
 
                 audio.play().catch(e => {
                     console.error('播放语音消息失败:', e);
@@ -1053,20 +1660,7 @@ async function startRecording() {
             }
 
             const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
-            const reader = new FileReader();
-
-            reader.onloadend = () => {
-                const base64Data = reader.result.split(',')[1];
-
-                socket.emit('send_message', {
-                    user_id: userId,
-                    room_id: currentRoomId,
-                    content: base64Data,
-                    type: 'voice'
-                });
-            };
-
-            reader.readAsDataURL(audioBlob);
+            sendVoiceMessage(audioBlob, duration);
 
             setTimeout(() => {
                 stream.getTracks().forEach(track => track.stop());
@@ -1095,6 +1689,40 @@ async function startRecording() {
     }
 }
 
+/**
+ * 通过 HTTP 上传语音二进制，再用 send_message 发送语音 ID
+ */
+async function sendVoiceMessage(audioBlob, duration) {
+    const roomId = currentRoomId;
+    const formData = new FormData();
+    formData.append('user_id', userId);
+    formData.append('room_id', roomId);
+    formData.append('audio', audioBlob, 'voice.webm');
+
+    try {
+        const response = await fetch('/upload_voice', {
+            method: 'POST',
+            body: formData
+        });
+        const data = await response.json();
+        if (!data.success) {
+            alert(data.message || '语音发送失败');
+            return;
+        }
+
+        socket.emit('send_message', {
+            user_id: userId,
+            room_id: roomId,
+            content: data.voice_id,
+            duration: duration,
+            type: 'voice'
+        });
+    } catch (error) {
+        console.error('上传语音失败:', error);
+        alert('语音发送失败：' + error.message);
+    }
+}
+
 function stopRecording() {
     if (!isRecording || !mediaRecorder) return;
 
@@ -1184,6 +1812,74 @@ function showInviteToRoomModal() {
     openModal('invite-to-room-modal');
 }
 
+// ==================== 消息搜索 ====================
+
+let searchOffset = 0;
+
+function showSearchModal() {
+    if (!currentRoomId) return;
+    document.getElementById('search-input').value = '';
+    document.getElementById('search-results').innerHTML = '';
+    document.getElementById('search-error').classList.add('hidden');
+    document.getElementById('search-more-btn').classList.add('hidden');
+    openModal('search-modal');
+    document.getElementById('search-input').focus();
+}
+
+/**
+ * 搜索当前房间的历史消息，more 为 true 时加载下一页
+ */
+function searchMessages(more) {
+    if (!currentRoomId) return;
+    if (!more) searchOffset = 0;
+    document.getElementById('search-error').classList.add('hidden');
+    socket.emit('search_messages', {
+        user_id: userId,
+        room_id: currentRoomId,
+        query: document.getElementById('search-input').value.trim(),
+        type: document.getElementById('search-type').value,
+        sort: document.getElementById('search-sort').value,
+        offset: searchOffset,
+        limit: 20
+    });
+}
+
+function showSearchError(message) {
+    const error = document.getElementById('search-error');
+    error.textContent = message;
+    error.classList.remove('hidden');
+}
+
+function renderSearchResults(data) {
+    const container = document.getElementById('search-results');
+    if (data.offset === 0) container.innerHTML = '';
+
+    // 消息内容按纯文本显示
+    data.messages.forEach(m => {
+        const item = document.createElement('div');
+        item.className = 'search-result';
+        const header = document.createElement('div');
+        header.className = 'search-result-header';
+        header.textContent = `${m.nickname} · ${new Date(m.timestamp).toLocaleString('zh-CN')}`;
+        const content = document.createElement('div');
+        content.className = 'search-result-content';
+        content.textContent = m.type === 'voice' ? '🎤 语音消息' : m.content;
+        item.appendChild(header);
+        item.appendChild(content);
+        container.appendChild(item);
+    });
+
+    if (data.offset === 0 && data.messages.length === 0) {
+        container.innerHTML = '<p class="search-empty">没有找到相关消息</p>';
+    }
+    searchOffset = data.offset + data.messages.length;
+    document.getElementById('search-more-btn').classList.toggle('hidden', !data.has_more);
+}
+
+document.getElementById('search-input').addEventListener('keypress', (e) => {
+    if (e.key === 'Enter') searchMessages(false);
+});
+
 /**
  * 生成房间邀请码
  */
@@ -1287,15 +1983,8 @@ async function startVoiceChat() {
             room_id: currentRoomId
         });
 
-        // 为所有其他成员创建 Peer 连接
-        if (window.currentRoomMembers && window.currentRoomMembers.length > 0) {
-            console.log('为房间成员创建 Peer 连接:', window.currentRoomMembers);
-            window.currentRoomMembers.forEach(member => {
-                if (member.user_id !== userId) {
-                    createPeerConnection(member.user_id, true);
-                }
-            });
-        }
+        // Peer 连接在收到 voice_room_users 后按服务端选择的模式（mesh / sfu）创建
+        startLevelMeter();
 
         showVoicePanel();
     } catch (error) {
@@ -1318,6 +2007,9 @@ function leaveVoiceChat() {
         }
     });
     peerConnections = {};
+    closeSfuConnection();
+    stopLevelMeter();
+    voiceMode = 'mesh';
 
     // 停止本地音频流
     if (localStream) {
@@ -1494,4 +2186,5 @@ window.addEventListener('beforeunload', () => {
             pc.close();
         }
     });
+    closeSfuConnection();
 });
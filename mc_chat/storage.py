@@ -0,0 +1,62 @@
+"""
+按内容哈希寻址的文件存储
+相同内容只落盘一次，文件名即 SHA-256
+"""
+import hashlib
+import os
+import re
+import uuid
+
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_digest(value):
+    return bool(value) and _DIGEST_RE.match(value) is not None
+
+
+class ContentStore:
+    """root/<sha256><suffix> 形式的只增存储"""
+
+    def __init__(self, root, suffix=''):
+        self.root = root
+        self.suffix = suffix
+
+    def filename(self, digest):
+        return f'{digest}{self.suffix}'
+
+    def path(self, digest):
+        return os.path.join(self.root, self.filename(digest))
+
+    def exists(self, digest):
+        return is_digest(digest) and os.path.exists(self.path(digest))
+
+    def size(self, digest):
+        try:
+            return os.path.getsize(self.path(digest))
+        except OSError:
+            return None
+
+    def put(self, data, digest=None):
+        """
+        写入内容，返回 (digest, created)；已存在时不再写盘
+        先写临时文件再 os.replace，并发上传同一内容也不会读到半个文件
+        """
+        digest = digest or content_digest(data)
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest, False
+
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return digest, True
+
+    def read(self, digest):
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
@@ -0,0 +1,7 @@
+"""
+测试直接导入 mc_chat 下的平铺模块，与 app.py 的导入方式一致
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
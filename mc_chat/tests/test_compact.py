@@ -0,0 +1,113 @@
+"""
+紧凑编码：服务端 encode() / introduce() 的输出交给浏览器端的 connectSocket 解码并展开句柄
+"""
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+msgpack = pytest.importorskip('msgpack')
+
+from compact import CompactCodec
+
+APP_JS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'js', 'app.js')
+
+USER = '0f8fad5b-d9cb-469f-a165-70867728950e'
+ROOM = '7c9e6679-7425-40de-944b-e07fc1f90ae7'
+MESSAGE = '16fd2706-8baf-433b-82eb-8c7fada847da'
+
+# 用假的 io() 执行 app.js 中的紧凑编码部分，按顺序把 [事件, 十六进制载荷] 交给注册的处理函数
+RUNNER = r'''
+const handlers = {};
+const io = () => ({ on(event, handler) { handlers[event] = handler; } });
+eval(require('fs').readFileSync(process.argv[1], 'utf8'));
+const s = connectSocket();
+const received = [];
+s.on('new_message', (data) => received.push(data));
+for (const [event, hex] of JSON.parse(process.argv[2])) {
+    const bytes = Buffer.from(hex, 'hex');
+    handlers[event](bytes.buffer.slice(bytes.byteOffset, bytes.byteOffset + bytes.length));
+}
+console.log(JSON.stringify({ received, compactIds }));
+'''
+
+
+def compact_section():
+    with open(APP_JS, encoding='utf-8') as f:
+        source = f.read()
+    start = source.index('// ========== 紧凑编码 ==========')
+    end = source.index('// ==========', start + 1)
+    return source[start:end].replace('let compactIds', 'var compactIds')
+
+
+def message():
+    return {
+        'id': MESSAGE,
+        'room_id': ROOM,
+        'user_id': USER,
+        'content': 'hi',
+        'timestamp': '2024-01-01T00:00:00+00:00'
+    }
+
+
+def send(codec, sid, args):
+    """与 fanout 发往一个连接的顺序一致：先 ids（如有），再事件本身"""
+    payload, handles = codec.encode(args)
+    with codec.lock:
+        ids = codec.introduce(sid, handles)
+    frames = [('ids', ids)] if ids else []
+    return frames + [('new_message', payload)]
+
+
+def test_ids_are_msgpack_with_integer_keys():
+    codec = CompactCodec()
+    codec.enable('sid')
+    payload, handles = codec.encode([message()])
+    ids = msgpack.unpackb(codec.introduce('sid', handles), strict_map_key=False)
+    assert ids == {codec.handle(USER): USER, codec.handle(ROOM): ROOM}
+    data = msgpack.unpackb(payload, strict_map_key=False)[0]
+    assert ids[data['user_id']] == USER and ids[data['room_id']] == ROOM
+    assert data['id'] == bytes.fromhex(MESSAGE.replace('-', ''))
+    # 同一连接已认识的句柄不再发送
+    assert codec.introduce('sid', handles) is None
+
+
+def test_prune_releases_dead_handles():
+    live = {USER}
+    codec = CompactCodec(alive=lambda value: value in live)
+    codec._prune_at = 2
+    codec.enable('sid')
+    first = codec.handle(ROOM)
+    codec.handle(USER)
+    codec.handle('other')
+    assert codec.stats()['released'] == 1
+    # 句柄号不复用，释放后重新分配的是新句柄
+    assert codec.handle(ROOM) != first
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='需要 node')
+def test_client_expands_handles(tmp_path):
+    codec = CompactCodec()
+    codec.enable('sid')
+    frames = send(codec, 'sid', [message()]) + send(codec, 'sid', [message()])
+    # 第二次发送不再带 ids
+    assert [event for event, _ in frames] == ['ids', 'new_message', 'new_message']
+
+    script = tmp_path / 'compact.js'
+    script.write_text(compact_section(), encoding='utf-8')
+    result = subprocess.run(
+        ['node', '-e', RUNNER, str(script), json.dumps([[event, data.hex()] for event, data in frames])],
+        capture_output=True, text=True, check=True, timeout=30
+    )
+    output = json.loads(result.stdout)
+    expected = {
+        'id': MESSAGE,
+        'room_id': ROOM,
+        'user_id': USER,
+        'content': 'hi',
+        'timestamp': 1704067200000
+    }
+    assert output['received'] == [expected, expected]
+    assert sorted(output['compactIds'].values()) == sorted([USER, ROOM])
@@ -0,0 +1,77 @@
+"""
+分层时间轮：到期时刻、高层下放（cascade）、改期与取消
+"""
+import random
+
+from expiry import ExpiryEngine, TimingWheel
+
+
+def run_until_expired(wheel, key, limit):
+    for tick in range(1, limit + 1):
+        if key in wheel.advance():
+            return tick
+    return None
+
+
+def test_expires_on_exact_tick_in_level_zero():
+    wheel = TimingWheel(slots=8, levels=3)
+    wheel.schedule('a', 5)
+    assert run_until_expired(wheel, 'a', 10) == 5
+    assert len(wheel) == 0
+
+
+def test_cascade_from_higher_levels():
+    wheel = TimingWheel(slots=4, levels=3)
+    # 4 个槽、3 层：第 1 层每槽 4 tick，第 2 层每槽 16 tick
+    for ticks in (4, 5, 15, 16, 17, 40, 63):
+        wheel.schedule(ticks, ticks)
+    expired = {}
+    for tick in range(1, 70):
+        for key in wheel.advance():
+            expired[key] = tick
+    assert expired == {ticks: ticks for ticks in (4, 5, 15, 16, 17, 40, 63)}
+
+
+def test_cascade_with_random_deadlines_from_offset_start():
+    wheel = TimingWheel(slots=8, levels=3)
+    # 先走一段，让当前时刻不在各层的边界上
+    for _ in range(37):
+        wheel.advance()
+    rng = random.Random(1)
+    deadlines = {f'k{i}': rng.randint(1, 8 ** 3 - 1) for i in range(300)}
+    for key, ticks in deadlines.items():
+        wheel.schedule(key, ticks)
+    expired = {}
+    for tick in range(1, 8 ** 3 + 1):
+        for key in wheel.advance():
+            expired[key] = tick
+    assert expired == deadlines
+
+
+def test_delay_beyond_range_is_clamped():
+    wheel = TimingWheel(slots=4, levels=2)
+    wheel.schedule('far', 1000)
+    assert run_until_expired(wheel, 'far', 100) == 15
+
+
+def test_reschedule_and_cancel():
+    wheel = TimingWheel(slots=4, levels=3)
+    wheel.schedule('a', 3)
+    wheel.schedule('a', 20)
+    wheel.schedule('b', 6)
+    wheel.cancel('b')
+    assert 'b' not in wheel
+    assert run_until_expired(wheel, 'a', 30) == 20
+    assert len(wheel) == 0
+
+
+def test_engine_counts_evicted_and_skipped():
+    engine = ExpiryEngine(tick=1.0)
+    engine.on('user', lambda key: key == 'gone')
+    engine._expire('user', 'gone')
+    engine._expire('user', 'back')
+    engine._expire('unknown', 'x')
+    assert engine.stats()['evicted'] == {'user': 1}
+    assert engine.stats()['skipped'] == 1
+    engine.schedule('user', 'a', 0)
+    assert engine.stats()['pending'] == 0
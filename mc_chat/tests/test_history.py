@@ -0,0 +1,96 @@
+"""
+MessageHistory：环形缓冲区的淘汰、按 seq 插入和二分查找的边界
+"""
+from history import MessageHistory
+
+
+def message(seq):
+    return {'id': f'm{seq}', 'seq': seq}
+
+
+def filled(capacity, seqs):
+    history = MessageHistory(capacity)
+    for seq in seqs:
+        history.append(message(seq))
+    return history
+
+
+def seqs(messages):
+    return [m['seq'] for m in messages]
+
+
+def test_append_evicts_oldest_when_full():
+    history = filled(3, [1, 2, 3])
+    evicted = history.append(message(4))
+    assert evicted['seq'] == 1
+    assert seqs(history) == [2, 3, 4]
+    assert history.first_seq == 2
+    assert history.seq_of('m1') is None
+    assert history.seq_of('m4') == 4
+
+
+def test_append_ignores_duplicate_id():
+    history = filled(3, [1, 2])
+    assert history.append(message(2)) is None
+    assert seqs(history) == [1, 2]
+
+
+def test_late_message_inserted_in_seq_order():
+    history = filled(5, [1, 2, 4, 5])
+    assert history.append(message(3)) is None
+    assert seqs(history) == [1, 2, 3, 4, 5]
+
+
+def test_message_older_than_full_buffer_is_rejected():
+    history = filled(3, [5, 6, 7])
+    late = message(2)
+    assert history.append(late) is late
+    assert seqs(history) == [5, 6, 7]
+    assert history.seq_of('m2') is None
+
+
+def test_last():
+    history = filled(4, [1, 2, 3, 4, 5, 6])
+    assert seqs(history.last(2)) == [5, 6]
+    assert seqs(history.last(10)) == [3, 4, 5, 6]
+    assert history.last(0) == []
+
+
+def test_get_hits_and_misses():
+    history = filled(4, [2, 4, 6])
+    assert history.get(4)['id'] == 'm4'
+    assert history.get(3) is None
+    assert history.get(1) is None
+    assert history.get(7) is None
+
+
+def test_before_boundaries():
+    history = filled(10, [1, 2, 3, 4, 5])
+    assert seqs(history.before(None, 2)) == [4, 5]
+    assert seqs(history.before(3, 10)) == [1, 2]
+    assert seqs(history.before(4, 2)) == [2, 3]
+    assert history.before(1, 5) == []
+    assert seqs(history.before(99, 2)) == [4, 5]
+
+
+def test_after_boundaries():
+    history = filled(10, [1, 2, 3, 4, 5])
+    assert seqs(history.after(2, 2)) == [3, 4]
+    assert seqs(history.after(3, 10)) == [4, 5]
+    assert history.after(5, 3) == []
+    assert seqs(history.after(0, 2)) == [1, 2]
+
+
+def test_cursor_between_sparse_seqs():
+    # 多进程部署时 seq 可能有间隔，游标不必是缓冲区中存在的 seq
+    history = filled(10, [10, 20, 30, 40])
+    assert seqs(history.before(25, 5)) == [10, 20]
+    assert seqs(history.after(25, 5)) == [30, 40]
+
+
+def test_slice_near_tail_after_wraparound():
+    history = filled(6, range(1, 21))
+    assert seqs(history) == [15, 16, 17, 18, 19, 20]
+    assert seqs(history.before(20, 2)) == [18, 19]
+    assert seqs(history.after(15, 3)) == [16, 17, 18]
+    assert seqs(history.before(16, 3)) == [15]
@@ -0,0 +1,114 @@
+"""
+ChatState.history_page：按消息 ID 游标分页，缓冲区之外的部分从 journal 读取
+"""
+import threading
+
+from persistence import ChatJournal
+from state import ChatState
+
+
+def make_state(capacity, count, journal=None):
+    state = ChatState(history_capacity={'group': capacity}, journal=journal)
+    state.add_user('u1', 'a')
+    state.create_room('r', 'group', 'g', 'u1', None)
+    for i in range(1, count + 1):
+        state.append_message('r', {'id': f'm{i}', 'user_id': 'u1', 'content': f'hello {i}'})
+    return state
+
+
+def ids(page):
+    return [m['id'] for m in page['messages']]
+
+
+def test_latest_page():
+    page = make_state(10, 5).history_page('r', limit=3)
+    assert ids(page) == ['m3', 'm4', 'm5']
+    assert page['has_more'] is True
+    assert page['reset'] is False
+
+
+def test_before_cursor_until_start():
+    state = make_state(10, 5)
+    page = state.history_page('r', before='m3', limit=5)
+    assert ids(page) == ['m1', 'm2']
+    assert page['has_more'] is False
+
+
+def test_after_cursor():
+    state = make_state(10, 5)
+    page = state.history_page('r', after='m2', limit=2)
+    assert ids(page) == ['m3', 'm4']
+    assert page['has_more'] is True
+    page = state.history_page('r', after='m4', limit=2)
+    assert ids(page) == ['m5']
+    assert page['has_more'] is False
+    assert state.history_page('r', after='m5')['messages'] == []
+
+
+def test_unknown_cursor_resets_to_latest():
+    state = make_state(3, 5)
+    # m1 已被挤出缓冲区，没有 journal 时找不到
+    page = state.history_page('r', after='m1', limit=2)
+    assert page['reset'] is True
+    assert ids(page) == ['m4', 'm5']
+
+
+def test_missing_room():
+    assert make_state(3, 1).history_page('nope') is None
+
+
+def test_pages_beyond_buffer_come_from_journal(tmp_path):
+    journal = ChatJournal(str(tmp_path / 'chat.db'))
+    journal.start()
+    state = make_state(3, 10, journal=journal)
+    journal.close()
+
+    page = state.history_page('r', before='m8', limit=4)
+    assert ids(page) == ['m4', 'm5', 'm6', 'm7']
+    assert page['has_more'] is True
+    page = state.history_page('r', before='m4', limit=4)
+    assert ids(page) == ['m1', 'm2', 'm3']
+    assert page['has_more'] is False
+
+    # 游标在缓冲区之外、结果跨过缓冲区边界
+    page = state.history_page('r', after='m5', limit=4)
+    assert ids(page) == ['m6', 'm7', 'm8', 'm9']
+    assert page['has_more'] is True
+    assert page['reset'] is False
+
+
+def test_journal_reads_run_outside_room_lock(tmp_path):
+    locked = []
+
+    class WatchedJournal(ChatJournal):
+        def lock_free(self):
+            # 从另一个线程尝试获取房间锁（分段锁可重入，同一线程总能获取）
+            result = []
+
+            def probe():
+                lock = state.room_lock('r')
+                result.append(lock.acquire(blocking=False))
+                if result[0]:
+                    lock.release()
+
+            thread = threading.Thread(target=probe)
+            thread.start()
+            thread.join()
+            locked.append(not result[0])
+
+        def messages_before(self, *args):
+            self.lock_free()
+            return super().messages_before(*args)
+
+        def messages_after(self, *args):
+            self.lock_free()
+            return super().messages_after(*args)
+
+    journal = WatchedJournal(str(tmp_path / 'chat.db'))
+    journal.start()
+    state = make_state(3, 10, journal=journal)
+    journal.close()
+
+    assert ids(state.history_page('r', before='m8', limit=4)) == ['m4', 'm5', 'm6', 'm7']
+    assert ids(state.history_page('r', after='m2', limit=4)) == ['m3', 'm4', 'm5', 'm6']
+    assert locked == [False, False]
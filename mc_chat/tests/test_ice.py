@@ -0,0 +1,70 @@
+"""
+ICE 候选合并：窗口内攒批、提前发出与过期的截止时间
+"""
+import time
+
+from ice import IceCoalescer
+
+
+def make(window, max_batch=32):
+    flushed = []
+    coalescer = IceCoalescer(lambda sid, payload: flushed.append((time.monotonic(), sid, payload)),
+                             window=window, max_batch=max_batch)
+    return coalescer, flushed
+
+
+def wait_for(flushed, count, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while len(flushed) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return len(flushed) >= count
+
+
+def test_candidates_in_window_are_merged():
+    coalescer, flushed = make(0.05)
+    for i in range(3):
+        coalescer.add('r', 'u1', 'sid', candidate={'c': i})
+    coalescer.add('r', 'u2', 'sid', candidate={'c': 9})
+    assert wait_for(flushed, 2)
+    payloads = {payload['from_user_id']: payload for _, _, payload in flushed}
+    assert payloads['u1']['candidates'] == [{'c': 0}, {'c': 1}, {'c': 2}]
+    assert payloads['u1']['end'] is False
+    assert coalescer.stats() == {'pending': 0, 'candidates': 4, 'batches': 2}
+
+
+def test_end_and_full_batch_flush_immediately():
+    coalescer, flushed = make(10.0, max_batch=2)
+    coalescer.add('r', 'u1', 'sid', candidate={'c': 0})
+    coalescer.add('r', 'u1', 'sid', candidate={'c': 1})
+    coalescer.add('r', 'u2', 'sid', end=True)
+    assert [payload['candidates'] for _, _, payload in flushed] == [[{'c': 0}, {'c': 1}], []]
+    assert flushed[1][2]['end'] is True
+
+
+def test_stale_deadline_does_not_flush_next_batch_early():
+    window = 0.3
+    coalescer, flushed = make(window, max_batch=2)
+    start = time.monotonic()
+    coalescer.add('r', 'u1', 'sid', candidate={'c': 0})
+    coalescer.add('r', 'u1', 'sid', candidate={'c': 1})
+    assert len(flushed) == 1
+
+    time.sleep(window / 2)
+    second = time.monotonic()
+    coalescer.add('r', 'u1', 'sid', candidate={'c': 2})
+    # 第一批的截止时间已过，第二批的还没到
+    time.sleep(start + window * 1.25 - time.monotonic())
+    assert len(flushed) == 1
+    assert wait_for(flushed, 2)
+    assert flushed[1][0] - second >= window
+    assert flushed[1][2]['candidates'] == [{'c': 2}]
+
+
+def test_discard_drops_pending_batches():
+    coalescer, flushed = make(0.05)
+    coalescer.add('r', 'u1', 'gone', candidate={'c': 0})
+    coalescer.discard('gone')
+    coalescer.add('r', 'u1', 'sid', candidate={'c': 1})
+    assert wait_for(flushed, 1)
+    time.sleep(0.1)
+    assert [sid for _, sid, _ in flushed] == ['sid']
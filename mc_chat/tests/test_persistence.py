@@ -0,0 +1,100 @@
+"""
+ChatJournal：事件写入后重启，用 load() 的快照恢复出同样的状态
+"""
+import sqlite3
+
+from persistence import ChatJournal, connect
+from state import ChatState
+
+CAPACITY = {'private': 100, 'group': 3}
+
+
+def restart(path, state=None):
+    """关闭旧 journal（写完积压的事件），用同一个数据库重新加载"""
+    if state is not None:
+        state.journal.close()
+    journal = ChatJournal(path)
+    restored = ChatState(history_capacity=CAPACITY, journal=journal)
+    restored.restore(journal.load(CAPACITY))
+    journal.start()
+    return restored
+
+
+def test_replay_after_restart(tmp_path):
+    path = str(tmp_path / 'chat.db')
+    journal = ChatJournal(path)
+    journal.start()
+    state = ChatState(history_capacity=CAPACITY, journal=journal)
+    state.add_user('u1', 'alice')
+    state.add_user('u2', 'bob')
+    state.add_user('u3', 'carol')
+    state.update_user('u1', avatar='/avatar/x.png')
+    state.create_room('r1', 'group', 'g', 'u1', 'sid1')
+    state.add_member('r1', 'u2', 'sid2')
+    state.add_member('r1', 'u3', 'sid3')
+    for i in range(1, 6):
+        state.append_message('r1', {'id': f'm{i}', 'user_id': 'u1', 'content': str(i)})
+    state.add_invite_code('abc', 'r1', expires_at=None, max_uses=3)
+    state.use_invite_code('abc')
+    state.add_invite_code('gone', 'r1')
+    state.remove_invite_code('gone')
+    state.create_room('r2', 'private', 'p', 'u2', 'sid2')
+    state.delete_room('r2')
+    state.remove_user('u3')
+
+    restored = restart(path, state)
+
+    assert set(restored.users) == {'u1', 'u2'}
+    assert restored.users['u1']['avatar'] == '/avatar/x.png'
+    assert restored.users['u1']['socket_id'] is None
+    assert set(restored.rooms) == {'r1'}
+    assert restored.member_ids('r1') == ['u1', 'u2']
+    assert restored.rooms_of('u2') == ['r1']
+    # 只加载缓冲区容量内的最近消息，seq 接着往后分配
+    assert [m['id'] for m in restored.recent_messages('r1', 10)] == ['m3', 'm4', 'm5']
+    assert restored.rooms['r1']['last_seq'] == 5
+    assert restored.invite_codes == {'abc': 'r1'}
+    assert restored.invite_limits['abc'] == {'expires_at': None, 'max_uses': 3, 'uses': 1}
+    restored.journal.close()
+
+
+def test_second_restart_keeps_new_events(tmp_path):
+    path = str(tmp_path / 'chat.db')
+    first = restart(path)
+    first.add_user('u1', 'alice')
+    first.create_room('r1', 'group', 'g', 'u1', None)
+    first.append_message('r1', {'id': 'm1', 'user_id': 'u1', 'content': 'a'})
+
+    second = restart(path, first)
+    second.append_message('r1', {'id': 'm2', 'user_id': 'u1', 'content': 'b'})
+    assert second.recent_messages('r1', 10)[-1]['seq'] == 2
+
+    third = restart(path, second)
+    assert [m['id'] for m in third.recent_messages('r1', 10)] == ['m1', 'm2']
+    page = third.history_page('r1', before='m2')
+    assert [m['id'] for m in page['messages']] == ['m1']
+    third.journal.close()
+
+
+def test_failed_compaction_is_not_counted(tmp_path):
+    journal = ChatJournal(str(tmp_path / 'chat.db'))
+    journal._since_snapshot = 5
+
+    class FailingCommit:
+        def __init__(self, conn):
+            self.conn = conn
+
+        def execute(self, sql, *args):
+            if sql == 'COMMIT':
+                raise sqlite3.OperationalError('disk I/O error')
+            return self.conn.execute(sql, *args)
+
+    conn = connect(journal.path)
+    journal.compact(FailingCommit(conn))
+    assert journal.snapshots == 0
+    assert journal._since_snapshot == 5
+
+    journal.compact(conn)
+    conn.close()
+    assert journal.snapshots == 1
+    assert journal._since_snapshot == 0
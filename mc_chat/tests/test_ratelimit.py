@@ -0,0 +1,96 @@
+"""
+令牌桶与限流规则
+"""
+import pytest
+
+from ratelimit import RateLimiter, TokenBuckets, merge_limits, parse_limits, payload_size
+
+
+def test_bucket_starts_full_and_refills_lazily():
+    buckets = TokenBuckets()
+    spec = [('k', 2.0, 4.0, 1)]
+    for _ in range(4):
+        assert buckets.take(spec, now=0.0) == 0.0
+    assert buckets.take(spec, now=0.0) == pytest.approx(0.5)
+    # 0.5 秒补充 1 个令牌
+    assert buckets.take(spec, now=0.5) == 0.0
+    assert buckets.take(spec, now=0.5) > 0
+    # 补充不超过 burst
+    for _ in range(4):
+        assert buckets.take(spec, now=100.0) == 0.0
+    assert buckets.take(spec, now=100.0) > 0
+
+
+def test_multi_bucket_take_is_all_or_nothing():
+    buckets = TokenBuckets()
+    assert buckets.take([('a', 1.0, 1.0, 1)], now=0.0) == 0.0
+    # b 足够、a 不够：两个都不扣除
+    wait = buckets.take([('a', 1.0, 1.0, 1), ('b', 1.0, 1.0, 1)], now=0.0)
+    assert wait == pytest.approx(1.0)
+    assert buckets.take([('b', 1.0, 1.0, 1)], now=0.0) == 0.0
+
+
+def test_wait_is_longest_of_failing_buckets():
+    buckets = TokenBuckets()
+    buckets.take([('a', 1.0, 1.0, 1), ('b', 0.25, 1.0, 1)], now=0.0)
+    assert buckets.take([('a', 1.0, 1.0, 1), ('b', 0.25, 1.0, 1)], now=0.0) == pytest.approx(4.0)
+
+
+def test_refund_restores_tokens():
+    buckets = TokenBuckets()
+    spec = [('k', 1.0, 1.0, 1)]
+    buckets.take(spec, now=0.0)
+    buckets.refund(spec)
+    assert buckets.take(spec, now=0.0) == 0.0
+
+
+def test_sweep_drops_full_buckets():
+    buckets = TokenBuckets(sweep_every=2)
+    buckets.take([('k', 1.0, 1.0, 1)], now=0.0)
+    assert len(buckets) == 1
+    buckets.take([('z', 1.0, 1.0, 0)], now=10.0)
+    assert 'k' not in buckets._buckets
+
+
+def test_parse_and_merge_limits():
+    parsed = parse_limits('send_message=2/10,send_message:room=20,upload_voice:bytes=0,bad:scope=1,x=oops')
+    assert parsed == {
+        'send_message': {'user': (2.0, 10.0), 'room': (20.0, 20.0)},
+        'upload_voice': {'bytes': None}
+    }
+    merged = merge_limits({'upload_voice': {'user': (1, 2), 'bytes': (10, 100)}}, parsed)
+    assert merged['upload_voice'] == {'user': (1, 2)}
+    assert merged['send_message']['room'] == (20.0, 20.0)
+
+
+def test_payload_size_counts_strings_and_bytes():
+    assert payload_size({'a': 'xyz', 'b': [b'12', {'c': 'd'}], 'n': 5}) == 6
+
+
+def test_limiter_user_and_room_scopes():
+    limiter = RateLimiter({'send': {'user': (0.001, 2), 'room': (0.001, 3)}})
+    assert limiter.check('send', 'sid1', room_id='r') == 0
+    assert limiter.check('send', 'sid1', room_id='r') == 0
+    # sid1 的桶用完
+    assert limiter.check('send', 'sid1', room_id='r') > 0
+    # 房间的桶与 sid 无关，还剩 1 个
+    assert limiter.check('send', 'sid2', room_id='r') == 0
+    assert limiter.check('send', 'sid3', room_id='r') > 0
+    # 不带 room_id（非成员）不消耗房间的桶
+    assert limiter.check('send', 'sid3') == 0
+    assert limiter.stats()['limited'] == {'send': 2}
+
+
+def test_limiter_ignores_unconfigured_events():
+    limiter = RateLimiter({})
+    assert all(limiter.check('anything', 'sid') == 0 for _ in range(100))
+
+
+def test_limiter_falls_back_to_local_when_shared_fails():
+    class BrokenBus:
+        def take(self, specs):
+            raise OSError('down')
+
+    limiter = RateLimiter({'send': {'room': (0.001, 1)}}, shared=BrokenBus())
+    assert limiter.check('send', 'sid', room_id='r') == 0
+    assert limiter.check('send', 'sid', room_id='r') > 0
@@ -0,0 +1,107 @@
+"""
+断线重连：会话保留、令牌一次性使用并轮换、按游标补发漏收的消息
+"""
+import threading
+
+from state import ChatState
+
+
+def make_state():
+    state = ChatState()
+    state.add_user('u1', 'alice')
+    state.add_user('u2', 'bob')
+    state.bind_socket('u1', 'sid1')
+    state.bind_socket('u2', 'sid2')
+    state.create_room('r', 'group', 'g', 'u1', 'sid1')
+    state.add_member('r', 'u2', 'sid2')
+    return state
+
+
+def send(state, user_id, count, start=1):
+    for i in range(start, start + count):
+        state.append_message('r', {'id': f'm{i}', 'user_id': user_id, 'content': str(i)})
+
+
+def test_suspend_keeps_membership_and_unbinds_socket():
+    state = make_state()
+    state.issue_resume_token('u1')
+    assert state.suspend_session('u1', 'sid1') is True
+    assert state.user_by_sid('sid1') is None
+    assert state.is_member('r', 'u1')
+    assert state.peer_sid('r', 'u1') is None
+    # 重连先于断开到达时不解绑新 socket
+    state.bind_socket('u2', 'sid2b')
+    assert state.suspend_session('u2', 'sid2') is False
+    assert state.user_by_sid('sid2b') == 'u2'
+
+
+def test_resume_rebinds_and_returns_delta():
+    state = make_state()
+    token = state.issue_resume_token('u1')
+    send(state, 'u1', 2)
+    state.suspend_session('u1', 'sid1')
+    send(state, 'u2', 3, start=3)
+
+    user_id, room_ids, new_token = state.resume_session(token, 'sid1b')
+    assert (user_id, room_ids) == ('u1', ['r'])
+    assert state.user_by_sid('sid1b') == 'u1'
+    assert state.peer_sid('r', 'u1') == 'sid1b'
+    page = state.history_page('r', after='m2', limit=50)
+    assert [m['id'] for m in page['messages']] == ['m3', 'm4', 'm5']
+    assert page['has_more'] is False
+    assert new_token and new_token != token
+
+
+def test_token_rotates_and_old_token_is_dead():
+    state = make_state()
+    token = state.issue_resume_token('u1')
+    state.suspend_session('u1', 'sid1')
+    _, _, second = state.resume_session(token, 'sid1b')
+    assert state.resume_session(token, 'sid1c') is None
+    assert token not in state.resume_tokens
+    assert state.resume_tokens == {second: 'u1'}
+
+    state.suspend_session('u1', 'sid1b')
+    _, _, third = state.resume_session(second, 'sid1c')
+    assert third not in (token, second)
+    assert state.user_by_sid('sid1c') == 'u1'
+
+
+def test_concurrent_resume_with_same_token_succeeds_once():
+    state = make_state()
+    token = state.issue_resume_token('u1')
+    state.suspend_session('u1', 'sid1')
+    results = []
+    barrier = threading.Barrier(8)
+
+    def attempt(sid):
+        barrier.wait()
+        results.append(state.resume_session(token, sid))
+
+    threads = [threading.Thread(target=attempt, args=(f'new{i}',)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(result is not None for result in results) == 1
+
+
+def test_invalid_token_and_expired_user():
+    state = make_state()
+    assert state.resume_session(None, 'sid') is None
+    assert state.resume_session('nope', 'sid') is None
+    token = state.issue_resume_token('u2')
+    state.suspend_session('u2', 'sid2')
+    assert state.expire_user('u2') == ['r']
+    assert state.resume_session(token, 'sid2b') is None
+    assert not state.is_member('r', 'u2')
+
+
+def test_cursor_outside_buffer_resets():
+    state = ChatState(history_capacity={'group': 3})
+    state.add_user('u1', 'alice')
+    state.create_room('r', 'group', 'g', 'u1', None)
+    send(state, 'u1', 6)
+    page = state.history_page('r', after='m1', limit=50)
+    assert page['reset'] is True
+    assert [m['id'] for m in page['messages']] == ['m4', 'm5', 'm6']
@@ -0,0 +1,110 @@
+"""
+分词、BM25 排序、筛选和索引上限
+"""
+import pytest
+
+from search import RoomIndex, SearchIndex, parse_time, query_terms, tokenize
+from state import ChatState
+
+
+def test_tokenize_latin_and_numbers():
+    assert tokenize('/tp 100 64 -200') == ['tp', '100', '64', '200']
+    assert tokenize('Hello, WORLD hello') == ['hello', 'world', 'hello']
+
+
+def test_tokenize_cjk_unigrams_and_bigrams():
+    assert tokenize('钻石矿') == ['钻', '石', '矿', '钻石', '石矿']
+    assert tokenize('挖 diamond') == ['挖', 'diamond']
+
+
+def test_query_terms_prefer_bigrams_and_dedupe():
+    assert query_terms('钻石') == ['钻石']
+    assert query_terms('挖') == ['挖']
+    assert query_terms('Hello 世界 hello') == ['hello', '世界']
+    assert query_terms('!!!') == []
+
+
+def test_parse_time():
+    assert parse_time(None) is None
+    assert parse_time('') is None
+    assert parse_time(12) == 12.0
+    assert parse_time('12.5') == 12.5
+    assert parse_time('1970-01-01T00:00:10+00:00') == 10.0
+    with pytest.raises(ValueError):
+        parse_time('yesterday')
+
+
+def add(index, seq, content, user_id='u1', message_type='text', ts=None):
+    index.add(seq, user_id, message_type, ts, tokenize(content))
+
+
+def test_bm25_prefers_higher_term_frequency_and_shorter_docs():
+    index = RoomIndex()
+    add(index, 1, 'diamond')
+    add(index, 2, 'diamond diamond diamond')
+    add(index, 3, 'diamond with a lot of other words around it here')
+    add(index, 4, 'nothing relevant')
+    hits, has_more = index.search(query_terms('diamond'))
+    assert [seq for seq, _ in hits] == [2, 1, 3]
+    assert hits[0][1] > hits[1][1] > hits[2][1]
+    assert has_more is False
+
+
+def test_rarer_term_weighs_more():
+    index = RoomIndex()
+    add(index, 1, 'common rare')
+    add(index, 2, 'common common')
+    for seq in range(3, 10):
+        add(index, seq, 'common filler')
+    hits, _ = index.search(query_terms('common rare'))
+    assert [seq for seq, _ in hits] == [1]
+    scores = dict(index.search(query_terms('rare'))[0])
+    common = dict(index.search(query_terms('common'))[0])
+    assert scores[1] > common[1]
+
+
+def test_recent_sort_filters_and_paging():
+    index = RoomIndex()
+    for seq in range(1, 8):
+        add(index, seq, 'tp home', user_id='u1' if seq % 2 else 'u2',
+            message_type='command' if seq > 4 else 'text', ts=float(seq))
+    hits, has_more = index.search(query_terms('tp'), sort='recent', limit=3)
+    assert hits == [(7, None), (6, None), (5, None)] and has_more
+    hits, has_more = index.search(query_terms('tp'), sort='recent', offset=3, limit=10)
+    assert [seq for seq, _ in hits] == [4, 3, 2, 1] and not has_more
+    hits, _ = index.search(query_terms('tp'), user_id='u2', message_type='text')
+    assert sorted(seq for seq, _ in hits) == [2, 4]
+    hits, _ = index.search([], since=3, until=5)
+    assert [seq for seq, _ in hits] == [5, 4, 3]
+
+
+def test_missing_term_returns_nothing():
+    index = RoomIndex()
+    add(index, 1, 'hello world')
+    assert index.search(query_terms('hello nope')) == ([], False)
+
+
+def test_remove_and_eviction_drop_postings():
+    index = SearchIndex(max_messages=2)
+    for seq, content in enumerate(('alpha shared', 'beta shared', 'gamma shared'), 1):
+        index.add('r', {'seq': seq, 'content': content})
+    room = index.rooms['r']
+    assert 'alpha' not in room.postings
+    assert sorted(room.postings['shared']) == [2, 3]
+    index.remove('r', {'seq': 2, 'content': 'beta shared'})
+    assert 'beta' not in room.postings
+    assert room.total_length == 2
+    assert index.stats()['evicted'] == 1
+
+
+def test_state_search_without_journal():
+    state = ChatState(history_capacity={'group': 2}, search=SearchIndex())
+    state.add_user('u1', 'a')
+    state.create_room('r', 'group', 'g', 'u1', None)
+    for i, content in enumerate(('我们去挖钻石吧', '钻石在哪里', '今天天气不错'), 1):
+        state.append_message('r', {'id': f'm{i}', 'user_id': 'u1', 'content': content})
+    # 没有 journal 时被挤出缓冲区的消息也移出索引
+    result = state.search_messages('r', query_terms('钻石'))
+    assert [m['id'] for m in result['messages']] == ['m2']
+    assert result['messages'][0]['score'] > 0
+    assert state.search_messages('nope', query_terms('钻石')) is None